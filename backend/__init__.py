@@ -29,11 +29,37 @@ SESSION_TIMEOUT = 1800  # 30分（秒単位）
 # LLM settings
 LLM_MAX_RETRIES = 3  # LLMが空のレスポンスを返した場合の最大リトライ回数
 LLM_HISTORY_LIMIT = 100  # 会話履歴の最大メッセージ数（システムプロンプト除く）
+LLM_MAX_CONCURRENCY = 8  # LLM呼び出し（チャットの1ターン等）を同時に実行するスレッド数。超えたリクエストは空くまで待つ
+HISTORY_CACHE_SIZE = 64  # 変換済み（List[BaseMessage]）の過去の会話履歴をキャッシュする件数
+
+# Session events settings
+SESSION_EVENTS_QUEUE_SIZE = 100  # セッションのイベントの購読者ごとに溜めておく件数（読むのが遅く超えたら古いものから捨てる）
+SESSION_EVENTS_KEEPALIVE = 15  # イベントがない間、接続を保つためのコメントを送る間隔（秒）
+
+# Memory settings
+MEMORY_MAX_IDLE_USERS = 1000  # メモリに残すlogoutユーザーの上限（超えたら最後に使ったのが古い順に追い出す）。0で無制限
+MEMORY_MAX_CLOSED_BODIES = 256  # メモリに残すclosedの会話本文（messages）の上限。0で無制限
 
 
 # Database settings
 MONGODB_DB = "livraria_dev"
 
+# Storage settings
+DATASTORE_BACKEND = "json"  # DataStoreの永続化方式（json: 全件書き出し / wal: 追記ログ + スナップショット / sqlite: SQLite / sharded: 会話を1件1ファイル / snapshot: msgpackスナップショット + 追記ログ / mongodb: MONGODB_URIのMongoDB）
+WAL_COMPACT_THRESHOLD = 1000  # WALのレコード数がこの値に達したらスナップショットへ圧縮
+WAL_FSYNC = False  # WAL追記ごとにfsyncするか（電源断対策。有効にすると書き込みが遅くなる）。ターンログにも適用
+TURN_LOG = True  # アクティブな会話のターンごとの追記分をログ（turns.jsonl）に書き、異常終了後の起動時に復元する
+WRITE_BEHIND_INTERVAL = 5.0  # 変更をまとめて書き出す間隔（秒）。0で無効（変更のたびにリクエスト内で書き込む）
+WRITE_BEHIND_FSYNC = False  # まとめて書き出すたびにfsyncするか
+DATASTORE_SHARED = False  # 複数ワーカー（uvicorn --workers）で状態を共有する（sqliteバックエンドが必要。write-behindは無効になる）
+SHARED_LOCK_TTL = 120  # ワーカー間のロック（リース）の有効期限（秒）。保持中は ttl/3 秒ごとに延長され、ワーカーが異常終了するとこの時間で解放される
+SHARED_LOCK_WAIT = 30  # 他のワーカーが処理中のセッションを待つ最大時間（秒）。超えたら409を返す
+SHARED_LASTLOGIN_INTERVAL = 60  # 複数ワーカー構成で get_user が lastlogin を保存する最短の間隔（秒）。それより短い読み込みではリースを取らず書き込まない
+ARCHIVE_AFTER_DAYS = 30  # closedになってからこの日数アクセスのない会話をアーカイブへ移す。0で無効
+ARCHIVE_INTERVAL = 3600  # アーカイブ処理（とTTL削除）を実行する間隔（秒）
+ARCHIVE_SEGMENT_SIZE = 64 * 1024 * 1024  # アーカイブのセグメントファイル1つあたりの上限（バイト）
+RECOMMEND_LOG_MAX_PER_USER = 100  # ユーザーごとに残す推薦ログの件数（超えたら古いものから捨てる）。0で無制限
+
 
 # ============================================================================
 # End of Configuration
@@ -80,6 +106,28 @@ FIREBASE_ACCOUNT_KEY_PATH = Path(PROJECT_ROOT, firebase_key_env)
 CONVERSATIONS_FILE = Path(DATA_DIR, "conversations.json")
 USERS_FILE = Path(DATA_DIR, "users.json")
 NFC_USERS_FILE = Path(DATA_DIR, "nfc_users.json")
+WAL_FILE = Path(DATA_DIR, "datastore.wal")
+
+# Storage configuration (環境変数で上書き可能)
+DATASTORE_BACKEND = os.getenv("DATASTORE_BACKEND", DATASTORE_BACKEND)
+WAL_COMPACT_THRESHOLD = int(os.getenv("WAL_COMPACT_THRESHOLD", str(WAL_COMPACT_THRESHOLD)))
+WAL_FSYNC = os.getenv("WAL_FSYNC", str(WAL_FSYNC)).lower() == "true"
+TURN_LOG = os.getenv("TURN_LOG", str(TURN_LOG)).lower() == "true"
+WRITE_BEHIND_INTERVAL = float(os.getenv("WRITE_BEHIND_INTERVAL", str(WRITE_BEHIND_INTERVAL)))
+WRITE_BEHIND_FSYNC = os.getenv("WRITE_BEHIND_FSYNC", str(WRITE_BEHIND_FSYNC)).lower() == "true"
+DATASTORE_SHARED = os.getenv("DATASTORE_SHARED", str(DATASTORE_SHARED)).lower() == "true"
+SHARED_LOCK_TTL = float(os.getenv("SHARED_LOCK_TTL", str(SHARED_LOCK_TTL)))
+SHARED_LOCK_WAIT = float(os.getenv("SHARED_LOCK_WAIT", str(SHARED_LOCK_WAIT)))
+SHARED_LASTLOGIN_INTERVAL = float(os.getenv("SHARED_LASTLOGIN_INTERVAL", str(SHARED_LASTLOGIN_INTERVAL)))
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", str(ARCHIVE_AFTER_DAYS)))
+RECOMMEND_LOG_MAX_PER_USER = int(os.getenv("RECOMMEND_LOG_MAX_PER_USER", str(RECOMMEND_LOG_MAX_PER_USER)))
+MEMORY_MAX_IDLE_USERS = int(os.getenv("MEMORY_MAX_IDLE_USERS", str(MEMORY_MAX_IDLE_USERS)))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", str(LLM_MAX_CONCURRENCY)))
+MEMORY_MAX_CLOSED_BODIES = int(os.getenv("MEMORY_MAX_CLOSED_BODIES", str(MEMORY_MAX_CLOSED_BODIES)))
+ARCHIVE_INTERVAL = int(os.getenv("ARCHIVE_INTERVAL", str(ARCHIVE_INTERVAL)))
+ARCHIVE_SEGMENT_SIZE = int(os.getenv("ARCHIVE_SEGMENT_SIZE", str(ARCHIVE_SEGMENT_SIZE)))
+SESSION_EVENTS_QUEUE_SIZE = int(os.getenv("SESSION_EVENTS_QUEUE_SIZE", str(SESSION_EVENTS_QUEUE_SIZE)))
+SESSION_EVENTS_KEEPALIVE = float(os.getenv("SESSION_EVENTS_KEEPALIVE", str(SESSION_EVENTS_KEEPALIVE)))
 
 # Prompt file paths
 # LLMバックエンドに応じてdefaultプロンプトを切り替え
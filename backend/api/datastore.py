@@ -1,25 +1,32 @@
-# DataStore: JSONベースの暫定ストレージ（Users, Conversations, Sessions）
+# DataStore: メモリ上のUsers, Conversations, Sessionsと永続化バックエンド（storage）の橋渡し
 
-import json
+import functools
+import heapq
 import logging
 import os
+import threading
 import uuid
+from contextlib import contextmanager, nullcontext
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Any
+from typing import Dict, Iterator, List, Optional, Any, Sequence, Set, Tuple
 
 from .models import (
 	ChatStatus, UserStatus, User, Conversation, 
-	Personal, BookData, RecommendationLogEntry, NfcUser
+	Personal, BookData, RecommendationLogEntry, NfcUser, SessionSummary
 )
 # LangChainベースのLLM関数を使用
 from . import summary_function
+# 永続化バックエンド（DATASTORE_BACKENDで切り替え）
+from .storage import Storage, SqliteStorage, WriteBehindStorage, PromptStore, ConversationArchive, RecommendationLog, TurnLog, SqliteLeases, create_storage
+from .locks import KeyedLock, LockTimeout
+from .history import ChatHistory
 
 # LangChain Messages
 from langchain_core.messages import (
 	BaseMessage, 
 	HumanMessage, 
 	AIMessage,
-	messages_to_dict, 
 	messages_from_dict
 )
 
@@ -27,159 +34,451 @@ from langchain_core.messages import (
 logger = logging.getLogger("uvicorn.error")
 
 # ファイルパス (DBへ移行するため, 一時的なもの. 本番はENVへまとめる)
-from backend import PROMPTS_DIR, DATA_DIR, USERS_FILE, CONVERSATIONS_FILE, NFC_USERS_FILE, PROMPT_SUMMARY, PROMPT_AI_INSIGHT, SESSION_TIMEOUT
+from backend import PROMPTS_DIR, DATA_DIR, PROMPT_SUMMARY, PROMPT_AI_INSIGHT, SESSION_TIMEOUT, WRITE_BEHIND_INTERVAL, HISTORY_CACHE_SIZE
+from backend import ARCHIVE_AFTER_DAYS, CONVERSATIONS_TTL_DAYS, RECOMMEND_LOG_TTL_DAYS, AI_INSIGHTS_TTL_DAYS
+from backend import MEMORY_MAX_IDLE_USERS, MEMORY_MAX_CLOSED_BODIES, DATASTORE_SHARED, TURN_LOG, SHARED_LASTLOGIN_INTERVAL
 
+# アーカイブ処理で一度に読み込む会話の件数
+_ARCHIVE_BATCH = 1000
+# ai_insightsの生成中に他の要約が書き換えた場合に作り直す回数の上限
+_INSIGHTS_ATTEMPTS = 3
+
+
+# ロックの順序: ユーザーのロック → セッションのロック → 状態ロック（_state_lock）
+# 状態ロックを持ったままユーザー・セッションのロックを待ってはいけない（デッドロック防止）
+def _synchronized(method):
+	"""状態ロックを取ってから実行する（メモリ上のdictを読み書きするメソッド用）。"""
+	@functools.wraps(method)
+	def wrapper(self, *args, **kwargs):
+		with self._state_lock:
+			return method(self, *args, **kwargs)
+	return wrapper
+
+
+def _user_synchronized(method):
+	"""ユーザーのロック → 状態ロックの順に取ってから実行する（第1引数がuser_idのメソッド用）。"""
+	@functools.wraps(method)
+	def wrapper(self, user_id, *args, **kwargs):
+		with self.user_lock(user_id), self._state_lock:
+			return method(self, user_id, *args, **kwargs)
+	return wrapper
+
+
+def _session_synchronized(method):
+	"""セッションのロック → 状態ロックの順に取ってから実行する（第1引数がsession_idのメソッド用）。"""
+	@functools.wraps(method)
+	def wrapper(self, session_id, *args, **kwargs):
+		with self.session_lock(session_id), self._state_lock:
+			return method(self, session_id, *args, **kwargs)
+	return wrapper
 
 
 class DataStore:
-	def __init__(self):
+	"""
+	スレッドセーフ: メモリ上のdict（users, conversations, sessions など）は状態ロックで保護する。
+	状態ロックはメモリ上の短い操作の間だけ持ち、LLM呼び出しのような長い処理は
+	user_lock() / session_lock() で同じユーザー・セッションの処理だけを直列化する。
+	永続化はwrite-behindの書き出しスレッド（無効な場合は状態ロック下の呼び出し）の1か所から行う。
+
+	複数ワーカー構成（shared=True, DATASTORE_SHARED）: SQLiteのDBファイルを複数のプロセスで共有する。
+	- user_lock() / session_lock() はSQLiteのリースで他のワーカーとも排他し、
+	  取得した時点でメモリ上のコピーを捨ててstorageから読み直す
+	- 変更はwrite-behindを使わずに即座にstorageへ書き込む（他のワーカーから見えるように）
+
+	ターンログ（TURN_LOG）: アクティブな会話は close/pause までstorageに保存しないため、
+	update_history のたびに追記分だけを TurnLog に書き、起動時にそこから復元する。
+	複数ワーカー構成では履歴を毎回storageへ書き込むため使わない。
+	"""
+	def __init__(
+		self,
+		storage: Optional[Storage] = None,
+		archive: Optional[ConversationArchive] = None,
+		shared: Optional[bool] = None,
+		recommend_log: Optional[RecommendationLog] = None,
+		turn_log: Optional[TurnLog] = None
+	):
 		DATA_DIR.mkdir(exist_ok=True)
+		if shared is None:
+			shared = DATASTORE_SHARED
+		# 永続化バックエンド（省略時は DATASTORE_BACKEND の設定に従う）
+		if storage is None:
+			storage = create_storage()
+			# 書き込みはバックグラウンドでまとめて行う（WRITE_BEHIND_INTERVAL=0で無効）
+			# 複数ワーカー構成では他のワーカーから見えるよう即座に書き込む
+			if WRITE_BEHIND_INTERVAL > 0 and not shared:
+				storage = WriteBehindStorage(storage)
+		self.storage = storage
+		# 複数ワーカー構成のワーカー間ロック
+		self.shared = shared
+		self.leases: Optional[SqliteLeases] = None
+		if shared:
+			if not isinstance(storage, SqliteStorage):
+				raise ValueError(
+					f"DATASTORE_SHARED requires the sqlite backend (got '{storage.name}')\n"
+					f"Hint: set DATASTORE_BACKEND=sqlite"
+				)
+			self.leases = SqliteLeases(storage.db_file)
+		if self.storage.deferred:
+			# 書き出し時にアクティブな会話のメモリ上の履歴をmessagesへ詰める
+			self.storage.prepare_conversation = self._snapshot_conversation
+		# 古いclosedの会話の移動先（読み取り専用で参照する）
+		if archive is None:
+			archive = ConversationArchive(getattr(self.storage, "data_dir", None) or DATA_DIR)
+		self.archive = archive
+		# 推薦ログ（ユーザーには埋め込まず、追記専用のファイルに保存する）
+		if recommend_log is None:
+			recommend_log = RecommendationLog(getattr(self.storage, "data_dir", None) or DATA_DIR)
+		self.recommend_log = recommend_log
+		# アクティブな会話のターンごとの追記ログ
+		if turn_log is None and TURN_LOG and not shared:
+			turn_log = TurnLog(getattr(self.storage, "data_dir", None) or DATA_DIR)
+		self.turn_log = turn_log
+		# 会話履歴が参照するシステムプロンプト（storageに保存し、全ワーカーから読めるようにする）
+		self.prompts = PromptStore(storage=self.storage)
+		# ターンログに書き込み済みの履歴と件数（session_id → (ChatHistory, 件数)）
+		self._turn_logged: Dict[str, Tuple[ChatHistory, int]] = {}
 		# メモリ上のデータ（最小限）
 		self.users: Dict[str, User] = {}  # pauseセッションのユーザーのみ
 		self.conversations: Dict[str, Conversation] = {}  # pauseのみ
-		# sessions は Gemini とやり取りする「history」をそのまま保持する辞書（メモリ上）
-		self.sessions: Dict[str, List[BaseMessage]] = {}
+		# sessions は Gemini とやり取りする「history」を保持する辞書（メモリ上）
+		# LangChainのメッセージではなく ChatHistory（役割タグ + 本文）でコンパクトに持つ
+		self.sessions: Dict[str, ChatHistory] = {}
+		# 履歴をまだ sessions に戻していないpause（起動時はactiveも）の会話。最初にアクセスされた時に戻す
+		self._unrestored: Set[str] = set()
 		# NFC認証用の辞書（全件）
 		self.nfc_users: Dict[str, NfcUser] = {}
+		# NFCの逆引き（user_id → nfc_id）。nfc_usersと常に同期させる
+		self.nfc_by_user: Dict[str, str] = {}
+		# ユーザーごとのアクティブセッション（user_id → session_id の集合）
+		self.active_sessions: Dict[str, Set[str]] = {}
+		# ユーザーごとの会話一覧（user_id → {session_id: SessionSummary}）
+		# list_sessions で要求されたユーザーについてだけ作り、以降は会話の変更に合わせて更新する
+		self._session_index: Dict[str, Dict[str, SessionSummary]] = {}
+		# タイムアウト監視: (期限, user_id) の最小ヒープと、登録済みのuser_id
+		self._timeout_heap: List[Tuple[datetime, str]] = []
+		self._timeout_scheduled: Set[str] = set()
+		# 過去（pause/closed）の会話の変換済み履歴（LRU, session_id → List[BaseMessage]）
+		self._history_cache: "OrderedDict[str, List[BaseMessage]]" = OrderedDict()
+		# 排他制御（順序は _synchronized の上のコメントを参照）
+		self._state_lock = threading.RLock()
+		self._user_locks = KeyedLock()
+		self._session_locks = KeyedLock()
+		# メモリ上限: logoutユーザーとclosedの会話本文をLRUで追い出す
+		self._idle_users: "OrderedDict[str, None]" = OrderedDict()  # logoutユーザー（古い順）
+		self._closed_bodies: "OrderedDict[str, None]" = OrderedDict()  # 本文を持つclosedの会話（古い順）
+		self._evicted_bodies: Set[str] = set()  # 本文を外した（メタデータのみの）会話
+		self._memory_counters = {"users_evicted": 0, "bodies_evicted": 0, "bodies_reloaded": 0}
 		# pauseセッションとそのユーザーを復元
 		self._restore_paused_sessions()
 
 	def _restore_paused_sessions(self):
 		"""
-		すべてのconversationsをメモリに読み込み、pauseセッションをactiveに戻す。
-		last_accessedとlastloginを現在時刻に更新。
+		storageから読み込み、pause（と保存されたままのactive）の会話を復元対象として登録する。
+		履歴（ChatHistory）は起動時には作らず、chat・get_history・resume_session で
+		最初にアクセスされた時に _restore_session で作る（起動時間がpauseの会話の数によらない）。
 		そのユーザーも読み込む。
 		"""
-		if USERS_FILE.exists():
-			with open(USERS_FILE, "r", encoding="utf-8") as f:
-				try:
-					users_data = json.load(f)
-					for user_dict in users_data:
-						user = User(**user_dict)
-						self.users[user.user_id] = user
-				except Exception:
-					self.users = {}
-
-		if CONVERSATIONS_FILE.exists():
-			with open(CONVERSATIONS_FILE, "r", encoding="utf-8") as f:
-				try:
-					convs_data = json.load(f)
-					for conv_dict in convs_data.values():
-						conv = Conversation(**conv_dict)
-						self.conversations[conv.session_id] = conv
-				except Exception:
-					self.conversations = {}
+		# users, conversations, nfc_users をstorageから読み込み
+		self.users, self.conversations, self.nfc_users = self.storage.load()
+		self.nfc_by_user = {nfc_user.user_id: nfc_id for nfc_id, nfc_user in self.nfc_users.items()}
+		if self.turn_log is not None:
+			self._recover_turns()
+		for conv in self.conversations.values():
+			self._index_session(conv)
+			self._track_body(conv)
+		for user in list(self.users.values()):
+			if self._migrate_recommend_log(user):
+				self.storage.put_user(user)
+			self._schedule_timeout(user)
+			self._track_user(user)
 
 		# in-memoryセッションを初期化
 		self.sessions = {}
 		
-		# pause状態のセッションを復元
-		restored_count = 0
-		for session_id, conv in self.conversations.items():
-			if conv.status == ChatStatus.pause:
-				# messagesをin-memoryセッションに復元 (dict -> BaseMessage list)
+		# pause状態のセッションを復元対象にする
+		# activeのまま保存されている会話（write-behindで途中まで保存された後に異常終了したもの）も同様に復元する
+		self._unrestored = {
+			session_id for session_id, conv in self.conversations.items()
+			if conv.status in (ChatStatus.pause, ChatStatus.active)
+		}
+		if self._unrestored:
+			logger.info(f"[SUCCESS] {len(self._unrestored)} paused session(s) will be restored on first access")
+
+	def _restore_session(self, session_id: str) -> Optional[ChatHistory]:
+		"""
+		メモリ上の履歴を返す。復元していないpauseの会話であれば、保存済みのmessagesから ChatHistory を作る。
+		どちらでもなければNone。
+		"""
+		history = self.sessions.get(session_id)
+		if history is not None or session_id not in self._unrestored:
+			return history
+		self._unrestored.discard(session_id)
+		conv = self.conversations.get(session_id)
+		if conv is None:
+			return None
+		# messagesをin-memoryセッションに復元 (dict -> ChatHistory)
+		try:
+			# [{"type": "human", "data": {...}}] 形式を期待する
+			# 互換性なし設定のため、パース失敗時は空で初期化（既存データ破棄）
+			history = ChatHistory.from_dicts(conv.messages)
+		except Exception as e:
+			logger.warning(f"[WARNING] Failed to restore session {session_id} due to format mismatch: {e}")
+			history = ChatHistory()
+		self.sessions[session_id] = history
+		# 保存済みの履歴なので、次のターンからは追記分だけをターンログに書く
+		self._turn_logged[session_id] = (history, len(history))
+		logger.info(f"[INFO] Session restored: {session_id}")
+		return history
+
+	def _recover_turns(self) -> None:
+		"""
+		ターンログから、保存されないまま終了したアクティブな会話の履歴を復元してstorageへ保存する。
+		保存済みのmessagesに各ターンの追記分を順に重ね（start 番目以降を置き換える）、
+		storageにない会話（作成後に一度も保存されていない会話）はユーザーの active_session も戻す。
+		すべて保存し終えたらターンログを空にする。
+		"""
+		turns = self.turn_log.replay()
+		recovered = 0
+		for session_id, (user_id, entries) in turns.items():
+			conv = self.conversations.get(session_id)
+			if conv is None:
 				try:
-					# 既存の messages (List[dict]) を LangChain Objects に変換
-					# messages_from_dict は [{"type": "human", ...}] 形式を期待する
-					# 互換性なし設定のため、パース失敗時は空リストまたはエラー
-					if conv.messages:
-						self.sessions[session_id] = messages_from_dict(conv.messages)
-					else:
-						self.sessions[session_id] = []
-					restored_count += 1
+					conv = self.storage.get_conversation(session_id)
 				except Exception as e:
-					logger.warning(f"[WARNING] Failed to restore session {session_id} due to format mismatch: {e}")
-					# フォーマット不整合時は空で初期化（既存データ破棄）
-					self.sessions[session_id] = []
-		
-		if restored_count > 0:
-			logger.info(f"[SUCCESS] Restored {restored_count} paused session(s)")
-		
-		# nfc_users.jsonの読み込み
-		if NFC_USERS_FILE.exists():
-			with open(NFC_USERS_FILE, "r", encoding="utf-8") as f:
-				try:
-					nfc_data = json.load(f)
-					for nfc_dict in nfc_data:
-						nfc_user = NfcUser(**nfc_dict)
-						self.nfc_users[nfc_user.nfc_id] = nfc_user
-				except Exception:
-					self.nfc_users = {}
+					logger.warning(f"[WARNING] Failed to load conversation {session_id} for turn log recovery: {e}")
+					continue
+			created = conv is None
+			if created:
+				if not user_id:
+					continue
+				conv = Conversation(**{"_id": session_id, "user_id": user_id, "messages": []})
+			elif conv.status == ChatStatus.closed:
+				# close済み（storageの方が新しい）
+				continue
+			messages = list(conv.messages)
+			for start, added in entries:
+				if start > len(messages):
+					logger.warning(f"[WARNING] Turn log of {session_id} has a gap at message {start}, recovered up to {len(messages)}")
+					break
+				messages[start:] = added
+			if not created and messages == conv.messages:
+				continue
+			conv.messages = messages
+			conv.last_accessed = datetime.now()
+			self.conversations[session_id] = conv
+			self.storage.put_conversation(conv)
+			if created:
+				user = self._load_user(user_id)
+				if user is not None and user.active_session != session_id:
+					if user.active_session and user.active_session not in user.old_session:
+						user.old_session.append(user.active_session)
+					user.active_session = session_id
+					user.status = UserStatus.chatting
+					self.storage.put_user(user)
+			recovered += 1
+		if turns:
+			# 復元した会話が永続化されてからログを空にする
+			self.storage.sync()
+			self.turn_log.reset()
+		if recovered > 0:
+			logger.info(f"[SUCCESS] Recovered {recovered} session(s) from the turn log")
+
+	@contextmanager
+	def user_lock(self, user_id: str) -> Iterator[None]:
+		"""
+		同じユーザーに対する一連の処理（読み込み → LLM呼び出し → 書き込み）を直列化する。
+		複数ワーカー構成では他のワーカーとも排他し、取得時にメモリ上のユーザーを読み直させる。
+		"""
+		with self._user_locks.hold(user_id):
+			if self.leases is None:
+				yield
+				return
+			with self.leases.hold(f"user:{user_id}") as acquired:
+				if acquired:
+					with self._state_lock:
+						self._forget_user(user_id)
+				yield
+
+	@contextmanager
+	def session_lock(self, session_id: str) -> Iterator[None]:
+		"""
+		同じセッションに対する一連の処理（履歴の取得 → LLM呼び出し → 履歴の更新）を直列化する。
+		複数ワーカー構成では他のワーカーとも排他し（待ちきれなければ LockTimeout）、
+		取得時にメモリ上の会話と履歴を読み直させる。
+		"""
+		with self._session_locks.hold(session_id):
+			if self.leases is None:
+				yield
+				return
+			with self.leases.hold(f"session:{session_id}") as acquired:
+				if acquired:
+					with self._state_lock:
+						self._forget_session(session_id)
+				yield
 
+	def _forget_user(self, user_id: str) -> None:
+		"""メモリ上のユーザーを捨てる（次のアクセスでstorageから読み直す）。"""
+		self.users.pop(user_id, None)
+		self._idle_users.pop(user_id, None)
+		self._session_index.pop(user_id, None)
+
+	def _forget_session(self, session_id: str) -> None:
+		"""メモリ上の会話と履歴を捨てる（次のアクセスでstorageから読み直す）。"""
+		conv = self.conversations.pop(session_id, None)
+		self.sessions.pop(session_id, None)
+		self._unrestored.discard(session_id)
+		self._turn_logged.pop(session_id, None)
+		self._history_cache.pop(session_id, None)
+		self._closed_bodies.pop(session_id, None)
+		self._evicted_bodies.discard(session_id)
+		if conv is not None:
+			sessions = self.active_sessions.get(conv.user_id)
+			if sessions is not None:
+				sessions.discard(session_id)
+				if not sessions:
+					del self.active_sessions[conv.user_id]
+
+	@_synchronized
 	def save_file(self):
 		"""
-		users と conversations を永続化する。
+		users, conversations, nfc_users をまとめて永続化する（スナップショット）。
 		sessions はメモリ上のみで管理し、pause/close時に conversations に保存される。
+		通常の更新は変更したレコードだけを storage.put_* で保存するため、
+		ここを呼ぶのはシャットダウン時など全件を書き出したい場合に限る。
 		"""
-		with open(USERS_FILE, 'w', encoding='utf-8') as f:
-			json.dump([v.model_dump(by_alias=True) for v in self.users.values()], f, indent=2, default=str, ensure_ascii=False)
-		
-		with open(CONVERSATIONS_FILE, 'w', encoding='utf-8') as f:
-			json.dump({k: v.model_dump(by_alias=True) for k, v in self.conversations.items()}, f, indent=2, default=str, ensure_ascii=False)
-		
-		# nfc_users.jsonへの保存
-		with open(NFC_USERS_FILE, 'w', encoding='utf-8') as f:
-			json.dump([v.model_dump(by_alias=True) for v in self.nfc_users.values()], f, indent=2, default=str, ensure_ascii=False)
+		self.storage.save_all(self.users, self.conversations, self.nfc_users)
+
+	def close(self) -> None:
+		"""
+		storageのファイルハンドル等を解放する（サーバー終了時）。
+		write-behindの場合は未書き出しの変更をすべて書き出してから閉じる。
+		"""
+		self.storage.close()
+		if self.turn_log is not None:
+			self.turn_log.close()
+		if self.leases is not None:
+			self.leases.close()
 
+	@_synchronized
+	def _snapshot_conversation(self, conv: Conversation) -> Conversation:
+		"""
+		アクティブな会話について、メモリ上の履歴をmessagesに詰めたコピーを返す（write-behindの書き出し用）。
+		pause/closedの会話は close/pause 時に messages が確定しているのでそのまま返す。
+		"""
+		history = self.sessions.get(conv.session_id)
+		if conv.status != ChatStatus.active or history is None:
+			return conv
+		return conv.model_copy(update={"messages": history.to_dicts()})
+
+	@_synchronized
 	def create_user(self, user_id: str, personal: Personal) -> User:
-		if user_id not in self.users:
+		if self._load_user(user_id) is None:
 			self.users[user_id] = User(**{
 				"_id": user_id, 
 				"lastlogin": datetime.now(), 
 				"personal": personal,
 				"status": UserStatus.activate
 			})
+			self.storage.put_user(self.users[user_id])
+			self._schedule_timeout(self.users[user_id])
 		return self.users[user_id]
 
 
+	def _load_user(self, user_id: str) -> Optional[User]:
+		"""
+		ユーザーをメモリ → storage の順に探す（lastloginは更新しない）。
+		storageはインデックスから該当ユーザー1件だけを読み込むため、
+		ミス時もファイル全体の読み込みや書き込みは発生しない。
+		"""
+		user = self.users.get(user_id)
+		if user is not None:
+			self._track_user(user)
+			return user
+
+		try:
+			user = self.storage.get_user(user_id)
+		except Exception as e:
+			logger.error(f"[ERROR] Failed to load user from storage: {e}")
+			return None
+		if user is not None:
+			self.users[user_id] = user
+			logger.info(f"[INFO] Loaded user from storage: {user_id}")
+			migrated = self._migrate_recommend_log(user)
+			if self._apply_user_ttl(user, datetime.now()) or migrated:
+				self.storage.put_user(user)
+			self._track_user(user)
+		return user
+
+	def _migrate_recommend_log(self, user: User) -> bool:
+		"""
+		ユーザーに埋め込まれた推薦ログ（旧形式）を RecommendationLog へ移す。
+		移した場合はTrueを返す（保存は呼び出し側で行う）。
+		"""
+		if not user.recommend_log:
+			return False
+		self.recommend_log.append(user.user_id, sorted(user.recommend_log, key=lambda entry: entry.timestamp))
+		logger.info(f"[INFO] Moved {len(user.recommend_log)} recommendation(s) of {user.user_id} to the recommendation log")
+		user.recommend_log = []
+		return True
+
+	def _apply_user_ttl(self, user: User, now: datetime) -> bool:
+		"""
+		AI_INSIGHTS_TTL_DAYS を過ぎたデータをユーザーから取り除く（推薦ログのTTLは RecommendationLog.expire）。
+		変更があればTrueを返す（保存は呼び出し側で行う）。
+		"""
+		changed = False
+		if AI_INSIGHTS_TTL_DAYS is not None and user.ai_insights:
+			# 最後のログインから期間が空いたユーザーの分析結果は破棄する
+			if user.lastlogin < now - timedelta(days=AI_INSIGHTS_TTL_DAYS):
+				user.ai_insights = ""
+				changed = True
+		return changed
+
 	def get_user(self, user_id: str) -> User:
 		"""
 		ユーザーデータを取得する（遅延読み込み）。
 		既にメモリにある場合はそのまま返す。
-		ない場合はディスクから読み込む。
+		ない場合はstorageから1件だけ読み込む。
+		lastloginはメモリ上でのみ更新する（次にユーザーを保存する時に永続化される）。
+
+		複数ワーカー構成では毎回storageから読み直す。lastloginは他のワーカーのタイムアウト判定に
+		使われるため保存するが、SHARED_LASTLOGIN_INTERVAL 秒に1回までとし、保存しない読み込みでは
+		リースを取らない（他のワーカーが処理中のユーザーでも待たされない）。
 		"""
-		if user_id in self.users:
-			# lastloginを更新
-			self.users[user_id].lastlogin = datetime.now()
-			return self.users[user_id]
-		
-		# ディスクから読み込み
-		if USERS_FILE.exists():
-			with open(USERS_FILE, "r", encoding="utf-8") as f:
-				try:
-					users_data = json.load(f)
-					# リスト形式からdict形式に変換
-					all_users = {}
-					for user_dict in users_data:
-						uid = user_dict.get("_id")
-						if uid:
-							all_users[uid] = user_dict
-					
-					if user_id in all_users:
-						user_data = all_users[user_id]
-						user = User(**user_data)
-						# lastloginを更新
-						user.lastlogin = datetime.now()
-						self.users[user_id] = user
-						logger.info(f"[INFO] Loaded user from disk: {user_id}")
-						# 更新を保存
-						self.save_file()
+		if self.shared:
+			with self._user_locks.hold(user_id), self._state_lock:
+				# user_lock() の中からの呼び出し（リースを持っている）はメモリ上のユーザーをそのまま使う
+				if not self.leases.held(f"user:{user_id}"):
+					self._forget_user(user_id)
+					user = self._load_user(user_id)
+					if user is None:
+						return None
+					now = datetime.now()
+					if now - user.lastlogin < timedelta(seconds=SHARED_LASTLOGIN_INTERVAL):
+						user.lastlogin = now
+						self._schedule_timeout(user)
 						return user
-				except Exception as e:
-					logger.error(f"[ERROR] Failed to load user from disk: {e}")
-		
-		return None
+		with self.user_lock(user_id), self._state_lock:
+			user = self._load_user(user_id)
+			if user is not None:
+				# lastloginを更新
+				user.lastlogin = datetime.now()
+				self._schedule_timeout(user)
+				if self.shared:
+					self.storage.put_user(user)
+			return user
 
 
+	@_user_synchronized
 	def update_user(self, user_id: str, **kwargs) -> User:
 		"""
 		ユーザー情報を更新する。
 		ai_insights, status, personal などのフィールドを更新可能。
 		"""
-		if user_id not in self.users:
+		user = self._load_user(user_id)
+		if user is None:
 			raise KeyError(f"User not found: {user_id}")
 		
-		user = self.users[user_id]
 		for key, value in kwargs.items():
 			if hasattr(user, key):
 				# personalフィールドの場合はPersonalモデルに変換してから代入
@@ -196,20 +495,32 @@ class DataStore:
 				raise ValueError(f"Invalid field: {key}")
 		
 		# 変更を保存
-		self.save_file()
+		self.storage.put_user(user)
+		self._schedule_timeout(user)
+		self._track_user(user)
 		
 		return user
 
+	@_user_synchronized
 	def add_recommendation(self, user_id: str, book_data: BookData, reason: str) -> None:
 		"""
 		ユーザーの推薦ログに新しい書籍推薦を追加する。
+		ログはユーザーとは別に追記されるため、ユーザーの保存は発生しない。
 		"""
-		if user_id not in self.users:
+		user = self._load_user(user_id)
+		if user is None:
 			raise KeyError(f"User not found: {user_id}")
 		
-		user = self.users[user_id]
 		entry = RecommendationLogEntry(book_data=book_data, reason=reason)
-		user.recommend_log.append(entry)
+		self.recommend_log.append(user_id, [entry])
+
+	def get_recommendations(self, user_id: str) -> List[RecommendationLogEntry]:
+		"""ユーザーの推薦ログ（古い順、RECOMMEND_LOG_MAX_PER_USER 件まで）を返す。"""
+		return self.recommend_log.entries(user_id)
+
+	def has_recommended(self, user_id: str, isbn: str) -> bool:
+		"""そのユーザーにこの本を推薦済みか（O(1)）。"""
+		return self.recommend_log.has_recommended(user_id, isbn)
 	
 	# NFC authentication
 	def register_nfc(self, nfc_id: str, user_id: str) -> NfcUser:
@@ -217,9 +528,14 @@ class DataStore:
 		NFC IDとユーザーIDを紐付ける。
 		1ユーザーにつき1枚のみ登録可能（既存の登録があれば削除）。
 		"""
+		with self.user_lock(user_id), self._state_lock:
+			return self._register_nfc(nfc_id, user_id)
+
+	def _register_nfc(self, nfc_id: str, user_id: str) -> NfcUser:
 		# ユーザーが存在するか確認（ディスクからのロード含む）
 		if not self.get_user(user_id):
 			raise KeyError(f"User not found: {user_id}")
+		self._refresh_nfc(nfc_id=nfc_id, user_id=user_id)
 		
 		# 既存の登録を確認し、削除 (1ユーザー1カード制)
 		old_nfc_id = self.get_nfc_by_user_id(user_id)
@@ -227,38 +543,80 @@ class DataStore:
 			self.unregister_nfc(old_nfc_id)
 			logger.info(f"[INFO] Removed old NFC card {old_nfc_id} for user {user_id}")
 		
+		# 同じカードが別ユーザーに登録されていた場合はその逆引きを外す
+		previous = self.nfc_users.get(nfc_id)
+		if previous and self.nfc_by_user.get(previous.user_id) == nfc_id:
+			del self.nfc_by_user[previous.user_id]
+		
 		nfc_user = NfcUser(**{"_id": nfc_id, "user_id": user_id})
 		self.nfc_users[nfc_id] = nfc_user
-		self.save_file()
+		self.nfc_by_user[user_id] = nfc_id
+		self.storage.put_nfc_user(nfc_user)
 		return nfc_user
 	
+	@_synchronized
 	def get_user_by_nfc(self, nfc_id: str) -> Optional[str]:
 		"""
 		NFC IDからユーザーIDを取得する。
 		"""
+		self._refresh_nfc(nfc_id=nfc_id)
 		nfc_user = self.nfc_users.get(nfc_id)
 		if nfc_user:
 			return nfc_user.user_id
 		return None
 	
+	@_synchronized
 	def get_nfc_by_user_id(self, user_id: str) -> Optional[str]:
 		"""
 		ユーザーIDからNFC IDを取得する (逆引き)。
 		"""
-		for nfc_user in self.nfc_users.values():
-			if nfc_user.user_id == user_id:
-				return nfc_user.nfc_id
-		return None
+		self._refresh_nfc(user_id=user_id)
+		return self.nfc_by_user.get(user_id)
 	
+	@_synchronized
 	def unregister_nfc(self, nfc_id: str) -> None:
 		"""
 		NFC IDの登録を解除する。
 		"""
-		if nfc_id in self.nfc_users:
-			del self.nfc_users[nfc_id]
-			self.save_file()
+		self._refresh_nfc(nfc_id=nfc_id)
+		nfc_user = self.nfc_users.pop(nfc_id, None)
+		if nfc_user is not None:
+			if self.nfc_by_user.get(nfc_user.user_id) == nfc_id:
+				del self.nfc_by_user[nfc_user.user_id]
+			self.storage.delete_nfc_user(nfc_id)
+
+	def _refresh_nfc(self, nfc_id: Optional[str] = None, user_id: Optional[str] = None) -> None:
+		"""
+		複数ワーカー構成の場合、他のワーカーの登録・解除を反映するため、
+		指定したNFC ID・ユーザーの紐付けをstorageから読み直す（nfc_users と nfc_by_user を同期させたまま）。
+		"""
+		if not self.shared:
+			return
+		nfc_ids = set()
+		if nfc_id is not None:
+			nfc_ids.add(nfc_id)
+		if user_id is not None:
+			stale = self.nfc_by_user.pop(user_id, None)
+			if stale is not None:
+				nfc_ids.add(stale)
+			current = self.storage.get_nfc_id_by_user(user_id)
+			if current is not None:
+				nfc_ids.add(current)
+		for key in nfc_ids:
+			old = self.nfc_users.pop(key, None)
+			if old is not None and self.nfc_by_user.get(old.user_id) == key:
+				del self.nfc_by_user[old.user_id]
+			nfc_user = self.storage.get_nfc_user(key)
+			if nfc_user is None:
+				continue
+			previous = self.nfc_by_user.get(nfc_user.user_id)
+			if previous is not None and previous != key:
+				self.nfc_users.pop(previous, None)
+			self.nfc_users[key] = nfc_user
+			self.nfc_by_user[nfc_user.user_id] = key
 
 	# Session management (for chat runtime history)
+	@_user_synchronized
 	def create_session(self, user_id: str) -> str:
 		"""
 		新しいセッションをメモリ上に作成する。ユーザーIDが与えられれば
@@ -273,7 +631,7 @@ class DataStore:
 		session_id = str(uuid.uuid4())
 		conv = Conversation(**{"_id": session_id, "user_id": user_id, "messages": []})
 		self.conversations[session_id] = conv
-		self.sessions[session_id] = []  # history kept as List[BaseMessage]
+		self.sessions[session_id] = ChatHistory()
 		# In-memory update of user's active_session
 		user = self.users[user_id]
 		if user.active_session:
@@ -283,14 +641,53 @@ class DataStore:
 		user.active_session = session_id
 		user.lastlogin = datetime.now()
 		user.status = UserStatus.chatting  # セッション開始時にステータスを chatting に変更
+		self._idle_users.pop(user_id, None)
+		self._index_session(conv)
+		self._schedule_timeout(user)
 		# note: do NOT call self.save_file() here to avoid frequent disk writes
+		# （write-behindの場合は次回の書き出しにまとめられるので記録しておく。複数ワーカー構成では即座に書き込む）
+		if self.storage.deferred or self.shared:
+			self.storage.put_conversation(conv)
+			self.storage.put_user(user)
 		return session_id
 
+	def _get_conversation(self, session_id: str) -> Optional[Conversation]:
+		"""
+		Conversationを取得する（遅延読み込み）。
+		メモリにない場合は storage から1件だけ読み込んでメモリに載せる。
+		"""
+		conv = self.conversations.get(session_id)
+		if conv is not None and session_id in self._evicted_bodies:
+			# 本文を追い出した会話はstorageから読み直す
+			self._evicted_bodies.discard(session_id)
+			reloaded = self.storage.get_conversation(session_id) if conv.status == ChatStatus.closed else None
+			if reloaded is not None:
+				conv = self.conversations[session_id] = reloaded
+				self._memory_counters["bodies_reloaded"] += 1
+		if conv is None:
+			conv = self.storage.get_conversation(session_id)
+			if conv is not None:
+				self.conversations[session_id] = conv
+				self._index_session(conv)
+				# 他のワーカーが処理していたアクティブな会話（複数ワーカー構成）は履歴もメモリへ戻す
+				if conv.status != ChatStatus.closed and session_id not in self.sessions:
+					try:
+						self.sessions[session_id] = ChatHistory.from_dicts(conv.messages)
+					except Exception:
+						self.sessions[session_id] = ChatHistory()
+			else:
+				# アーカイブ済みの会話（読み取り専用なのでメモリには載せない）
+				conv = self.archive.get(session_id)
+				return conv
+		self._track_body(conv)
+		return conv
+
+	@_synchronized
 	def has_session(self, session_id: str) -> bool:
 		"""
 		セッションの存在確認（アクティブ・過去両方をチェック）
 		"""
-		return session_id in self.sessions or session_id in self.conversations
+		return session_id in self.sessions or self._get_conversation(session_id) is not None
 
 	def has_user_session(self, user_id: str, session_id: str) -> bool:
 		user = self.get_user(user_id)
@@ -298,28 +695,90 @@ class DataStore:
 			return False
 		return session_id == user.active_session or session_id in user.old_session
 
-	def get_history(self, session_id: str) -> List[BaseMessage]:
-		# アクティブセッション（メモリ上）をチェック
-		if session_id in self.sessions:
-			return self.sessions.get(session_id, [])
+	@_synchronized
+	def get_history(self, session_id: str) -> Sequence[BaseMessage]:
+		"""
+		会話履歴を返す。
+		アクティブなセッションはメモリ上の ChatHistory そのもの（要素を取り出した時にLangChainのメッセージになる）、
+		過去のセッションは List[BaseMessage] のコピー。
+		"""
+		# アクティブセッション（メモリ上・復元していないpause）をチェック
+		history = self._restore_session(session_id)
+		if history is not None:
+			return history
 		# 過去のセッション（永続化済み）をチェック
-		elif session_id in self.conversations:
+		cached = self._history_cache.get(session_id)
+		if cached is not None:
+			self._history_cache.move_to_end(session_id)
+			return list(cached)
+		conv = self._get_conversation(session_id)
+		if session_id in self.sessions:
+			# storageから読み直したアクティブな会話（複数ワーカー構成）
+			return self.sessions[session_id]
+		if conv is not None:
 			# Dict -> BaseMessage 変換して返す (read-only用途が多いが念のため)
-			messages_dict = self.conversations.get(session_id).messages
+			messages_dict = conv.messages
 			if messages_dict:
 				try:
-					return messages_from_dict(messages_dict)
+					history = messages_from_dict(messages_dict)
 				except Exception:
 					return []
+				self._cache_history(session_id, history)
+				return list(history)
 			return []
-		else:
-			return []
+		return []
+
+	@_synchronized
+	def get_history_dicts(self, session_id: str) -> List[dict]:
+		"""
+		履歴を messages_to_dict 形式で返す（API応答用）。
+		永続化済みの会話は保存されている messages をそのまま返し、LangChainのオブジェクトを経由しない。
+		返すリストは読み取り専用として扱うこと。
+		"""
+		if session_id in self.sessions:
+			return self.sessions[session_id].to_dicts()
+		conv = self._get_conversation(session_id)
+		if conv is not None:
+			return conv.messages
+		return []
+
+	def _cache_history(self, session_id: str, history: List[BaseMessage]) -> None:
+		if HISTORY_CACHE_SIZE <= 0:
+			return
+		self._history_cache[session_id] = history
+		self._history_cache.move_to_end(session_id)
+		while len(self._history_cache) > HISTORY_CACHE_SIZE:
+			self._history_cache.popitem(last=False)
+
+	def _log_turn(self, session_id: str, history: ChatHistory) -> None:
+		"""
+		前回ターンログに書いた後に追記されたメッセージだけをターンログへ書く。
+		別の履歴に置き換えられた場合（pauseからの再開など）は全体を書く。
+		"""
+		logged = self._turn_logged.get(session_id)
+		start = logged[1] if logged is not None and logged[0] is history and logged[1] <= len(history) else 0
+		if start == len(history) and start > 0:
+			return
+		conv = self.conversations.get(session_id)
+		self.turn_log.append(session_id, conv.user_id if conv is not None else "", start, history.to_dicts(start))
+		self._turn_logged[session_id] = (history, len(history))
 
-	def update_history(self, session_id: str, history: List[BaseMessage]) -> None:
+	@_session_synchronized
+	def update_history(self, session_id: str, history: Sequence[BaseMessage]) -> None:
 		"""
 		メモリ上の履歴を更新し、最終アクセス時刻を記録する。
+		ChatHistory 以外（List[BaseMessage] 等）を渡した場合は ChatHistory に詰め直す。
 		"""
+		if not isinstance(history, ChatHistory):
+			history = ChatHistory(history)
 		self.sessions[session_id] = history
+		self._unrestored.discard(session_id)
+		if self.turn_log is not None:
+			self._log_turn(session_id, history)
+		self._history_cache.pop(session_id, None)
+		# アクティブな会話は追い出し対象外（本文は history から作り直す）
+		self._closed_bodies.pop(session_id, None)
+		self._evicted_bodies.discard(session_id)
 		
 		# 最終アクセス時刻を更新し、ステータスをactiveにする
 		if session_id in self.conversations:
@@ -328,6 +787,16 @@ class DataStore:
 			# pauseから復帰した場合などを考慮してactiveにする
 			if conv.status != ChatStatus.active:
 				conv.status = ChatStatus.active
+				self._index_session(conv)
+			else:
+				self._summarize(conv)
+			# write-behindの場合のみ、アクティブな履歴も定期的に保存されるよう記録する
+			# （全件を書き直すバックエンドでは毎回の書き出しが重いため行わず、ターンログに任せる）
+			if self.storage.deferred and self.storage.incremental:
+				self.storage.put_conversation(conv)
+			elif self.shared:
+				# 複数ワーカー構成では次のターンを別のワーカーが処理できるよう、履歴ごと即座に保存する
+				self.storage.put_conversation(self._snapshot_conversation(conv))
 
 
 	def close_session(self, session_id: str) -> None:
@@ -337,29 +806,50 @@ class DataStore:
 		- Conversation.status を closed にする
 		- 該当ユーザーの active_session を解除し old_session に追加
 		- sessions の in-memory エントリを削除
-		- 最後に save_file() を呼んで disk に書き込む
+		- 最後に変更した conversation と user を storage に書き込む
 		
 		注: summary/ai_insightの生成は非同期処理で行うため、ここでは実行しない
 		"""
-		if session_id not in self.sessions and session_id not in self.conversations:
+		# ユーザーの状態も変更するため、ユーザー → セッションの順にロックを取る
+		with self._state_lock:
+			conv = self._get_conversation(session_id)
+			user_id = conv.user_id if conv is not None else ""
+		with self.user_lock(user_id) if user_id else nullcontext(), self.session_lock(session_id), self._state_lock:
+			self._close_session(session_id)
+
+	def _close_session(self, session_id: str) -> None:
+		conv = self._get_conversation(session_id)
+		if session_id not in self.sessions and conv is None:
 			raise KeyError("Session not found")
+		# 既にcloseされた会話（タイムアウトとログアウトが重なった場合など）は履歴を上書きしない
+		if session_id not in self.sessions and conv.status == ChatStatus.closed:
+			return
 
-		history = self.sessions.get(session_id, [])
-		# List[BaseMessage] -> List[dict] に変換して保存
-		messages = messages_to_dict(history)
+		history = self.sessions.get(session_id)
+		if history is not None:
+			# ChatHistory -> List[dict] に変換して保存
+			messages = history.to_dicts()
+		elif session_id in self._unrestored:
+			# 復元していないpauseの会話は保存済みのmessagesのまま
+			messages = conv.messages
+		else:
+			messages = []
+		self._unrestored.discard(session_id)
 
-		conv = self.conversations.get(session_id)
 		if not conv:
 			conv = Conversation(**{"_id": session_id, "user_id": "", "messages": []})
 
 		conv.messages = messages
 		conv.status = ChatStatus.closed
 		self.conversations[session_id] = conv
+		self._history_cache.pop(session_id, None)
+		self._index_session(conv)
 
 		# ユーザーの active_session を解除して old_session に追加
+		# （メモリから追い出されている・他のワーカーが読み込んだユーザーもstorageから読み込む）
 		user_id = conv.user_id
-		if user_id and user_id in self.users:
-			user = self.users[user_id]
+		user = self._load_user(user_id) if user_id else None
+		if user is not None:
 			if user.active_session == session_id:
 				user.active_session = None
 			if session_id not in user.old_session:
@@ -369,10 +859,22 @@ class DataStore:
 		# in-memory sessions を解放（必要なら残す）
 		if session_id in self.sessions:
 			del self.sessions[session_id]
+		self._discard_turns(session_id)
 
-		# 永続化（users, conversations, sessions）
-		self.save_file()
+		# 永続化（変更した conversation と user のみ）
+		self.storage.put_conversation(conv)
+		if user is not None:
+			self.storage.put_user(user)
+			self._track_user(user)
+		self._track_body(conv)
 
+	def _discard_turns(self, session_id: str) -> None:
+		"""履歴をstorageへ保存した会話のターンログを不要にする（次の compact で取り除く）。"""
+		self._turn_logged.pop(session_id, None)
+		if self.turn_log is not None:
+			self.turn_log.discard(session_id)
+
+	@_session_synchronized
 	def pause_session(self, session_id: str) -> None:
 		"""
 		アクティブセッションを一時停止して保存する。
@@ -382,9 +884,9 @@ class DataStore:
 		if session_id not in self.sessions:
 			return
 		
-		history = self.sessions.get(session_id, [])
-		# List[BaseMessage] -> List[dict] に変換して保存
-		messages = messages_to_dict(history)
+		history = self.sessions.get(session_id) or ChatHistory()
+		# ChatHistory -> List[dict] に変換して保存
+		messages = history.to_dicts()
 
 		conv = self.conversations.get(session_id)
 		if not conv:
@@ -393,13 +895,19 @@ class DataStore:
 		conv.messages = messages
 		conv.status = ChatStatus.pause  # pauseに設定
 		self.conversations[session_id] = conv
+		self._history_cache.pop(session_id, None)
+		self._index_session(conv)
 
-		# in-memory sessionsを解放
+		# in-memory sessionsを解放（次にアクセスされた時に復元する）
 		if session_id in self.sessions:
 			del self.sessions[session_id]
+		self._unrestored.add(session_id)
+		self._discard_turns(session_id)
 
-		# 永続化（users, conversations, sessions）
-		self.save_file()
+		# 永続化（変更した conversation と user のみ）
+		self.storage.put_conversation(conv)
+		if conv.user_id and conv.user_id in self.users and not self.shared:
+			self.storage.put_user(self.users[conv.user_id])
 		logger.info(f"[SUCCESS] Session paused: {session_id}")
 
 	def generate_summary_and_insights(self, session_id: str) -> None:
@@ -409,13 +917,13 @@ class DataStore:
 		"""
 		logger.info(f"[INFO] [BackgroundTask] Starting summary/ai_insights generation: session_id={session_id}")
 		try:
-			# セッションと履歴を取得
-			conv = self.conversations.get(session_id)
-			if not conv:
-				logger.warning(f"[WARNING] [BackgroundTask] Session not found: {session_id}")
-				return
-			
-			history = conv.messages
+			# セッションと履歴を取得（LLM呼び出し中はロックを持たない）
+			with self._state_lock:
+				conv = self._get_conversation(session_id)
+				if not conv:
+					logger.warning(f"[WARNING] [BackgroundTask] Session not found: {session_id}")
+					return
+				history = conv.messages
 			logger.info(f"[INFO] [BackgroundTask] History count: {len(history)}")
 			
 			# summaryを生成
@@ -425,8 +933,10 @@ class DataStore:
 					logger.info("[INFO] [BackgroundTask] Generating summary...")
 					# ユーザーの ai_insights を要約の文脈として渡す
 					user_insight = ""
-					if conv.user_id and conv.user_id in self.users:
-						user_insight = getattr(self.users[conv.user_id], "ai_insights", "") or ""
+					with self._state_lock:
+						owner = self._load_user(conv.user_id) if conv.user_id else None
+						if owner is not None:
+							user_insight = getattr(owner, "ai_insights", "") or ""
 					
 					# 会話履歴を文字列形式に変換
 					conversation_text = ""
@@ -448,8 +958,12 @@ class DataStore:
 					# summary_function を使って要約を生成（LangChainベース）
 					summary_text = summary_function(str(summary_path), conversation_text, ai_insight=user_insight)
 					if summary_text:
-						conv.summary = summary_text
-						self.conversations[session_id] = conv
+						with self._state_lock:
+							conv.summary = summary_text
+							self.conversations[session_id] = conv
+							self._evicted_bodies.discard(session_id)
+							self._summarize(conv)
+							self.storage.put_conversation(conv)
 						logger.info(f"[SUCCESS] [BackgroundTask] Summary generated: {len(summary_text)} characters")
 					else:
 						logger.warning(f"[WARNING] [BackgroundTask] Summary generation returned None")
@@ -459,18 +973,39 @@ class DataStore:
 				logger.error(f"[ERROR] [BackgroundTask] Summary generation failed: {e}", exc_info=True)
 
 			# ai_insightsを更新（summaryが生成されている場合）
-			user_id = conv.user_id
-			if user_id and user_id in self.users and conv.summary:
-				user = self.users[user_id]
-				try:
-					ai_insight_path = PROMPT_AI_INSIGHT
-					if ai_insight_path.exists():
-						logger.info("[INFO] [BackgroundTask] Updating ai_insights...")
-						# 既存の ai_insights を取得
-						existing_insights = user.ai_insights or ""
-						
-						# プロンプトメッセージを構築
-						message = f"""
+			# close後にメモリから追い出されていてもstorageから読み直す
+			if not conv.user_id:
+				return
+			self._update_insights(session_id, conv)
+		except Exception as e:
+			logger.error(f"[ERROR] [BackgroundTask] Error: {e}", exc_info=True)
+
+	def _update_insights(self, session_id: str, conv: Conversation) -> None:
+		"""
+		要約からユーザーのai_insightsを更新して保存する。
+		LLM呼び出しの間はユーザーのロックを持たない（同じユーザーのリクエストを待たせない）。
+		呼び出し前の ai_insights を控えておき、書き込む時に変わっていなければ新しい値を書く（compare-and-set）。
+		他の要約が先に書き換えていた場合は、その値を元に作り直す。
+		"""
+		user_id = conv.user_id
+		if not conv.summary:
+			return
+		ai_insight_path = PROMPT_AI_INSIGHT
+		if not ai_insight_path.exists():
+			logger.warning(f"[WARNING] [BackgroundTask] ai_insight.md not found: {ai_insight_path}")
+			return
+		for _ in range(_INSIGHTS_ATTEMPTS):
+			with self.user_lock(user_id), self._state_lock:
+				user = self._load_user(user_id)
+				if user is None:
+					return
+				# 既存の ai_insights を取得
+				existing_insights = user.ai_insights or ""
+			try:
+				logger.info("[INFO] [BackgroundTask] Updating ai_insights...")
+				
+				# プロンプトメッセージを構築
+				message = f"""
 **既存のAI Insights:**
 ```
 {existing_insights if existing_insights else "（なし）"}
@@ -481,83 +1016,402 @@ class DataStore:
 {conv.summary}
 ```
 """
-						# summary_function を使って新しい ai_insights を生成（LangChainベース）
-						user.ai_insights = summary_function(str(ai_insight_path), message, ai_insight=None)
-						logger.info(f"[SUCCESS] [BackgroundTask] ai_insights updated: {len(user.ai_insights)} characters")
-					else:
-						logger.warning(f"[WARNING] [BackgroundTask] ai_insight.md not found: {ai_insight_path}")
-				except Exception as e:
-					logger.error(f"[ERROR] [BackgroundTask] ai_insights update failed: {e}", exc_info=True)
-				
-				# 永続化
-				logger.info("[INFO] [BackgroundTask] Saving data...")
-				self.save_file()
-				logger.info(f"[SUCCESS] [BackgroundTask] Completed: session_id={session_id}")
-		except Exception as e:
-			logger.error(f"[ERROR] [BackgroundTask] Error: {e}", exc_info=True)
+				# summary_function を使って新しい ai_insights を生成（LangChainベース）
+				ai_insights = summary_function(str(ai_insight_path), message, ai_insight=None)
+			except Exception as e:
+				logger.error(f"[ERROR] [BackgroundTask] ai_insights update failed: {e}", exc_info=True)
+				return
+			
+			# 永続化（複数ワーカー構成ではリースを取り、他のワーカーの変更を上書きしないようstorageから読み直す）
+			with self.user_lock(user_id), self._state_lock:
+				# LLM呼び出し中にメモリから追い出された場合に備えて取り直す
+				user = self._load_user(user_id)
+				if user is None:
+					return
+				if (user.ai_insights or "") == existing_insights:
+					user.ai_insights = ai_insights
+					self.storage.put_user(user)
+					logger.info(f"[SUCCESS] [BackgroundTask] ai_insights updated: {len(ai_insights or '')} characters")
+					logger.info(f"[SUCCESS] [BackgroundTask] Completed: session_id={session_id}")
+					return
+			logger.info(f"[INFO] [BackgroundTask] ai_insights changed during generation, regenerating: {user_id}")
+		logger.warning(f"[WARNING] [BackgroundTask] ai_insights kept changing, gave up: session_id={session_id}")
 	
 	def check_user_timeout(self) -> List[str]:
 		"""
 		非アクティブなユーザーのセッションをcloseする。
 		lastloginを基準に判定（SESSION_TIMEOUT秒）。
 		タイムアウトしたセッションIDのリストを返す。
+
+		期限順のヒープから期限切れのユーザーだけを取り出すため、
+		1回のチェックで触れるのは実際にタイムアウトしたユーザーとそのセッションのみ。
+		summary/ai_insightの生成はここでは行わない（呼び出し側で非同期に実行する）。
 		"""
-		timeout_threshold = datetime.now() - timedelta(seconds=SESSION_TIMEOUT)
+		now = datetime.now()
+		# 期限切れのユーザーとそのアクティブセッションを取り出す
+		expired: List[Tuple[User, List[str]]] = []
+		with self._state_lock:
+			while self._timeout_heap and self._timeout_heap[0][0] <= now:
+				_, user_id = heapq.heappop(self._timeout_heap)
+				# 処理済みの重複エントリ
+				if user_id not in self._timeout_scheduled:
+					continue
+				
+				user = self.users.get(user_id)
+				# 既にlogoutステータスのユーザーは監視対象から外す（無限ループ防止）
+				if user is None or user.status == UserStatus.logout:
+					self._timeout_scheduled.discard(user_id)
+					continue
+				
+				# 登録後にlastloginが更新されていれば、新しい期限で登録し直す
+				deadline = user.lastlogin + timedelta(seconds=SESSION_TIMEOUT)
+				if deadline > now:
+					heapq.heappush(self._timeout_heap, (deadline, user_id))
+					continue
+				
+				self._timeout_scheduled.discard(user_id)
+				expired.append((user, list(self.active_sessions.get(user_id, ()))))
+		
+		# ユーザー・セッションのロックを取るため、状態ロックを放してから処理する
 		closed_sessions = []
+		for user, session_ids in expired:
+			user_id = user.user_id
+			try:
+				self._timeout_user(user, session_ids, now, closed_sessions)
+			except Exception as e:
+				# ヒープから取り出し済みのため、登録し直さないと二度とチェックされない
+				# （期限は過ぎているので次回のチェックで再試行する）
+				logger.error(f"[ERROR] User timeout failed: {user_id}, will retry: {e}")
+				with self._state_lock:
+					self.reschedule_timeout(user_id)
 		
-		for user_id, user in list(self.users.items()):
-			# lastloginがタイムアウトを超えている場合
-			# 既にlogoutステータスのユーザーはスキップ（無限ループ防止）
-			if user.status == UserStatus.logout:
-				continue
+		return closed_sessions
+
+	def _timeout_user(self, user: User, session_ids: List[str], now: datetime, closed_sessions: List[str]) -> None:
+		"""期限切れのユーザー1人のセッションをcloseしてlogoutにする。closeしたセッションは closed_sessions に追加する。"""
+		user_id = user.user_id
+		renewed = False
+		with self.user_lock(user_id):
+			for session_id in session_ids:
+				with self.session_lock(session_id), self._state_lock:
+					# 取り出した後にメッセージが届いていれば、そのユーザーはタイムアウトさせない
+					# （複数ワーカー構成では他のワーカーが更新したlastloginを読み直す）
+					user = self._load_user(user_id) or user
+					if user.lastlogin + timedelta(seconds=SESSION_TIMEOUT) > now:
+						renewed = True
+						break
+					if self._get_conversation(session_id) is None or (session_id not in self.sessions and session_id not in self._unrestored):
+						continue
+					logger.info(f"[INFO] User timeout: {user_id}, closing session: {session_id}")
+					# そのユーザーのアクティブセッションをすべてclose（history を messages に保存）
+					self._close_session(session_id)
+					closed_sessions.append(session_id)
 			
-			if user.lastlogin < timeout_threshold:
-				# そのユーザーのアクティブセッションをすべてclose
-				for session_id, conv in list(self.conversations.items()):
-					if conv.user_id == user_id and conv.status == ChatStatus.active:
-						logger.info(f"[INFO] User timeout: {user_id}, closing session: {session_id}")
-						
-						# タイムアウト時も要約とAI Insightsを生成する
-						try:
-							self.generate_summary_and_insights(session_id)
-						except Exception as e:
-							logger.error(f"[ERROR] Failed to generate insights during timeout for session {session_id}: {e}")
-						
-						# active → closed
-						conv.status = ChatStatus.closed
-						# メモリから削除
-						if session_id in self.sessions:
-							del self.sessions[session_id]
-						closed_sessions.append(session_id)
-				
+			with self._state_lock:
+				user = self._load_user(user_id) or user
+				if renewed or user.lastlogin + timedelta(seconds=SESSION_TIMEOUT) > now:
+					self.reschedule_timeout(user_id)
+					return
 				# ユーザーをメモリから削除せず、ステータスをlogoutに変更
 				# del self.users[user_id]
-				user.status = UserStatus.logout
-				logger.info(f"[INFO] User timeout: {user_id}, status set to logout")
-				logger.info(f"[INFO] Unloaded inactive user: {user_id}")
-		
-		# 変更を保存
-		if closed_sessions:
-			self.save_file()
-		
-		return closed_sessions
+				if user.status != UserStatus.logout:
+					status = user.status
+					user.status = UserStatus.logout
+					try:
+						self.storage.put_user(user)
+					except Exception:
+						# 保存できなければlogoutにせず、再試行の対象に残す
+						user.status = status
+						raise
+				self._track_user(user)
+		logger.info(f"[INFO] User timeout: {user_id}, status set to logout")
+
+	def archive_conversations(self, now: Optional[datetime] = None) -> Tuple[int, int]:
+		"""
+		古いclosedの会話をstorageからアーカイブへ移し、TTLを過ぎたデータを削除する。
+		- ARCHIVE_AFTER_DAYS より前にアクセスされたclosedの会話をアーカイブへ追記し、
+		  追記が終わってからstorageとメモリから削除する
+		- CONVERSATIONS_TTL_DAYS を過ぎた会話はアーカイブせずに削除し、アーカイブからも削除する
+		- 推薦ログに RECOMMEND_LOG_TTL_DAYS を適用する
+		- メモリ上のユーザーに AI_INSIGHTS_TTL_DAYS を適用する
+		  （storageにしかないユーザーは次に読み込んだ時に適用する）
+		- CONVERSATIONS_TTL_DAYS / AI_INSIGHTS_TTL_DAYS の短い方より長く使われていない
+		  システムプロンプト（ai_insightsを含む）を削除する
+		(アーカイブした件数, 削除した件数) を返す。定期タスクからスレッドで呼ぶ。
+		複数ワーカー構成では1つのワーカーだけが実行する（他のワーカーが実行中ならスキップ）。
+		"""
+		if self.leases is None:
+			return self._archive_conversations(now)
+		try:
+			with self.leases.hold("archive", wait=0):
+				return self._archive_conversations(now)
+		except LockTimeout:
+			logger.info("[INFO] Archive is running on another worker, skipped")
+			return 0, 0
+
+	def _archive_conversations(self, now: Optional[datetime]) -> Tuple[int, int]:
+		now = now or datetime.now()
+		archive_cutoff = now - timedelta(days=ARCHIVE_AFTER_DAYS) if ARCHIVE_AFTER_DAYS > 0 else None
+		ttl_cutoff = now - timedelta(days=CONVERSATIONS_TTL_DAYS) if CONVERSATIONS_TTL_DAYS is not None else None
+		cutoffs = [c for c in (archive_cutoff, ttl_cutoff) if c is not None]
+
+		archived = 0
+		deleted = 0
+		if cutoffs:
+			with self._state_lock:
+				session_ids = self.storage.closed_before(max(cutoffs))
+			# 状態ロックはバッチごとに取り直す（リクエストを長く待たせない）
+			for start in range(0, len(session_ids), _ARCHIVE_BATCH):
+				with self._state_lock:
+					to_archive = []
+					to_delete = []
+					for session_id in session_ids[start:start + _ARCHIVE_BATCH]:
+						conv = self.conversations.get(session_id)
+						if conv is None or session_id in self._evicted_bodies:
+							conv = self.storage.get_conversation(session_id)
+						# 再開された会話は対象外
+						if conv is None or conv.status != ChatStatus.closed or session_id in self.sessions:
+							continue
+						if ttl_cutoff is not None and conv.last_accessed < ttl_cutoff:
+							deleted += 1
+						elif archive_cutoff is not None and conv.last_accessed < archive_cutoff:
+							to_archive.append(conv)
+						else:
+							continue
+						to_delete.append(session_id)
+					# アーカイブへの書き込みが終わってからstorageから消す
+					archived += self.archive.append_many(to_archive)
+					for session_id in to_delete:
+						self.storage.delete_conversation(session_id)
+						self.conversations.pop(session_id, None)
+						self._history_cache.pop(session_id, None)
+						self._closed_bodies.pop(session_id, None)
+						self._evicted_bodies.discard(session_id)
+		if ttl_cutoff is not None:
+			deleted += self.archive.purge(ttl_cutoff)
+		if deleted:
+			# 削除した会話を一覧から除くため、作った一覧は次の要求時に作り直す
+			with self._state_lock:
+				self._session_index.clear()
+
+		# close/pauseした会話のターンログを取り除く（write-behindの書き出しを済ませてから）
+		if self.turn_log is not None:
+			with self._state_lock:
+				self.storage.sync()
+				self.turn_log.compact()
+
+		# 推薦ログは件数上限で捨てた分の整理もここで行う
+		expired = self.recommend_log.expire(
+			now - timedelta(days=RECOMMEND_LOG_TTL_DAYS) if RECOMMEND_LOG_TTL_DAYS is not None else None
+		)
+		if expired:
+			logger.info(f"[INFO] Deleted {expired} expired recommendation(s)")
+
+		# システムプロンプトは使われるたびに最後に使われた時刻を更新しているため、TTLより長く使われていないものだけを消す
+		# （消したプロンプトを参照する会話を再開した場合は、llm_chatが現在のプロンプトで作り直す）
+		prompt_ttls = [d for d in (CONVERSATIONS_TTL_DAYS, AI_INSIGHTS_TTL_DAYS) if d is not None]
+		if prompt_ttls:
+			removed = self.storage.delete_prompts_before(now - timedelta(days=min(prompt_ttls)))
+			if removed:
+				logger.info(f"[INFO] Deleted {removed} unused system prompt(s)")
+
+		# 複数ワーカー構成ではメモリ上のユーザーが古い可能性があるため、読み込み時の適用に任せる
+		with self._state_lock:
+			for user in list(self.users.values()) if not self.shared else ():
+				if self._apply_user_ttl(user, now):
+					self.storage.put_user(user)
+
+		if archived or deleted:
+			logger.info(f"[INFO] Archived {archived} conversation(s), deleted {deleted} expired conversation(s)")
+		return archived, deleted
+
+	def _track_user(self, user: User) -> None:
+		"""
+		logoutユーザーを最近使った順に記録し、MEMORY_MAX_IDLE_USERS を超えた分をメモリから追い出す。
+		追い出すユーザーは念のため storage に保存する（lastlogin等がメモリ上でのみ更新されているため）。
+		storage 側のコピーも evict_user で手放させる。
+		"""
+		if user.status != UserStatus.logout:
+			self._idle_users.pop(user.user_id, None)
+			return
+		self._idle_users[user.user_id] = None
+		self._idle_users.move_to_end(user.user_id)
+		if MEMORY_MAX_IDLE_USERS <= 0:
+			return
+		while len(self._idle_users) > MEMORY_MAX_IDLE_USERS:
+			user_id, _ = self._idle_users.popitem(last=False)
+			idle = self.users.get(user_id)
+			if idle is None or idle.status != UserStatus.logout or user_id in self.active_sessions:
+				continue
+			# 複数ワーカー構成では変更のたびに保存済みで、メモリ上のコピーは古い可能性がある
+			if not self.shared:
+				self.storage.put_user(idle)
+			del self.users[user_id]
+			self.storage.evict_user(user_id)
+			self._session_index.pop(user_id, None)
+			self._memory_counters["users_evicted"] += 1
+
+	def _track_body(self, conv: Conversation) -> None:
+		"""
+		本文を持つclosedの会話を最近使った順に記録し、MEMORY_MAX_CLOSED_BODIES を超えた分の
+		messages をメモリから外す（メタデータは残し、必要になったら _get_conversation で読み直す）。
+		write-behindの書き出し待ちのオブジェクトを書き換えないよう、本文を外したコピーに差し替える。
+		storage 側の本文も evict_conversation で手放させる。
+		"""
+		session_id = conv.session_id
+		if conv.status != ChatStatus.closed or session_id in self._evicted_bodies or self.conversations.get(session_id) is not conv:
+			return
+		self._closed_bodies[session_id] = None
+		self._closed_bodies.move_to_end(session_id)
+		if MEMORY_MAX_CLOSED_BODIES <= 0:
+			return
+		while len(self._closed_bodies) > MEMORY_MAX_CLOSED_BODIES:
+			session_id, _ = self._closed_bodies.popitem(last=False)
+			closed = self.conversations.get(session_id)
+			if closed is None or closed.status != ChatStatus.closed or session_id in self.sessions:
+				continue
+			self.conversations[session_id] = closed.model_copy(update={"messages": []})
+			self.storage.evict_conversation(session_id)
+			self._evicted_bodies.add(session_id)
+			self._memory_counters["bodies_evicted"] += 1
+
+	@_synchronized
+	def memory_stats(self) -> Dict[str, int]:
+		"""
+		メモリ上に保持している件数と追い出しのカウンタを返す（キオスク・コンテナのサイズ見積もり用）。
+		*_total はプロセス起動からの累計。
+		"""
+		return {
+			"users": len(self.users),
+			"idle_users": len(self._idle_users),
+			"max_idle_users": MEMORY_MAX_IDLE_USERS,
+			"conversations": len(self.conversations),
+			"closed_bodies": len(self._closed_bodies),
+			"evicted_bodies": len(self._evicted_bodies),
+			"max_closed_bodies": MEMORY_MAX_CLOSED_BODIES,
+			"active_sessions": len(self.sessions),
+			"unrestored_sessions": len(self._unrestored),
+			"history_cache": len(self._history_cache),
+			"users_evicted_total": self._memory_counters["users_evicted"],
+			"bodies_evicted_total": self._memory_counters["bodies_evicted"],
+			"bodies_reloaded_total": self._memory_counters["bodies_reloaded"],
+		}
+
+	def _schedule_timeout(self, user: User) -> None:
+		"""
+		ユーザーをタイムアウト監視の対象に登録する（登録済み・logoutなら何もしない）。
+		期限はヒープから取り出した時点のlastloginで再計算するため、
+		lastloginが先へ進んだ場合の登録し直しは不要。
+		"""
+		if user.status == UserStatus.logout or user.user_id in self._timeout_scheduled:
+			return
+		self._timeout_scheduled.add(user.user_id)
+		heapq.heappush(self._timeout_heap, (user.lastlogin + timedelta(seconds=SESSION_TIMEOUT), user.user_id))
+
+	@_synchronized
+	def reschedule_timeout(self, user_id: str) -> None:
+		"""
+		lastloginを過去へ書き換えた場合など、期限が早まったユーザーを登録し直す。
+		"""
+		user = self.users.get(user_id)
+		if user is None or user.status == UserStatus.logout:
+			return
+		self._timeout_scheduled.add(user_id)
+		heapq.heappush(self._timeout_heap, (user.lastlogin + timedelta(seconds=SESSION_TIMEOUT), user_id))
+
+	def _index_session(self, conv: Conversation) -> None:
+		"""
+		ユーザーごとのアクティブセッション索引と会話一覧を conv.status に合わせて更新する。
+		Conversation.status を変更したら必ず呼ぶこと。
+		"""
+		sessions = self.active_sessions.get(conv.user_id)
+		if conv.status == ChatStatus.active:
+			if sessions is None:
+				sessions = self.active_sessions[conv.user_id] = set()
+			sessions.add(conv.session_id)
+		elif sessions is not None:
+			sessions.discard(conv.session_id)
+			if not sessions:
+				del self.active_sessions[conv.user_id]
+		self._summarize(conv)
+
+	@staticmethod
+	def _session_summary(conv: Conversation) -> SessionSummary:
+		return SessionSummary(
+			session_id=conv.session_id,
+			status=conv.status,
+			last_accessed=conv.last_accessed,
+			summary=conv.summary
+		)
+
+	def _summarize(self, conv: Conversation) -> None:
+		"""会話一覧を作ったユーザーであれば、会話のメタデータ（status, last_accessed, summary）を反映する。"""
+		index = self._session_index.get(conv.user_id)
+		if index is not None:
+			index[conv.session_id] = self._session_summary(conv)
+
+	def _build_session_index(self, user: User) -> Dict[str, SessionSummary]:
+		"""
+		ユーザーの会話一覧を作る（User.old_session / active_session とメモリ上のアクティブセッションから）。
+		メモリにない会話はstorage・アーカイブから1件ずつ読み、メタデータだけを残す。
+		"""
+		session_ids = list(user.old_session)
+		if user.active_session:
+			session_ids.append(user.active_session)
+		session_ids.extend(self.active_sessions.get(user.user_id, ()))
+		index: Dict[str, SessionSummary] = {}
+		for session_id in dict.fromkeys(session_ids):
+			conv = self.conversations.get(session_id)
+			if conv is None:
+				try:
+					conv = self.storage.get_conversation(session_id) or self.archive.get(session_id)
+				except Exception as e:
+					logger.warning(f"[WARNING] Failed to load conversation {session_id} for the session list: {e}")
+					continue
+			if conv is None or conv.user_id != user.user_id:
+				continue
+			index[session_id] = self._session_summary(conv)
+		return index
+
+	@_synchronized
+	def list_sessions(self, user_id: str, offset: int = 0, limit: int = 20) -> Optional[Tuple[int, List[SessionSummary]]]:
+		"""
+		ユーザーの会話を最終アクセスの新しい順に offset から limit 件返す（messagesは含まない）。
+		(全件数, 会話のリスト) を返す。ユーザーが存在しなければNone。
+		一覧は最初の要求時に作り、ユーザーがメモリにある間は会話の変更に合わせて更新する
+		（複数ワーカー構成では他のワーカーの変更を反映するため、毎回作り直す）。
+		"""
+		user = self._load_user(user_id)
+		if user is None:
+			return None
+		index = self._session_index.get(user_id)
+		if index is None:
+			index = self._build_session_index(user)
+			if not self.shared:
+				self._session_index[user_id] = index
+		ordered = sorted(index.values(), key=lambda summary: summary.last_accessed, reverse=True)
+		return len(ordered), ordered[offset:offset + limit]
 
 	
+	@_session_synchronized
 	def resume_session(self, session_id: str) -> None:
 		"""
 		pause状態のセッションをactiveに戻す。
 		"""
-		if session_id in self.conversations:
-			conv = self.conversations[session_id]
+		conv = self._get_conversation(session_id)
+		if conv is not None:
+			# 起動時・pause後にまだ復元していない履歴をメモリへ戻す
+			self._restore_session(session_id)
 			if conv.status == ChatStatus.pause:
 				conv.status = ChatStatus.active
 				conv.last_accessed = datetime.now()
-				# messagesをin-memoryセッションに復元 (dict -> object)
-				try:
-					if conv.messages:
-						self.sessions[session_id] = messages_from_dict(conv.messages)
-					else:
-						self.sessions[session_id] = []
-				except Exception:
-					self.sessions[session_id] = []
+				self._index_session(conv)
+				if session_id not in self.sessions:
+					# messagesをin-memoryセッションに復元 (dict -> ChatHistory)
+					try:
+						self.sessions[session_id] = ChatHistory.from_dicts(conv.messages)
+					except Exception:
+						self.sessions[session_id] = ChatHistory()
+				if self.shared:
+					self.storage.put_conversation(self._snapshot_conversation(conv))
 				logger.info(f"[INFO] Session resumed: {session_id}")
@@ -0,0 +1,71 @@
+# SessionEventHub: セッションごとのエージェントのイベント（表情・検索・推薦等）を購読者へ配信する
+
+import asyncio
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Tuple
+
+from backend import SESSION_EVENTS_QUEUE_SIZE
+
+# ロガー設定
+logger = logging.getLogger("uvicorn.error")
+
+
+class SessionEventHub:
+	"""
+	セッションごとの購読者（asyncio.Queue）にイベント (イベント名, データ) を配信する。
+	- publish() はLLM用のスレッドから呼ばれるため、購読者のイベントループへ call_soon_threadsafe で渡す
+	- 購読者のキューが満杯（読むのが遅い）の場合は古いイベントから捨てる
+	- 購読者がいないセッションのイベントは捨てる（保存・再送はしない）
+	同じプロセス内のみ。複数ワーカー構成では、ターンを処理したワーカーに接続している購読者にだけ届く。
+	"""
+
+	def __init__(self, queue_size: int = SESSION_EVENTS_QUEUE_SIZE):
+		self.queue_size = queue_size
+		self._lock = threading.Lock()
+		# session_id → [(購読者のイベントループ, キュー)]
+		self._subscribers: Dict[str, List[Tuple[asyncio.AbstractEventLoop, asyncio.Queue]]] = {}
+
+	@contextmanager
+	def subscription(self, session_id: str) -> Iterator[asyncio.Queue]:
+		"""セッションのイベントを受け取るキューを貸し出す（イベントループ内で使う）。"""
+		entry = (asyncio.get_running_loop(), asyncio.Queue(maxsize=self.queue_size))
+		with self._lock:
+			self._subscribers.setdefault(session_id, []).append(entry)
+		try:
+			yield entry[1]
+		finally:
+			with self._lock:
+				subscribers = self._subscribers.get(session_id, [])
+				if entry in subscribers:
+					subscribers.remove(entry)
+				if not subscribers:
+					self._subscribers.pop(session_id, None)
+
+	def has_subscribers(self, session_id: str) -> bool:
+		with self._lock:
+			return bool(self._subscribers.get(session_id))
+
+	def publish(self, session_id: str, event: str, data: dict) -> None:
+		"""セッションの購読者全員にイベントを送る（どのスレッドから呼んでもよい）。"""
+		with self._lock:
+			subscribers = list(self._subscribers.get(session_id, ()))
+		for loop, queue in subscribers:
+			try:
+				loop.call_soon_threadsafe(self._put, queue, (event, data))
+			except RuntimeError:
+				# 購読者のイベントループが終了している
+				pass
+
+	@staticmethod
+	def _put(queue: asyncio.Queue, item: Tuple[str, dict]) -> None:
+		if queue.full():
+			queue.get_nowait()
+			logger.warning("[WARNING] Session event queue full, dropped the oldest event")
+		queue.put_nowait(item)
+
+	def __len__(self) -> int:
+		"""購読者の数。"""
+		with self._lock:
+			return sum(len(subscribers) for subscribers in self._subscribers.values())
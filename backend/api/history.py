@@ -0,0 +1,149 @@
+# ChatHistory: アクティブなセッションの履歴をコンパクトに保持するコンテナ
+
+from typing import Any, Dict, Iterable, Iterator, List, Union
+
+from langchain_core.messages import (
+	BaseMessage,
+	AIMessage,
+	HumanMessage,
+	SystemMessage,
+	message_to_dict,
+	messages_from_dict
+)
+
+# 役割タグ（bytearrayに1バイトで持つ）
+_TYPES = ("human", "ai", "system")
+_TAGS = {message_type: tag for tag, message_type in enumerate(_TYPES)}
+# 上記以外の種類（tool等）は messages_to_dict 形式のdictを丸ごと _extra に持つ
+_TAG_RAW = 255
+# 仕様書の {role, content} 形式の役割名
+_ROLES = {"user": "human", "human": "human", "model": "ai", "assistant": "ai", "ai": "ai", "system": "system"}
+_MISSING = object()
+
+
+def _default_data(message_class) -> Dict[str, Any]:
+	"""message_to_dict で出力される data のうち、content以外の既定値。"""
+	data = message_to_dict(message_class(content=""))["data"]
+	data.pop("content")
+	return data
+
+
+_DEFAULTS = {
+	"human": _default_data(HumanMessage),
+	"ai": _default_data(AIMessage),
+	"system": _default_data(SystemMessage),
+}
+
+
+class ChatHistory:
+	"""
+	1セッションの会話履歴。LangChainのメッセージオブジェクトの代わりに
+	役割タグ（bytearray）・本文（list）・既定値以外のフィールド（メッセージ番号 → dict, 疎）を持つ。
+	- append / extend は末尾への追記のみで O(1)（既存の要素はコピーしない）
+	- LangChainのメッセージは LLM に渡す時などに、インデックス・スライス・イテレーションで必要な分だけ作る
+	- to_dicts() は messages_to_dict と同じ形式をオブジェクトを経由せずに作る（保存用）
+	追記は本文 → タグの順に行い、len() はタグの数で数えるため、
+	ロックなしで読んでも書きかけのメッセージは見えない。
+	"""
+	__slots__ = ("_tags", "_contents", "_extra")
+
+	def __init__(self, messages: Iterable[Union[BaseMessage, dict]] = ()):
+		self._tags = bytearray()
+		self._contents: List[Any] = []
+		self._extra: Dict[int, dict] = {}
+		self.extend(messages)
+
+	@classmethod
+	def from_dicts(cls, dicts: Iterable[dict]) -> "ChatHistory":
+		"""messages_to_dict 形式（Conversation.messages）から作る。"""
+		history = cls()
+		for d in dicts:
+			history._append_dict(d)
+		return history
+
+	def _append_dict(self, d: dict) -> None:
+		message_type = d.get("type")
+		data = d.get("data")
+		if "role" in d and data is None:
+			# 仕様書の {role, content} 形式
+			message_type = _ROLES.get(d["role"])
+			if message_type is None:
+				raise ValueError(f"Unknown message role: {d['role']}")
+			data = {"content": d.get("content", "")}
+		if not isinstance(data, dict) or "content" not in data:
+			raise ValueError(f"Invalid message dict: {d}")
+		tag = _TAGS.get(message_type, _TAG_RAW)
+		index = len(self._tags)
+		if tag == _TAG_RAW:
+			self._extra[index] = d
+		else:
+			defaults = _DEFAULTS[message_type]
+			extra = {k: v for k, v in data.items() if k != "content" and defaults.get(k, _MISSING) != v}
+			if extra:
+				self._extra[index] = extra
+		self._contents.append(data["content"])
+		self._tags.append(tag)
+
+	def append(self, message: Union[BaseMessage, dict]) -> None:
+		if isinstance(message, BaseMessage):
+			message = message_to_dict(message)
+		self._append_dict(message)
+
+	def extend(self, messages: Iterable[Union[BaseMessage, dict]]) -> None:
+		for message in messages:
+			self.append(message)
+
+	def _dict(self, index: int) -> dict:
+		tag = self._tags[index]
+		if tag == _TAG_RAW:
+			return self._extra[index]
+		message_type = _TYPES[tag]
+		data = {"content": self._contents[index]}
+		# 既定値の空のdict・listは呼び出し側で変更されても共有されないよう毎回作る
+		for k, v in _DEFAULTS[message_type].items():
+			data[k] = v.copy() if isinstance(v, (dict, list)) else v
+		extra = self._extra.get(index)
+		if extra:
+			data.update(extra)
+		return {"type": message_type, "data": data}
+
+	def to_dicts(self, start: int = 0) -> List[dict]:
+		"""messages_to_dict 形式のリスト（start番目以降）。"""
+		return [self._dict(i) for i in range(start, len(self._tags))]
+
+	def __len__(self) -> int:
+		return len(self._tags)
+
+	def __getitem__(self, index: Union[int, slice]) -> Union[BaseMessage, List[BaseMessage]]:
+		if isinstance(index, slice):
+			indices = range(*index.indices(len(self._tags)))
+			return messages_from_dict([self._dict(i) for i in indices])
+		if index < 0:
+			index += len(self._tags)
+		if not 0 <= index < len(self._tags):
+			raise IndexError("history index out of range")
+		return messages_from_dict([self._dict(index)])[0]
+
+	def __iter__(self) -> Iterator[BaseMessage]:
+		for i in range(len(self._tags)):
+			yield self[i]
+
+	def __add__(self, other: Iterable[Union[BaseMessage, dict]]) -> "ChatHistory":
+		"""コピーを作って追加する（呼び出し側の履歴は変更しない）。"""
+		history = self.copy()
+		history.extend(other)
+		return history
+
+	def copy(self) -> "ChatHistory":
+		history = ChatHistory()
+		history._tags = bytearray(self._tags)
+		history._contents = list(self._contents)
+		history._extra = dict(self._extra)
+		return history
+
+	def messages(self) -> List[BaseMessage]:
+		"""LangChainのメッセージのリスト。"""
+		return self[:]
+
+	def __repr__(self) -> str:
+		return f"ChatHistory({len(self)} messages)"
@@ -1,13 +1,18 @@
 # Standard Library
 import os
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-from typing import Optional, List, Dict, Any, TypedDict, Annotated, Sequence
+from typing import Optional, List, Dict, Any, Callable, TypedDict, Annotated, Sequence
 import logging
 
 # LangChain
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_core.messages import HumanMessage, AIMessage, SystemMessage, BaseMessage, ToolMessage
+from langchain_core.messages import HumanMessage, AIMessage, AIMessageChunk, SystemMessage, BaseMessage, ToolMessage
 from langchain_core.tools import tool
+from langchain_core.runnables import RunnableConfig
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_ollama import ChatOllama
 from langgraph.graph import StateGraph, END
@@ -15,8 +20,10 @@ from langgraph.graph.message import add_messages
 from langgraph.prebuilt import ToolNode
 
 # User-defined
-from backend import PROMPTS_DIR, LLM_MAX_RETRIES, LLM_HISTORY_LIMIT
+from backend import PROMPTS_DIR, LLM_MAX_RETRIES, LLM_HISTORY_LIMIT, LLM_MAX_CONCURRENCY
 from backend.search.rakuten_books import rakuten_search_books
+from .storage.prompts import PromptStore, PromptNotFound
+from .history import ChatHistory
 
 # Logger
 logger = logging.getLogger("uvicorn.error")
@@ -31,63 +38,158 @@ if os.getenv("LANGCHAIN_DEBUG", "false").lower() == "true":
 # State Definition
 
 class AgentState(TypedDict):
-	"""エージェントの状態"""
+	"""
+	エージェントの状態（メッセージのみ）。
+	検索結果・推薦はツールの並行実行で更新されるため、グラフの状態ではなく実行時のconfigの TurnState に持つ。
+	"""
 	messages: Annotated[Sequence[BaseMessage], add_messages]
-	search_results: Dict[int, dict]  # 検索結果（番号 → 書籍データ）
-	recommended_books: List[dict]  # 推薦された書籍
 
 
-# グローバルステート（ツール間で共有）
-_global_state = {
-	"search_results": {},
-	"recommended_books": []
-}
+# システムプロンプトの保存先（履歴にはハッシュのみを持たせる）
+prompt_store = PromptStore()
+# 最初のHumanMessageの additional_kwargs に入れるプロンプト参照のキー
+SYSTEM_PROMPT_REF = "system_prompt_ref"
+# LLMに送る最初のメッセージでの、システムプロンプトとユーザー発言の区切り
+FIRST_MESSAGE_SEPARATOR = "\n\n---\n\nユーザー: "
+
+# LLM呼び出し専用のスレッドプール
+# LangGraphの実行・Gemini/OllamaのHTTP呼び出し・楽天APIの検索はすべて同期（ブロッキング）のため、
+# イベントループでも既定のスレッドプール（asyncio.to_thread）でもなく、上限付きのこのプールで実行する
+_llm_executor = ThreadPoolExecutor(max_workers=LLM_MAX_CONCURRENCY, thread_name_prefix="llm")
+
+
+async def run_in_llm_pool(func, *args, **kwargs):
+	"""
+	同期の関数（llm_chat や LLM呼び出しを含む1ターンの処理）をLLM用のスレッドプールで実行して待つ。
+	同時に実行されるのは LLM_MAX_CONCURRENCY 件までで、それ以上は空くまでキューで待つ。
+	待っている間もイベントループは他のリクエスト（認証・NFCログイン・ヘルスチェック等）を処理できる。
+	"""
+	loop = asyncio.get_running_loop()
+	return await loop.run_in_executor(_llm_executor, functools.partial(func, *args, **kwargs))
+
 
 # LLM Initialization
 
+# LLMクライアントのレジストリ（(backend, model, temperature, max_tokens) → インスタンス）
+# インスタンスは内部にHTTPクライアント（接続プール）を持つため、ターンごとに作らず使い回す
+_llm_clients: Dict[tuple, Any] = {}
+_llm_clients_lock = threading.Lock()
+
+
+def _model_name(backend: str) -> str:
+	"""バックエンドで使うモデル名。"""
+	if backend == "gemini":
+		return "gemini-2.5-flash"
+	return os.getenv("OLLAMA_MODEL", "llama3.2")
+
+
+def _create_llm(backend: str, model_name: str, temperature: float, max_tokens: int):
+	"""LLMインスタンスを作る（get_llm からのみ呼ぶ）。"""
+	if backend == "gemini":
+		# システムプロンプトはsystem_instructionではなくメッセージリストに追加する方式を採用
+		return ChatGoogleGenerativeAI(
+			model=model_name,
+			temperature=temperature,
+			max_tokens=max_tokens,
+			google_api_key=os.getenv("GEMINI_API_KEY")
+		)
+	else:  # ollama
+		return ChatOllama(
+			model=model_name,
+			base_url=os.getenv("OLLAMA_API_URL", "http://localhost:11434"),
+			temperature=temperature,
+			num_predict=max_tokens
+		)
+
+
 def get_llm(backend: str = None, temperature: float = 0.3, max_tokens: int = 512, system_prompt: Optional[str] = None):
 	"""
 	LLMインスタンスを取得
+	(backend, model, temperature, max_tokens) ごとに1回だけ作り、以降は同じインスタンス（と接続プール）を返す。
+	インスタンスは状態を持たないため、複数のスレッドから同時に使ってよい。
 	
 	Args:
 		backend: LLMバックエンド（'gemini' または 'ollama'）
 		temperature: 温度パラメータ
 		max_tokens: 最大トークン数
-		system_prompt: システムプロンプト（オプション）
+		system_prompt: システムプロンプト（未使用。メッセージリストに追加する）
 		
 	Returns:
 		LangChain LLMインスタンス
 	"""
 	if backend is None:
 		backend = os.getenv("LLM_BACKEND", "gemini")
-	
+	model_name = _model_name(backend)
+	key = (backend, model_name, temperature, max_tokens)
+	llm = _llm_clients.get(key)
+	if llm is None:
+		with _llm_clients_lock:
+			llm = _llm_clients.get(key)
+			if llm is None:
+				llm = _llm_clients[key] = _create_llm(backend, model_name, temperature, max_tokens)
+	return llm
+
+
+def warm_llm_clients(backend: Optional[str] = None) -> None:
+	"""
+	起動時に既定の設定（チャット・要約で使う temperature=0.3, max_tokens=512）のクライアントとエージェントを作り、
+	LLMのエンドポイントへ軽いリクエスト（モデル情報の取得）を1回送って接続（TLSのハンドシェイク含む）を張っておく。
+	"""
+	if backend is None:
+		backend = os.getenv("LLM_BACKEND", "gemini")
+	get_agent(backend)
+	llm = get_llm(backend)
 	if backend == "gemini":
-		# Geminiの場合、system_instructionとして渡す
-		kwargs = {
-			"model": "gemini-2.5-flash",
-			"temperature": temperature,
-			"max_tokens": max_tokens,
-			"google_api_key": os.getenv("GEMINI_API_KEY")
-		}
-		if system_prompt:
-			# LangChainのChatGoogleGenerativeAIはsystem_instructionをサポート
-			# ただし、メッセージとして渡す必要がある場合もあるため、
-			# ここでは含めずに、メッセージリストに追加する方式を採用
-			pass
-		return ChatGoogleGenerativeAI(**kwargs)
-	else:  # ollama
-		return ChatOllama(
-			model=os.getenv("OLLAMA_MODEL", "llama3.2"),
-			base_url=os.getenv("OLLAMA_API_URL", "http://localhost:11434"),
-			temperature=temperature,
-			num_predict=max_tokens
-		)
+		llm.client.models.get(model=llm.model)
+	else:
+		llm._client.list()
+	logger.info(f"[SUCCESS] LLM client warmed up: backend={backend}, model={_model_name(backend)}")
 
 
 # Tools Definition
+# ツールはモジュールで1回だけ定義し、1ターン分の状態（検索結果・推薦）は
+# 実行時の config["configurable"][TURN_STATE_KEY] の TurnState で受け取る
+
+# 実行時のconfigでTurnStateを渡すキー
+TURN_STATE_KEY = "turn_state"
+
+# ターンの途中経過を受け取るコールバック（イベント名, データ）
+EventCallback = Callable[[str, dict], None]
+
+
+class TurnState:
+	"""
+	llm_chat 1回（1ターン）の間だけツールが共有する状態。
+	ToolNodeは同じメッセージの複数のツール呼び出しを並行に実行するため、更新はロックを持って行う。
+	on_event が設定されていれば、ツールは実行した時点でイベント
+	（search_started / books_found / recommended_books / expression）を通知する。
+	"""
+	__slots__ = ("search_results", "recommended_books", "lock", "on_event")
+
+	def __init__(self, on_event: Optional[EventCallback] = None):
+		self.search_results: Dict[int, dict] = {}  # 全検索結果の累積（番号 → 書籍データ）
+		self.recommended_books: List[dict] = []  # 今回のターンで推薦された書籍
+		self.lock = threading.Lock()
+		self.on_event = on_event
+
+	def emit(self, event: str, data: dict) -> None:
+		"""イベントを通知する（通知先の失敗はターンの処理に影響させない）。"""
+		if self.on_event is None:
+			return
+		try:
+			self.on_event(event, data)
+		except Exception as e:
+			logger.warning(f"[WARNING] Turn event callback failed ({event}): {e}")
+
+
+def _turn_state(config: Optional[RunnableConfig]) -> TurnState:
+	"""configからTurnStateを取り出す（llm_chatの外から呼ばれた場合は使い捨てのものを返す）。"""
+	state = ((config or {}).get("configurable") or {}).get(TURN_STATE_KEY)
+	return state if state is not None else TurnState()
+
 
 @tool
-def search_books(keywords: list[str], count: int = 30) -> str:
+def search_books(keywords: list[str], config: RunnableConfig, count: int = 30) -> str:
 	"""
 	楽天Books APIを使って書籍を検索
 	
@@ -109,6 +211,9 @@ def search_books(keywords: list[str], count: int = 30) -> str:
 			logger.error(f"[ERROR] Invalid keywords: {keywords}")
 			return "検索キーワードが指定されていません。"
 		
+		state = _turn_state(config)
+		state.emit("search_started", {"keywords": keywords})
+		
 		# rakuten_search_booksは list[dict] を返す
 		books = rakuten_search_books(keywords, count=max(count, 10), orflag=0) # AND検索
 		
@@ -116,22 +221,27 @@ def search_books(keywords: list[str], count: int = 30) -> str:
 			books = rakuten_search_books(keywords, count=max(count * 2, 20), orflag=1) # OR検索
 			if not books:
 				logger.error("No books found for keywords: %s", keywords)
+				state.emit("books_found", {"keywords": keywords, "books": []})
 				return "申し訳ございません。該当する書籍が見つかりませんでした。"
-			
-		# グローバルステートに保存（番号 → 書籍データ）
-		_global_state["search_results"] = {i+1: book for i, book in enumerate(books)}
+		
+		# 累積されているIDの続きから番号を振る（同じターンの複数回の検索に対応）
+		with state.lock:
+			start_id = max(state.search_results.keys()) + 1 if state.search_results else 1
+			for i, book in enumerate(books):
+				state.search_results[start_id + i] = book
+		# 画像の先読みができるよう、推薦の前に見つかった本を番号付きで通知する
+		state.emit("books_found", {"keywords": keywords, "books": [{"number": start_id + i, **book} for i, book in enumerate(books)]})
 		
 		# LLMには番号付きリストとして返す
 		book_list = []
-		for i, book in enumerate(books, 1):
+		for i, book in enumerate(books):
 			title = book.get("title", "不明")
 			# authorsはリスト形式なので、最初の著者を取得
 			authors = book.get("authors", [])
 			author = authors[0] if authors else "不明"
-			book_list.append(f"{i}. 『{title}』 - {author}")
+			book_list.append(f"{start_id + i}. 『{title}』 - {author}")
 		
-		logger.info(f"[DEBUG] Found {len(books)} books")
-		logger.info(f"[DEBUG] Found {len(books)} books")
+		logger.info(f"[DEBUG] Found {len(books)} books. IDs assigned: {start_id} to {start_id + len(books) - 1}")
 		return f"検索結果（{len(books)}冊）:\n" + "\n".join(book_list) + "\n\nこれらの結果から、ユーザーに合った本を選び、必ず `recommend_books` を呼び出してください。テキストで検索結果を要約しないでください。もし推薦する本がない場合は、空のリスト `[]` を引数にして `recommend_books` を呼び出してください。"
 		
 	except Exception as e:
@@ -140,22 +250,23 @@ def search_books(keywords: list[str], count: int = 30) -> str:
 
 
 @tool
-def update_expression(expression_type: str) -> str:
-    """
-    表情の更新
-
+def update_expression(expression_type: str, config: RunnableConfig) -> str:
+	"""
+	表情の更新
+	
 	司書アバターの表情（感情）を更新します。
-    Args:
-        expression_type: 'neutral'（通常）', happy'（良い本が見つかった時）, 'thinking'（検索中）, 'sorry'（見つからない時）
-    Returns:
+	Args:
+		expression_type: 'neutral'（通常）', happy'（良い本が見つかった時）, 'thinking'（検索中）, 'sorry'（見つからない時）
+	Returns:
 		表情の変更の有無のメッセージ
 	"""
-    # このツール自体はメッセージを返すだけで、
-    # 実際のState更新はLangGraphのノード内、またはToolNodeの結果を反映して行います。
-    return f"表情を{expression_type}に変更しました。"
+	# 応答の表情は llm_chat がツール呼び出しの引数から取り出す。ここでは途中経過として通知のみ行う
+	_turn_state(config).emit("expression", {"expression": expression_type})
+	return f"表情を{expression_type}に変更しました。"
+
 
 @tool
-def recommend_books(selections: list[dict]) -> str:
+def recommend_books(selections: list[dict], config: RunnableConfig) -> str:
 	"""
 	検索結果から推薦する本を選択
 	
@@ -169,18 +280,21 @@ def recommend_books(selections: list[dict]) -> str:
 	"""
 	try:
 		recommended = []
-		search_results = _global_state.get("search_results", {})
+		state = _turn_state(config)
 		
-		for selection in selections:
-			num = selection.get("number")
-			reason = selection.get("reason", "")
+		with state.lock:
+			for selection in selections:
+				num = selection.get("number")
+				reason = selection.get("reason", "")
+				
+				if num in state.search_results:
+					book = state.search_results[num].copy()
+					book["recommendation_reason"] = reason
+					recommended.append(book)
 			
-			if num in search_results:
-				book = search_results[num].copy()
-				book["recommendation_reason"] = reason
-				recommended.append(book)
-		
-		_global_state["recommended_books"] = recommended
+			# 「今回の回答に含まれる推薦本」を返すため、同じターンで再度呼ばれた場合は置き換える
+			state.recommended_books[:] = recommended
+		state.emit("recommended_books", {"books": recommended})
 		
 		if recommended:
 			# LLMに返すメッセージを作成（番号を振り直して提示）
@@ -196,6 +310,10 @@ def recommend_books(selections: list[dict]) -> str:
 		return f"推薦処理中にエラーが発生しました: {str(e)}"
 
 
+# エージェントに渡すツール
+AGENT_TOOLS = [search_books, recommend_books, update_expression]
+
+
 # Prompt Management
 
 def load_prompt_text(filepath: str) -> str:
@@ -242,6 +360,75 @@ def create_system_prompt(base_prompt: str, ai_insight: Optional[str] = None) ->
 	
 	return full_prompt
 
+def expand_system_prompt(history: List[BaseMessage], store: Optional[PromptStore] = None) -> List[BaseMessage]:
+	"""
+	履歴の最初のメッセージのプロンプト参照を本文に戻したリストを返す（LLMに送る直前に使う）。
+	参照を持たない履歴（本文が埋め込まれた旧形式）はそのまま返す。
+	参照先のプロンプトが保存先にない場合は PromptNotFound を送出する（プロンプトなしでは送らない）。
+	"""
+	if not history:
+		return list(history)
+	first = history[0]
+	prompt_hash = first.additional_kwargs.get(SYSTEM_PROMPT_REF) if isinstance(first, HumanMessage) else None
+	if not prompt_hash:
+		return list(history)
+	system_prompt = (store or prompt_store).get(prompt_hash)
+	if system_prompt is None:
+		raise PromptNotFound(f"System prompt {prompt_hash} referenced by the history is missing")
+	return [HumanMessage(content=f"{system_prompt}{FIRST_MESSAGE_SEPARATOR}{first.content}")] + list(history[1:])
+
+
+def _expand_or_rebuild(
+	history: List[BaseMessage],
+	store: Optional[PromptStore],
+	prompt_file: str,
+	ai_insight: Optional[str]
+) -> List[BaseMessage]:
+	"""
+	expand_system_prompt と同じ。参照先のプロンプトが削除されていた場合（TTL等）は、
+	エラーを記録した上で prompt_file と現在の ai_insight からプロンプトを作り直して送る。
+	"""
+	try:
+		return expand_system_prompt(history, store)
+	except PromptNotFound as e:
+		logger.error(f"[ERROR] {e}, rebuilding it from {prompt_file}")
+		system_prompt = create_system_prompt(load_prompt_text(prompt_file), ai_insight)
+		return [HumanMessage(content=f"{system_prompt}{FIRST_MESSAGE_SEPARATOR}{history[0].content}")] + list(history[1:])
+
+
+def _append_turn(history: Sequence[BaseMessage], new_messages: List[BaseMessage]) -> Sequence[BaseMessage]:
+	"""
+	履歴の末尾にこのターンのメッセージを足したものを返す。
+	ChatHistory はその場で追記して同じオブジェクトを返し（既存の履歴をコピーしない）、
+	リストは従来通り新しいリストを返す。
+	"""
+	if isinstance(history, ChatHistory):
+		history.extend(new_messages)
+		return history
+	return list(history) + new_messages
+
+
+def history_view(messages: List[dict]) -> List[dict]:
+	"""
+	API応答用に、システムプロンプト（参照・埋め込み本文とも）を除いた履歴を返す。
+	messages は messages_to_dict 形式（保存されている Conversation.messages そのもの）で、
+	LangChainのオブジェクトへの変換は行わない。渡されたdictは変更しない。
+	"""
+	if not messages or messages[0].get("type") != "human":
+		return list(messages)
+	first = messages[0]
+	data = first.get("data", {})
+	kwargs = data.get("additional_kwargs") or {}
+	content = data.get("content")
+	if SYSTEM_PROMPT_REF in kwargs:
+		data = {**data, "additional_kwargs": {k: v for k, v in kwargs.items() if k != SYSTEM_PROMPT_REF}}
+	elif isinstance(content, str) and FIRST_MESSAGE_SEPARATOR in content:
+		# 旧形式: プロンプト本文が最初のメッセージに埋め込まれている
+		data = {**data, "content": content.split(FIRST_MESSAGE_SEPARATOR, 1)[1]}
+	else:
+		return list(messages)
+	return [{**first, "data": data}] + list(messages[1:])
+
 # LangGraph Workflow
 
 def create_agent_workflow(llm, tools):
@@ -314,159 +501,107 @@ def create_agent_workflow(llm, tools):
 	return workflow.compile()
 
 
+# コンパイル済みのエージェント（(backend, model, temperature, max_tokens) → グラフ）
+_agents: Dict[tuple, Any] = {}
+_agents_lock = threading.Lock()
+
+
+def get_agent(backend: Optional[str] = None, temperature: float = 0.3, max_tokens: int = 512):
+	"""
+	コンパイル済みのエージェント（モデルの作成・bind_tools・StateGraphのコンパイル済み）を返す。
+	(backend, model, temperature, max_tokens) ごとに1回だけ作り、以降のターンでは使い回す（モデルはget_llmのレジストリのもの）。
+	グラフは状態を持たない（検索結果等は実行時のconfigで渡す）ため、複数のスレッドから同時に実行してよい。
+	"""
+	if backend is None:
+		backend = os.getenv("LLM_BACKEND", "gemini")
+	key = (backend, _model_name(backend), temperature, max_tokens)
+	agent = _agents.get(key)
+	if agent is None:
+		# 同時に来た最初のターンがそれぞれ作らないよう、作成はロックを持って1回だけ行う
+		with _agents_lock:
+			agent = _agents.get(key)
+			if agent is None:
+				logger.info(f"[INFO] Compiling agent workflow: backend={backend}, temperature={temperature}, max_tokens={max_tokens}")
+				llm = get_llm(backend=backend, temperature=temperature, max_tokens=max_tokens)
+				agent = _agents[key] = create_agent_workflow(llm, AGENT_TOOLS)
+	return agent
+
+
 # Chat Functions
 
+def _message_text(content: Any, fallback: bool = True) -> str:
+	"""メッセージのcontent（文字列 または パートのリスト）からテキストを取り出す。"""
+	if isinstance(content, str):
+		return content
+	if isinstance(content, list):
+		# contentがリストの場合、テキスト部分を抽出
+		text_parts = []
+		for part in content:
+			if isinstance(part, dict) and 'text' in part:
+				text_parts.append(part['text'])
+			elif isinstance(part, str):
+				text_parts.append(part)
+		if text_parts or not fallback:
+			return ''.join(text_parts)
+	return str(content) if fallback else ""
+
+
+def _stream_agent(app, messages: List[BaseMessage], config: dict, turn_state: TurnState) -> dict:
+	"""
+	グラフをストリーミングで実行し、agentノードのLLMが生成したテキストを "token" イベントで通知する。
+	ノード内の invoke もストリーミングのコールバックにより逐次出力される。戻り値は invoke と同じ最終状態。
+	token の step はグラフのステップ番号で、ツール呼び出しを挟んで別の応答になると変わる（最終的な応答は最後のstepの分）。
+	"""
+	result: Dict[str, Any] = {"messages": messages}
+	for mode, chunk in app.stream({"messages": messages}, config=config, stream_mode=["messages", "values"]):
+		if mode == "values":
+			result = chunk
+			continue
+		message, metadata = chunk
+		if metadata.get("langgraph_node") != "agent" or not isinstance(message, AIMessageChunk):
+			continue
+		text = _message_text(message.content, fallback=False)
+		if text:
+			turn_state.emit("token", {"text": text, "step": metadata.get("langgraph_step")})
+	return result
+
+
 def llm_chat(
 	prompt_file: str,
 	message: str,
-	history: Optional[List[BaseMessage]] = None,
+	history: Optional[Sequence[BaseMessage]] = None,
 	ai_insight: Optional[str] = None,
 	model: Optional[str] = None,
 	temperature: float = 0.3,
-	max_tokens: int = 512
-) -> tuple[str, List[BaseMessage], List[dict]]:
+	max_tokens: int = 512,
+	store: Optional[PromptStore] = None,
+	on_event: Optional[EventCallback] = None
+) -> tuple[str, Sequence[BaseMessage], List[dict], str]:
 	"""
 	LangGraphを使ったチャット対話
 	
 	Args:
 		prompt_file: プロンプトファイルのパス
 		message: ユーザーメッセージ
-		history: 会話履歴 (List[BaseMessage])
+		history: 会話履歴 (List[BaseMessage] または ChatHistory。ChatHistoryには応答後にその場で追記する)
 		ai_insight: ユーザー情報
 		model: 使用するLLMバックエンド
 		temperature: 温度パラメータ
 		max_tokens: 最大トークン数
+		store: システムプロンプトの保存先（省略時は prompt_store）
+		on_event: 途中経過を受け取るコールバック。指定するとグラフをストリーミングで実行し、
+			生成中のテキスト（"token"）と、ツールの実行時のイベント（TurnState を参照）を通知する。
+			空の応答でやり直す場合は、やり直す前に "retry"（attempt: 次の試行の番号）を通知する
+			（それまでの "token" は最終的な応答に含まれない）
 		
 	Returns:
-		(応答テキスト, 更新された履歴(List[BaseMessage]), 推薦された書籍リスト)
+		(応答テキスト, 更新された履歴(List[BaseMessage]), 推薦された書籍リスト, 表情)
+		履歴の最初のメッセージにはシステムプロンプト本文ではなく参照（ハッシュ）が入る
 	"""
-    # ローカルステート初期化 (スレッドセーフかつ複数回検索に対応)
-	search_results_state = {}     # 全検索結果の累積 (ID -> BookDict)
-	recommended_books_state = []  # 推薦された本のリスト
-	
-    # ツール定義 (クロージャとして実装することでローカルステートにアクセス)
-	
-	@tool
-	def search_books(keywords: list[str], count: int = 30) -> str:
-		"""
-		楽天Books APIを使って書籍を検索
-		
-		検索結果は番号付きリストで返されます。
-		推薦する本を選ぶ際は、この番号を使用してください。
-		
-		Args:
-			keywords: 検索キーワードのリスト（例: ["SF", "初心者", "おすすめ"]）
-			count: 取得する書籍数（デフォルト: 10, 10冊以上を指定すること）
-			
-		Returns:
-			番号付き書籍リスト
-		"""
-		try:
-			logger.info(f"[DEBUG] search_books called with keywords: {keywords}, count: {count}")
-			
-			if not keywords or not isinstance(keywords, list):
-				logger.error(f"[ERROR] Invalid keywords: {keywords}")
-				return "検索キーワードが指定されていません。"
-			
-			# API呼び出し
-			books = rakuten_search_books(keywords, count=max(count, 10), orflag=0)
-			
-			if not books:
-				books = rakuten_search_books(keywords, count=max(count * 2, 20), orflag=1)
-				if not books:
-					logger.error("No books found for keywords: %s", keywords)
-					return "申し訳ございません。該当する書籍が見つかりませんでした。"
-				
-			# 累積されているIDの続きから番号を振る
-			start_id = max(search_results_state.keys()) + 1 if search_results_state else 1
-			
-			book_list = []
-			for i, book in enumerate(books):
-				current_id = start_id + i
-				# ローカルステートに保存
-				search_results_state[current_id] = book
-				
-				title = book.get("title", "不明")
-				authors = book.get("authors", [])
-				author = authors[0] if authors else "不明"
-				book_list.append(f"{current_id}. 『{title}』 - {author}")
-			
-			logger.info(f"[DEBUG] Found {len(books)} books. IDs assigned: {start_id} to {start_id + len(books) - 1}")
-			return f"検索結果（{len(books)}冊）:\n" + "\n".join(book_list) + "\n\nこれらの結果から、ユーザーに合った本を選び、必ず `recommend_books` を呼び出してください。テキストで検索結果を要約しないでください。もし推薦する本がない場合は、空のリスト `[]` を引数にして `recommend_books` を呼び出してください。"
-			
-		except Exception as e:
-			logger.error(f"[ERROR] search_books error: {e}", exc_info=True)
-			return f"検索中にエラーが発生しました: {str(e)}"
-
-	@tool
-	def update_expression(expression_type: str) -> str:
-		"""
-		表情の更新
-	
-		司書アバターの表情（感情）を更新します。
-		Args:
-			expression_type: 'neutral'（通常）', happy'（良い本が見つかった時）, 'thinking'（検索中）, 'sorry'（見つからない時）
-		Returns:
-			表情の変更の有無のメッセージ
-		"""
-		return f"表情を{expression_type}に変更しました。"
-
-	@tool
-	def recommend_books(selections: list[dict]) -> str:
-		"""
-		検索結果から推薦する本を選択
-		
-		Args:
-			selections: 推薦する本のリスト
-				各要素は {"number": 番号, "reason": "推薦理由"} の形式
-				例: [{"number": 1, "reason": "初心者向けで分かりやすい"}, {"number": 3, "reason": "実践的な内容"}]
-			
-		Returns:
-			推薦完了メッセージ
-		"""
-		try:
-			recommended_temp = []
-			
-			for selection in selections:
-				num = selection.get("number")
-				reason = selection.get("reason", "")
-				
-				# ローカルステートから検索
-				if num in search_results_state:
-					book = search_results_state[num].copy()
-					book["recommendation_reason"] = reason
-					recommended_temp.append(book)
-			
-			# 結果リストに追加（上書きせず追加、ただし今回はリクエストごとなので代入でOKに見えるが、念のためextend）
-			# ※仕様として「今回の回答に含まれる推薦本」を返すなら代入でよい。
-			# 過去の会話の推薦本は含めないのが通例。
-			recommended_books_state.clear()
-			recommended_books_state.extend(recommended_temp)
-			
-			if recommended_temp:
-				msg_lines = [f"{len(recommended_temp)}冊の本を推薦リストに追加しました。以下の番号と情報を使って、ユーザーに推薦してください。"]
-				for i, book in enumerate(recommended_temp, 1):
-					msg_lines.append(f"{i}. 『{book['title']}』 (理由: {book['recommendation_reason']})")
-				return "\n".join(msg_lines)
-			else:
-				return "推薦する本が選択されませんでした。ユーザーに「条件に合う本が見つかりませんでした」と報告してください。"
-				
-		except Exception as e:
-			return f"推薦処理中にエラーが発生しました: {str(e)}"
-
-	
-	# プロンプト読み込み
-	base_prompt = load_prompt_text(prompt_file)
-	system_prompt = create_system_prompt(base_prompt, ai_insight)
-	
-	# LLM初期化
-	llm = get_llm(backend=model, temperature=temperature, max_tokens=max_tokens)
-	
-	# ツール定義
-	tools = [search_books, recommend_books, update_expression]
-	
-	# ワークフロー作成
-	app = create_agent_workflow(llm, tools)
+	# コンパイル済みのエージェント（モデル・ツールのバインド・グラフは設定ごとに1回だけ作る）
+	app = get_agent(model, temperature, max_tokens)
+	# このターンの検索結果・推薦（ツールへは実行時のconfigで渡す）
+	turn_state = TurnState(on_event)
 	
 	# メッセージ履歴を準備
 	if history is None:
@@ -475,24 +610,27 @@ def llm_chat(
 	# メッセージリストを構築
 	if not history:
 		# 履歴がない場合: システムプロンプトを最初のメッセージに含める
-		first_message = f"{system_prompt}\n\n---\n\nユーザー: {message}"
-		# HumanMessageオブジェクトを作成
-		current_message = HumanMessage(content=first_message)
-		messages = [current_message]
+		# 履歴にはプロンプトのハッシュだけを残し、本文は prompt_store に1回だけ保存する
+		base_prompt = load_prompt_text(prompt_file)
+		system_prompt = create_system_prompt(base_prompt, ai_insight)
+		prompt_hash = (store or prompt_store).put(system_prompt)
+		current_message = HumanMessage(content=message, additional_kwargs={SYSTEM_PROMPT_REF: prompt_hash})
+		messages = [HumanMessage(content=f"{system_prompt}{FIRST_MESSAGE_SEPARATOR}{message}")]
 		logger.info(f"[DEBUG] No history, created first message with system prompt")
 	else:
-		# 履歴がある場合: システムプロンプトは最初の会話で既に送信済みなので、通常のメッセージのみ
+		# 履歴がある場合: システムプロンプトは最初の会話で決まっているので、参照を本文に戻して送る
 		current_message = HumanMessage(content=message)
-		messages = history + [current_message]
-		logger.info(f"[DEBUG] With history, messages count: {len(messages)}")
+		logger.info(f"[DEBUG] With history, messages count: {len(history) + 1}")
 		
 		# 履歴が長すぎる場合は最新のメッセージのみを保持（Gemini 2.5 Flashの空レスポンス対策）
-		if len(messages) > LLM_HISTORY_LIMIT:
-			# 最初のメッセージ（システムプロンプト含む）と最新のN件を保持
-			first_message = messages[0]
-			recent_messages = messages[-(LLM_HISTORY_LIMIT - 1):]
-			messages = [first_message] + recent_messages
+		if len(history) + 1 > LLM_HISTORY_LIMIT:
+			# 最初のメッセージ（システムプロンプト含む）と最新のN件だけをLangChainのメッセージにする
+			keep = LLM_HISTORY_LIMIT - 2
+			window = [history[0]] + (list(history[len(history) - keep:]) if keep > 0 else [])
+			messages = _expand_or_rebuild(window, store, prompt_file, ai_insight) + [current_message]
 			logger.info(f"[INFO] History truncated to {len(messages)} messages (limit: {LLM_HISTORY_LIMIT})")
+		else:
+			messages = _expand_or_rebuild(list(history), store, prompt_file, ai_insight) + [current_message]
 	
 	logger.info(f"[DEBUG] Final messages for LangGraph: {len(messages)} messages")
 	
@@ -502,14 +640,14 @@ def llm_chat(
 	
 	try:
 		while retry_count < LLM_MAX_RETRIES:
-			# 初期ステートに search_results は空で渡すが、
-			# 実際のデータ管理はツール内のクロージャ変数が担うため、
-			# StateGraph上の search_results は実質ダミーまたはログ用となる
-			result = app.invoke({
-				"messages": messages,
-				"search_results": {},
-				"recommended_books": []
-			})
+			if retry_count > 0:
+				# 破棄した試行で送った "token" をクライアントが取り消せるよう、やり直す前に通知する
+				turn_state.emit("retry", {"attempt": retry_count + 1})
+			config = {"configurable": {TURN_STATE_KEY: turn_state}}
+			if on_event is None:
+				result = app.invoke({"messages": messages}, config=config)
+			else:
+				result = _stream_agent(app, messages, config, turn_state)
 			
 			# デバッグ: 結果の詳細をログ出力
 			logger.info(f"[DEBUG] LangGraph result keys: {list(result.keys())}")
@@ -524,20 +662,7 @@ def llm_chat(
 			ai_messages = [msg for msg in result["messages"] if isinstance(msg, AIMessage)]
 			if ai_messages:
 				last_message = ai_messages[-1]
-				# contentが文字列でない場合の処理
-				if isinstance(last_message.content, str):
-					response_text = last_message.content
-				elif isinstance(last_message.content, list):
-					# contentがリストの場合、テキスト部分を抽出
-					text_parts = []
-					for part in last_message.content:
-						if isinstance(part, dict) and 'text' in part:
-							text_parts.append(part['text'])
-						elif isinstance(part, str):
-							text_parts.append(part)
-					response_text = ''.join(text_parts) if text_parts else str(last_message.content)
-				else:
-					response_text = str(last_message.content)
+				response_text = _message_text(last_message.content)
 				
 				# 空の応答でなければ成功
 				if response_text.strip():
@@ -581,10 +706,10 @@ def llm_chat(
 			response_text = "申し訳ございません。応答の生成中にエラーが発生しました。もう一度お試しください。"
 			ai_message = AIMessage(content=response_text)
 		
-		updated_history = history + [current_message, ai_message]
+		updated_history = _append_turn(history, [current_message, ai_message])
 		
-		# 推薦された書籍を取得 (クロージャ変数から)
-		recommended_books = list(recommended_books_state)
+		# 推薦された書籍を取得（このターンのTurnStateから）
+		recommended_books = list(turn_state.recommended_books)
 		
 		return response_text, updated_history, recommended_books, current_expression
 		
@@ -598,9 +723,9 @@ def llm_chat(
 		# エラー時も履歴オブジェクトを返す
 		ai_message = AIMessage(content=error_message)
 		if 'current_message' in locals():
-			updated_history = history + [current_message, ai_message]
+			updated_history = _append_turn(history, [current_message, ai_message])
 		else:
-			updated_history = history + [AIMessage(content=error_message)]
+			updated_history = _append_turn(history, [AIMessage(content=error_message)])
 			
 		# errorログは別で保存する → クライアント側に返すと脆弱
 		return error_message, updated_history, [], "neutral"
@@ -661,7 +786,7 @@ if __name__ == "__main__":
 	
 	print("Testing LangGraph LLM chat...")
 	# historyはBaseMessageのリスト
-	response, history, recommended_books = llm_chat(
+	response, history, recommended_books, expression = llm_chat(
 		prompt_file=str(PROMPT_LIBRARIAN),
 		message=test_message,
 		history=[]
@@ -670,6 +795,7 @@ if __name__ == "__main__":
 	print(f"\nResponse:\n{response}")
 	print(f"\nHistory length: {len(history)}")
 	print(f"\nRecommended books: {len(recommended_books)}")
+	print(f"\nExpression: {expression}")
 	
 	if recommended_books:
 		print("\n推薦された書籍:")
@@ -0,0 +1,44 @@
+# KeyedLock: user_id / session_id ごとのロック
+
+import threading
+from contextlib import contextmanager
+from typing import Dict, Hashable, Iterator, List
+
+
+class KeyedLock:
+	"""
+	キーごとに1つのRLockを貸し出す。
+	- 同じキーの hold() は直列化され、異なるキーは並行に実行できる
+	- 使用中のスレッドがいなくなったロックは削除するため、キーの数だけ増え続けることはない
+	- RLockなので、同じスレッドからの入れ子の hold() はブロックしない
+	"""
+
+	def __init__(self):
+		self._guard = threading.Lock()
+		# キー → [RLock, 参照数]
+		self._locks: Dict[Hashable, List] = {}
+
+	@contextmanager
+	def hold(self, key: Hashable) -> Iterator[None]:
+		with self._guard:
+			entry = self._locks.get(key)
+			if entry is None:
+				entry = self._locks[key] = [threading.RLock(), 0]
+			entry[1] += 1
+		try:
+			with entry[0]:
+				yield
+		finally:
+			with self._guard:
+				entry[1] -= 1
+				if entry[1] == 0:
+					del self._locks[key]
+
+	def __len__(self) -> int:
+		"""使用中のキーの数。"""
+		with self._guard:
+			return len(self._locks)
+
+
+class LockTimeout(TimeoutError):
+	"""ワーカー間のロックを時間内に取得できなかった（他のワーカーが同じセッションを処理中）。"""
@@ -30,6 +30,19 @@ class ChatResponse(BaseModel):
 	recommended_books: List[dict] = Field(default_factory=list, description="推薦された書籍リスト")
 	expression: str = Field("none", description="司書の表情ステータス")
 
+class SessionSummary(BaseModel):
+	session_id: str = Field(description="Session ID")
+	status: ChatStatus = Field(description="Chat status")
+	last_accessed: datetime = Field(description="Last accessed time")
+	summary: Optional[str] = Field(None, description="AI-generated summary at session end")
+
+class SessionListResponse(BaseModel):
+	user_id: str
+	total: int = Field(description="Number of sessions of the user")
+	offset: int
+	limit: int
+	sessions: List[SessionSummary] = Field(default_factory=list, description="Sessions, most recently accessed first (without messages)")
+
 # Data Models
 # Message Class : 廃止, LangChainの方へ合わせる
 
@@ -40,6 +53,7 @@ class NfcUser(BaseModel):
 class BookData(BaseModel):
 	isbn: str = Field(alias="_id", description="ISBN")
 	title: str = Field(description="Book title")
+	genre: Optional[str] = Field(None, description="Book genre (e.g. Rakuten booksGenreId)")
 
 class RecommendationLogEntry(BaseModel):
 	reason: str = Field(description="Reason for recommendation")
@@ -60,7 +74,7 @@ class User(BaseModel):
 	status: UserStatus = Field(default=UserStatus.logout, description="User status (activate/logout/chatting)")
 	active_session: Optional[str] = Field(default=None, description="Active chat session ID")
 	old_session: List[str] = Field(default_factory=list, description="Old chat session IDs")
-	recommend_log: List[RecommendationLogEntry] = Field(default_factory=list, description="Recommendation log")
+	recommend_log: List[RecommendationLogEntry] = Field(default_factory=list, description="Legacy embedded recommendation log (moved to RecommendationLog on load)")
 	lastlogin: datetime = Field(default_factory=datetime.now, description="Last login time")
 
 	class Config:
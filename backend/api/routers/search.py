@@ -1,4 +1,5 @@
 from fastapi import APIRouter, HTTPException, Depends
+import asyncio
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 import logging
 from backend import PROMPTS_DIR
@@ -15,7 +16,7 @@ from backend.search.rakuten_books import rakuten_search_books_random as search_b
 
 # Firebase認証 & AIチャット
 from firebase_admin import auth
-from backend.api.llm import llm_chat as chat_function
+from backend.api.llm import llm_chat as chat_function, run_in_llm_pool
 
 logger = logging.getLogger("uvicorn.error")
 
@@ -57,8 +58,9 @@ async def search_books_endpoint(
     if semantic:
         try:
             if PROMPT_KEYWORD_SEARCH.exists():
-                extracted_keyword, _, _ = chat_function(
-                    str(PROMPT_KEYWORD_SEARCH), q, [], ai_insight=""
+                # LLM呼び出しはイベントループを塞がないようLLM用のスレッドプールで実行する
+                extracted_keyword, _, _, _ = await run_in_llm_pool(
+                    chat_function, str(PROMPT_KEYWORD_SEARCH), q, [], ai_insight=""
                 )
                 extracted_keyword = extracted_keyword.strip()
                 if extracted_keyword:
@@ -75,8 +77,8 @@ async def search_books_endpoint(
         if not keywords:
             return []
             
-        # ★ここで「豪華版（ランダム）」関数を呼び出す
-        books = search_books_random(keywords)
+        # ★ここで「豪華版（ランダム）」関数を呼び出す（requestsで同期通信するためスレッドで実行）
+        books = await asyncio.to_thread(search_books_random, keywords)
         return books
         
     except Exception as e:
@@ -98,7 +100,7 @@ async def search_libraries_endpoint(
     ユーザーの住所判定はフロントエンド側で行われているため、ここでは受け取ったprefをそのまま使う。
     """
     try:
-        return search_libraries(pref, limit)
+        return await asyncio.to_thread(search_libraries, pref, limit)
     except Exception as e:
         logger.error(f"[ERROR] Library search failed: {e}")
         raise HTTPException(status_code=500, detail=str(e))
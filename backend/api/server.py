@@ -1,20 +1,25 @@
 # FastAPI Server for LiVraria
 
 from backend import PROMPTS_DIR, FIREBASE_ACCOUNT_KEY_PATH, DATA_DIR, USERS_FILE, CONVERSATIONS_FILE, NFC_USERS_FILE, PROMPT_DEFAULT, PROMPT_LIBRARIAN
+from backend import ARCHIVE_INTERVAL, SESSION_EVENTS_KEEPALIVE
 import logging
-from fastapi import FastAPI, HTTPException, BackgroundTasks, Depends
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Depends, Query, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 import os
 import uvicorn
 import asyncio
+import json
+from typing import Optional
 
 
-from .models import ChatRequest, ChatResponse, Personal, ChatStatus, UserStatus, NfcIdRequest
+from .models import ChatRequest, ChatResponse, Personal, ChatStatus, UserStatus, NfcIdRequest, SessionListResponse
 from .datastore import DataStore
-from .llm import llm_chat
+from .locks import LockTimeout
+from .events import SessionEventHub
+from .llm import llm_chat, history_view, run_in_llm_pool, warm_llm_clients
 from . import LLM_BACKEND
-from langchain_core.messages import messages_to_dict
 
 # 検索機能
 from backend.api.routers import search
@@ -38,8 +43,19 @@ async def startup_event():
 	else:
 		logger.info("🤖 [LLM Backend] Using Gemini API")
 
+	# LLMクライアントの作成と接続を最初のターンより前に済ませる（起動は待たせない）
+	asyncio.create_task(warm_llm())
 	# バックグラウンドでタイムアウト監視を開始
 	asyncio.create_task(monitor_timeouts())
+	# 古い会話のアーカイブとTTL削除
+	asyncio.create_task(monitor_archive())
+
+async def warm_llm():
+	"""LLMクライアントとエージェントを作り、エンドポイントへの接続を張っておく。失敗しても最初のターンで作り直す。"""
+	try:
+		await run_in_llm_pool(warm_llm_clients, LLM_BACKEND)
+	except Exception as e:
+		logger.warning(f"[WARNING] LLM warm-up failed: {e}")
 
 async def monitor_timeouts():
 	"""
@@ -47,13 +63,30 @@ async def monitor_timeouts():
 	"""
 	while True:
 		try:
-			# ブロッキング処理（LLM呼び出し含む）なのでスレッドで実行
-			await asyncio.to_thread(data_store.check_user_timeout)
+			# 期限切れのユーザーのセッションをclose（ファイルI/Oを含むのでスレッドで実行）
+			closed_sessions = await asyncio.to_thread(data_store.check_user_timeout)
+			for session_id in closed_sessions:
+				server.events.publish(session_id, "closed", {"session_id": session_id})
+			# summary/ai_insightの生成（LLM呼び出し）はcloseとは別に1件ずつ実行
+			for session_id in closed_sessions:
+				await run_in_llm_pool(data_store.generate_summary_and_insights, session_id)
 		except Exception as e:
 			logger.error(f"[ERROR] Timeout monitor failed: {e}")
 		
 		await asyncio.sleep(60)
 
+async def monitor_archive():
+	"""
+	ARCHIVE_INTERVAL秒ごとに古いclosedの会話をアーカイブし、TTLを過ぎたデータを削除するバックグラウンドタスク
+	"""
+	while True:
+		try:
+			await asyncio.to_thread(data_store.archive_conversations)
+		except Exception as e:
+			logger.error(f"[ERROR] Archive monitor failed: {e}")
+		
+		await asyncio.sleep(ARCHIVE_INTERVAL)
+
 
 # CORS設定（フロントエンドからのアクセスを許可）
 # 開発環境のオリジン（デフォルト）
@@ -81,6 +114,12 @@ app.add_middleware(
 	allow_headers=["*"],
 )
 
+# 複数ワーカー構成で、同じセッション・ユーザーを他のワーカーが処理中のまま待ちきれなかった場合
+@app.exception_handler(LockTimeout)
+async def lock_timeout_handler(request, exc: LockTimeout):
+	logger.warning(f"[WARNING] Lock timeout: {exc}")
+	return JSONResponse(status_code=409, content={"detail": "Session is busy"})
+
 # Firebase Auth
 try:
 	if FIREBASE_ACCOUNT_KEY_PATH.exists():
@@ -108,19 +147,29 @@ def get_current_user_id(credentials: HTTPAuthorizationCredentials = Depends(oaut
 		logger.error(f"[ERROR] Firebase authentication failed: {e}")
 		raise HTTPException(status_code=401, detail="Invalid authentication token")
 
+# Server-Sent Events
+# プロキシでバッファリングされないようにする
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+def sse_event(event: str, data: dict) -> str:
+	"""Server-Sent Eventsの1イベント分の文字列"""
+	return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
 class Server:
 	"""
 	Server クラス: FastAPI ルートを束ね、DataStore を用いてセッション管理を行う
 	"""
-	def __init__(self, app: FastAPI, data_store: DataStore):
+	def __init__(self, app: FastAPI, data_store: DataStore, events: Optional[SessionEventHub] = None):
 		self.app = app
 		self.data_store = data_store
+		# セッションごとのエージェントのイベント（GET /sessions/{session_id}/events の購読者へ配信）
+		self.events = events if events is not None else SessionEventHub()
 		self._register_routes()
 
 	def _register_routes(self):
 		@self.app.get("/")
 		async def read_root(user_id: str = Depends(get_current_user_id)):
-			name = self.data_store.get_user(user_id).personal.name
+			name = (await asyncio.to_thread(self.data_store.get_user, user_id)).personal.name
 			return f"Hello, {name}! The LiVraria API server is running."
 
 		# User Endpoints
@@ -129,7 +178,7 @@ class Server:
 			"""
 			ユーザーを作成する（RESTful）。
 			"""
-			user = self.data_store.create_user(user_id, personal)
+			user = await asyncio.to_thread(self.data_store.create_user, user_id, personal)
 			return {"detail": "User created successfully", "user": user}
 		
 		@self.app.get("/users/{user_id}")
@@ -142,7 +191,7 @@ class Server:
 			if user_id != current_user_id:
 				raise HTTPException(status_code=403, detail="Forbidden")
 			
-			user = self.data_store.get_user(user_id)
+			user = await asyncio.to_thread(self.data_store.get_user, user_id)
 			if not user:
 				raise HTTPException(status_code=404, detail="User not found")
 			
@@ -159,7 +208,7 @@ class Server:
 				raise HTTPException(status_code=403, detail="Forbidden")
 			
 			try:
-				user = self.data_store.update_user(user_id, **updates)
+				user = await asyncio.to_thread(self.data_store.update_user, user_id, **updates)
 				return user
 			except KeyError:
 				raise HTTPException(status_code=404, detail="User not found")
@@ -181,7 +230,7 @@ class Server:
 			if user_id != current_user_id:
 				raise HTTPException(status_code=403, detail="Forbidden")
 			
-			user = self.data_store.get_user(user_id)
+			user = await asyncio.to_thread(self.data_store.get_user, user_id)
 			if not user:
 				raise HTTPException(status_code=404, detail="User not found")
 			
@@ -189,15 +238,39 @@ class Server:
 			session_id = user.active_session
 			if session_id:
 				# セッションをクローズ（これで user.status も logout になる）
-				self.data_store.close_session(session_id)
+				# 処理中のターンがあれば終わるまで待つため、スレッドで実行する
+				await asyncio.to_thread(self.data_store.close_session, session_id)
+				self.events.publish(session_id, "closed", {"session_id": session_id})
 				# ログアウト時は非同期でインサイト生成（ユーザーを待たせない）
 				background_tasks.add_task(self.data_store.generate_summary_and_insights, session_id)
 			else:
 				# セッションがない場合はステータスのみ更新
-				self.data_store.update_user(user_id, status=UserStatus.logout)
+				await asyncio.to_thread(self.data_store.update_user, user_id, status=UserStatus.logout)
 			
 			return {"detail": "User logged out successfully"}
 
+		@self.app.get("/users/{user_id}/sessions", response_model=SessionListResponse)
+		async def list_sessions(
+			user_id: str,
+			offset: int = Query(0, ge=0),
+			limit: int = Query(20, ge=1, le=100),
+			current_user_id: str = Depends(get_current_user_id)
+		):
+			"""
+			ユーザーの会話一覧を最終アクセスの新しい順に返す（RESTful）。
+			自分自身の会話のみ取得可能。messagesは含まない（履歴は /sessions/{session_id} で取得する）。
+			"""
+			# 自分自身の情報のみ取得可能
+			if user_id != current_user_id:
+				raise HTTPException(status_code=403, detail="Forbidden")
+			
+			# 初回は会話をstorageから読むことがあるため、スレッドで実行する
+			result = await asyncio.to_thread(self.data_store.list_sessions, user_id, offset, limit)
+			if result is None:
+				raise HTTPException(status_code=404, detail="User not found")
+			total, sessions = result
+			return SessionListResponse(user_id=user_id, total=total, offset=offset, limit=limit, sessions=sessions)
+
 		# NFC Authentication Endpoints
 		@self.app.post("/nfc/auth")
 		async def nfc_auth(request: NfcIdRequest):
@@ -206,11 +279,11 @@ class Server:
 			認証不要（NFCタグの物理的所持が前提）。
 			"""
 			nfc_id = request.nfc_id
-			user_id = self.data_store.get_user_by_nfc(nfc_id)
+			user_id = await asyncio.to_thread(self.data_store.get_user_by_nfc, nfc_id)
 			if user_id is None:
 				raise HTTPException(status_code=404, detail="NFC ID not registered")
 			
-			user = self.data_store.get_user(user_id)
+			user = await asyncio.to_thread(self.data_store.get_user, user_id)
 			if user is None:
 				raise HTTPException(status_code=404, detail="User not found")
 			
@@ -232,7 +305,7 @@ class Server:
 			"""
 			try:
 				nfc_id = request.nfc_id
-				nfc_user = self.data_store.register_nfc(nfc_id, user_id)
+				nfc_user = await asyncio.to_thread(self.data_store.register_nfc, nfc_id, user_id)
 				return {
 					"detail": "NFC registered successfully",
 					"nfc_id": nfc_id,
@@ -248,11 +321,11 @@ class Server:
 			"""
 			# 認証チェック: このNFC IDが本当にこのユーザーのものか確認
 			nfc_id = request.nfc_id
-			registered_user_id = self.data_store.get_user_by_nfc(nfc_id)
+			registered_user_id = await asyncio.to_thread(self.data_store.get_user_by_nfc, nfc_id)
 			if registered_user_id != user_id:
 				raise HTTPException(status_code=404, detail="NFC ID not found")
 			
-			self.data_store.unregister_nfc(nfc_id)
+			await asyncio.to_thread(self.data_store.unregister_nfc, nfc_id)
 			return {"detail": "NFC unregistered successfully"}
 		
 		@self.app.get("/users/{user_id}/nfc")
@@ -264,16 +337,28 @@ class Server:
 			if user_id != current_user_id:
 				raise HTTPException(status_code=403, detail="Forbidden")
 				
-			nfc_id = self.data_store.get_nfc_by_user_id(user_id)
+			nfc_id = await asyncio.to_thread(self.data_store.get_nfc_by_user_id, user_id)
 			if nfc_id is None:
 				return {"nfc_id": None}
 				
 			return {"nfc_id": nfc_id}
 		
+		# Monitoring Endpoints
+		@self.app.get("/stats/memory")
+		async def memory_stats(user_id: str = Depends(get_current_user_id)):
+			"""
+			DataStoreがメモリ上に保持している件数と追い出しのカウンタを返す（認証必須）。
+			"""
+			return await asyncio.to_thread(self.data_store.memory_stats)
+		
 		
 		@self.app.on_event("shutdown")
 		async def shutdown_event():
 			"""サーバー終了時に全アクティブセッションを一時停止して保存"""
+			# 複数ワーカー構成では会話は随時保存されており、他のワーカーが処理を続けるためpauseしない
+			if self.data_store.shared:
+				self.data_store.close()
+				return
 			logger.info("[INFO] Server shutdown: Saving active sessions...")
 			session_ids = list(self.data_store.sessions.keys())
 			# タイムアウト回避のため、各セッションの処理をtry-exceptで囲む
@@ -295,6 +380,7 @@ class Server:
 				except Exception as e:
 					logger.error(f"[ERROR] Session save failed: {session_id}, Error: {e}")
 			logger.info(f"[SUCCESS] Saved {len(session_ids)} session(s)")
+			self.data_store.close()
 
 		# Session Endpoints
 		@self.app.get("/sessions/{session_id}")
@@ -303,11 +389,12 @@ class Server:
 			セッション情報を取得する（RESTful）。
 			"""
 			# user_idとsession_idの組み合わせをチェック
-			if not self.data_store.has_user_session(user_id, session_id):
+			if not await asyncio.to_thread(self.data_store.has_user_session, user_id, session_id):
 				raise HTTPException(status_code=404, detail="Session not found")
 			
-			history_objs = self.data_store.get_history(session_id)
-			history_dicts = messages_to_dict(history_objs)
+			# システムプロンプトを除いた履歴を返す
+			# （保存済みの会話はdictのまま返し、LangChainのオブジェクトを経由しない）
+			history_dicts = history_view(await asyncio.to_thread(self.data_store.get_history_dicts, session_id))
 			return {"session_id": session_id, "history": history_dicts}
 
 		@self.app.post("/sessions/{session_id}/messages", status_code=201)
@@ -322,25 +409,85 @@ class Server:
 			session_id="new"の場合は新規セッション作成。
 			mode: "default" または "librarian"
 			"""
-			# モードに応じたプロンプトファイルを選択
-			if mode == "librarian":
-				prompt_path = PROMPT_LIBRARIAN
-			else:
-				prompt_path = PROMPT_DEFAULT
-			
-			if not prompt_path.exists():
-				raise HTTPException(status_code=500, detail=f"Prompt file not found")
-			
-			# 新規セッション作成の場合
-			if session_id == "new":
-				request.session_id = None  # chat_promptで新規作成させる
-			else:
-				# 既存セッションの認証チェック
-				if not self.data_store.has_user_session(user_id, session_id):
-					raise HTTPException(status_code=404, detail="Session not found")
-				request.session_id = session_id
-			
-			return await self.chat_prompt(request, str(prompt_path), user_id)
+			prompt_path = await asyncio.to_thread(self._prepare_message, session_id, request, mode, user_id)
+			return await self.chat_prompt(request, prompt_path, user_id)
+
+		@self.app.post("/sessions/{session_id}/messages/stream")
+		async def send_message_stream(
+			session_id: str,
+			request: ChatRequest,
+			mode: str = "default",
+			user_id: str = Depends(get_current_user_id)
+		):
+			"""
+			メッセージを送信し、応答を生成しながらServer-Sent Eventsで返す（POST /sessions/{session_id}/messages のストリーミング版）。
+			イベント: session → token（生成中のテキスト）/ expression / recommended_books → done（ChatResponseと同じ内容） または error
+			"""
+			prompt_path = await asyncio.to_thread(self._prepare_message, session_id, request, mode, user_id)
+
+			async def event_stream():
+				async for event, data in self.stream_chat(request, prompt_path, user_id):
+					yield sse_event(event, data)
+
+			return StreamingResponse(event_stream(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+		@self.app.websocket("/sessions/{session_id}/messages/ws")
+		async def send_message_ws(websocket: WebSocket, session_id: str):
+			"""
+			WebSocketでメッセージを送信し、応答をストリーミングで受け取る（1つの接続で複数ターン）。
+			ブラウザのWebSocketはヘッダーを付けられないため、最初のメッセージでIDトークンを送る。
+			  クライアント → {"token": "...", "message": "...", "mode": "default"}（2回目以降は token 不要）
+			  サーバー → {"event": "...", "data": {...}}（イベントはSSE版と同じ）
+			"""
+			await websocket.accept()
+			user_id = None
+			try:
+				while True:
+					payload = await websocket.receive_json()
+					try:
+						if user_id is None:
+							user_id = get_current_user_id(HTTPAuthorizationCredentials(scheme="Bearer", credentials=payload.get("token", "")))
+						request = ChatRequest(message=str(payload.get("message", "")))
+						prompt_path = await asyncio.to_thread(self._prepare_message, session_id, request, payload.get("mode", "default"), user_id)
+					except HTTPException as e:
+						await websocket.send_json({"event": "error", "data": {"status_code": e.status_code, "detail": e.detail}})
+						if user_id is None:
+							await websocket.close(code=1008)
+							return
+						continue
+					async for event, data in self.stream_chat(request, prompt_path, user_id):
+						await websocket.send_json({"event": event, "data": data})
+						if event == "done":
+							# 新規セッションの場合、次のターンは作成されたセッションに送る
+							session_id = data["session_id"]
+			except WebSocketDisconnect:
+				pass
+
+		@self.app.get("/sessions/{session_id}/events")
+		async def session_events(session_id: str, user_id: str = Depends(get_current_user_id)):
+			"""
+			セッションのエージェントのイベントをServer-Sent Eventsで受け取る（セカンドディスプレイ向け）。
+			どのエンドポイントから送られたターンでも、ツールの実行時点で届く（生成中のテキストは含まない）。
+			イベント: turn_started → search_started / books_found / recommended_books / expression → done（ChatResponse）
+			セッションがcloseされると closed を送って終了する。
+			"""
+			if not await asyncio.to_thread(self.data_store.has_user_session, user_id, session_id):
+				raise HTTPException(status_code=404, detail="Session not found")
+
+			async def event_stream():
+				with self.events.subscription(session_id) as queue:
+					while True:
+						try:
+							event, data = await asyncio.wait_for(queue.get(), SESSION_EVENTS_KEEPALIVE)
+						except asyncio.TimeoutError:
+							# イベントがない間もプロキシに接続を切られないようにする
+							yield ": keepalive\n\n"
+							continue
+						yield sse_event(event, data)
+						if event == "closed":
+							return
+
+			return StreamingResponse(event_stream(), media_type="text/event-stream", headers=SSE_HEADERS)
 
 		@self.app.post("/sessions/{session_id}/close")
 		async def close_session(
@@ -353,12 +500,13 @@ class Server:
 			summary/ai_insightの生成は非同期で実行される。
 			"""
 			# user_idとsession_idの組み合わせをチェック
-			if not self.data_store.has_user_session(user_id, session_id):
+			if not await asyncio.to_thread(self.data_store.has_user_session, user_id, session_id):
 				raise HTTPException(status_code=404, detail="Session not found")
 			
 			try:
-				# セッションをクローズ（同期処理）
-				self.data_store.close_session(session_id)
+				# セッションをクローズ（処理中のターンがあれば終わるまで待つため、スレッドで実行）
+				await asyncio.to_thread(self.data_store.close_session, session_id)
+				self.events.publish(session_id, "closed", {"session_id": session_id})
 				# summary/ai_insightの生成をバックグラウンドタスクで実行（非同期処理）
 				background_tasks.add_task(self.data_store.generate_summary_and_insights, session_id)
 			except KeyError:
@@ -372,36 +520,109 @@ class Server:
         )
 
 
-	async def chat_prompt(self, request: ChatRequest, prompt_file: str, user_id: str) -> ChatResponse:
+	def _prepare_message(self, session_id: str, request: ChatRequest, mode: str, user_id: str) -> str:
+		"""
+		メッセージ送信の前処理。モードに応じたプロンプトファイルを選び、request.session_id を設定する。
+		session_id="new"の場合は新規セッション作成。
+		ユーザーのロックを取るため、イベントループからは asyncio.to_thread で呼ぶ。
+		"""
+		# モードに応じたプロンプトファイルを選択
+		if mode == "librarian":
+			prompt_path = PROMPT_LIBRARIAN
+		else:
+			prompt_path = PROMPT_DEFAULT
+		
+		if not prompt_path.exists():
+			raise HTTPException(status_code=500, detail=f"Prompt file not found")
+		
+		# 新規セッション作成の場合
+		if session_id == "new":
+			request.session_id = None  # chat_promptで新規作成させる
+		else:
+			# 既存セッションの認証チェック
+			if not self.data_store.has_user_session(user_id, session_id):
+				raise HTTPException(status_code=404, detail="Session not found")
+			request.session_id = session_id
+		return str(prompt_path)
+
+	async def chat_prompt(self, request: ChatRequest, prompt_file: str, user_id: str, on_event=None) -> ChatResponse:
+		# LLM呼び出しを含む1ターンをLLM用のスレッドプールで実行する（イベントループを塞がない）
+		# ロック（user_lock / session_lock）はスレッドのロックのため、1ターン全体を同じスレッドで実行する
+		return await run_in_llm_pool(self._chat_turn, request, prompt_file, user_id, on_event)
+
+	async def stream_chat(self, request: ChatRequest, prompt_file: str, user_id: str):
+		"""
+		1ターンを実行し、途中経過のイベント (イベント名, データ) を発生した順に返す。
+		最後は "done"（ChatResponseの内容） または "error"。
+		クライアントが途中で切断しても、ターンは最後まで実行して履歴を保存する。
+		"""
+		loop = asyncio.get_running_loop()
+		queue: asyncio.Queue = asyncio.Queue()
+
+		def on_event(event: str, data: dict):
+			# LLM用のスレッドから呼ばれるため、イベントループ側でキューに入れる
+			loop.call_soon_threadsafe(queue.put_nowait, (event, data))
+
+		async def run_turn():
+			try:
+				response = await self.chat_prompt(request, prompt_file, user_id, on_event)
+				queue.put_nowait(("done", response.model_dump()))
+			except HTTPException as e:
+				queue.put_nowait(("error", {"status_code": e.status_code, "detail": e.detail}))
+			except LockTimeout as e:
+				logger.warning(f"[WARNING] Lock timeout: {e}")
+				queue.put_nowait(("error", {"status_code": 409, "detail": "Session is busy"}))
+			except Exception as e:
+				logger.error(f"[ERROR] Streaming chat failed: {e}")
+				queue.put_nowait(("error", {"status_code": 500, "detail": "Internal server error"}))
+			finally:
+				queue.put_nowait(None)
+
+		task = asyncio.create_task(run_turn())
+		while True:
+			item = await queue.get()
+			if item is None:
+				break
+			yield item
+		await task
+
+	def _chat_turn(self, request: ChatRequest, prompt_file: str, user_id: str, on_event=None) -> ChatResponse:
 		
 		# セッション確保
 		session_id = request.session_id
 		logger.info(f"[DEBUG] chat_prompt: request.session_id = {session_id}")
 		
-		# session_idが指定されていない場合、ユーザーの既存のアクティブセッションを探す
-		if session_id is None:
-			user = self.data_store.get_user(user_id)
-			if user and user.active_session and self.data_store.has_session(user.active_session):
-				# 既存セッションを再開
-				session_id = user.active_session
-				logger.info(f"[INFO] Resuming existing session: {session_id}")
-				# pause状態ならactiveに戻す
-				self.data_store.resume_session(session_id)
-			else:
-				# 既存セッションがなければ新規作成
-				session_id = self.data_store.create_session(user_id)
-				logger.info(f"[INFO] Created new session: {session_id}")
-			
-			# 履歴を取得（新規なら空）
-			if self.data_store.has_session(session_id):
-				history = self.data_store.get_history(session_id)
-			else:
-				history = []
-		else:
-			if not self.data_store.has_session(session_id):
+		# 同じユーザーの同時リクエストがそれぞれ新しいセッションを作らないよう、ユーザー単位で直列化する
+		with self.data_store.user_lock(user_id):
+			# session_idが指定されていない場合、ユーザーの既存のアクティブセッションを探す
+			if session_id is None:
+				user = self.data_store.get_user(user_id)
+				if user and user.active_session and self.data_store.has_session(user.active_session):
+					# 既存セッションを再開
+					session_id = user.active_session
+					logger.info(f"[INFO] Resuming existing session: {session_id}")
+					# pause状態ならactiveに戻す
+					self.data_store.resume_session(session_id)
+				else:
+					# 既存セッションがなければ新規作成
+					session_id = self.data_store.create_session(user_id)
+					logger.info(f"[INFO] Created new session: {session_id}")
+			elif not self.data_store.has_session(session_id):
 				raise HTTPException(status_code=404, detail="Session not found")
-			
-			history = self.data_store.get_history(session_id)
+
+		if on_event is not None:
+			on_event("session", {"session_id": session_id})
+
+		# ツールのイベントはセッションのイベントの購読者にも配信する（生成中のテキストとその取り消しは除く）
+		if self.events.has_subscribers(session_id):
+			self.events.publish(session_id, "turn_started", {"session_id": session_id})
+			stream_event = on_event
+
+			def on_event(event: str, data: dict):
+				if stream_event is not None:
+					stream_event(event, data)
+				if event not in ("token", "retry"):
+					self.events.publish(session_id, event, data)
 
 		# ユーザーの ai_insights と personal 情報を取得して LLM に渡す
 		ai_insight = ""
@@ -429,28 +650,37 @@ class Server:
 					else:
 						ai_insight = ai_insights_text
 
-		# LLMバックエンドを使用してチャット
-		# llm_chatは (response_text, new_history, recommended_books, current_expression) を返す
-		response_text, new_history, recommended_books, current_expression = llm_chat(
-			prompt_file, 
-			request.message, 
-			history, 
-			ai_insight=ai_insight
-		)
+		# 同じセッションへの同時リクエストは1ターンずつ処理する（履歴の更新が失われないように）
+		with self.data_store.session_lock(session_id):
+			# 履歴を取得（新規なら空）
+			history = self.data_store.get_history(session_id)
 
-		# メモリ上の履歴を更新（ディスク書き込みは close_session 時に行う）
-		self.data_store.update_history(session_id, new_history)
+			# LLMバックエンドを使用してチャット
+			# llm_chatは (response_text, new_history, recommended_books, current_expression) を返す
+			response_text, new_history, recommended_books, current_expression = llm_chat(
+				prompt_file, 
+				request.message, 
+				history, 
+				ai_insight=ai_insight,
+				store=self.data_store.prompts,
+				on_event=on_event
+			)
+
+			# メモリ上の履歴を更新（ディスク書き込みは close_session 時に行う）
+			self.data_store.update_history(session_id, new_history)
 		
 		logger.info(f"[DEBUG] chat_prompt returning session_id: {session_id}")
 		logger.info(f"[DEBUG] recommended_books count: {len(recommended_books)}")
 		logger.info(f"[DEBUG] current_expression: {current_expression}")
 
-		return ChatResponse(
+		response = ChatResponse(
 			response=response_text, 
 			session_id=session_id,
 			recommended_books=recommended_books,
 			expression=current_expression
 		)
+		self.events.publish(session_id, "done", response.model_dump())
+		return response
 
 
 # DataStoreインスタンスを作成
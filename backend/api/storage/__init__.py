@@ -0,0 +1,48 @@
+"""
+DataStoreの永続化バックエンド
+環境変数 DATASTORE_BACKEND で切り替える（json / wal / sqlite / sharded / snapshot / mongodb）
+"""
+from typing import Optional
+
+from .base import Storage
+from .json_file import JsonStorage
+from .wal import WalStorage
+from .sqlite import SqliteStorage
+from .sharded import ShardedStorage
+from .snapshot import SnapshotStorage, convert_json_to_snapshot
+from .mongodb import MongoStorage
+from .write_behind import WriteBehindStorage
+from .prompts import PromptStore, PromptNotFound
+from .archive import ConversationArchive
+from .recommend_log import RecommendationLog
+from .turn_log import TurnLog
+from .leases import SqliteLeases
+
+from backend import DATASTORE_BACKEND
+
+STORAGE_BACKENDS = {
+	JsonStorage.name: JsonStorage,
+	WalStorage.name: WalStorage,
+	SqliteStorage.name: SqliteStorage,
+	ShardedStorage.name: ShardedStorage,
+	SnapshotStorage.name: SnapshotStorage,
+	MongoStorage.name: MongoStorage,
+}
+
+
+def create_storage(backend: Optional[str] = None, **kwargs) -> Storage:
+	"""
+	バックエンド名からStorageインスタンスを作成する。
+	backendを省略した場合は DATASTORE_BACKEND を使う。
+	"""
+	if backend is None:
+		backend = DATASTORE_BACKEND
+	if backend not in STORAGE_BACKENDS:
+		raise ValueError(
+			f"Unknown DATASTORE_BACKEND: '{backend}'\n"
+			f"Hint: choose one of {', '.join(STORAGE_BACKENDS)}"
+		)
+	return STORAGE_BACKENDS[backend](**kwargs)
+
+
+__all__ = ['Storage', 'JsonStorage', 'WalStorage', 'SqliteStorage', 'ShardedStorage', 'SnapshotStorage', 'MongoStorage', 'WriteBehindStorage', 'PromptStore', 'PromptNotFound', 'ConversationArchive', 'RecommendationLog', 'TurnLog', 'SqliteLeases', 'STORAGE_BACKENDS', 'create_storage', 'convert_json_to_snapshot']
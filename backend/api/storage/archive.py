@@ -0,0 +1,226 @@
+# ConversationArchive: closedの会話を圧縮して追記専用のセグメントへ移すアーカイブ
+
+import json
+import logging
+import os
+import threading
+import zlib
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from ..models import Conversation
+
+from backend import DATA_DIR, ARCHIVE_SEGMENT_SIZE, WAL_FSYNC
+
+# ロガー設定
+logger = logging.getLogger("uvicorn.error")
+
+
+class ConversationArchive:
+	"""
+	archive/ ディレクトリに以下を置く。
+	  segment-<番号>.bin … 会話1件ごとにzlib圧縮したJSONを連結したもの（追記のみ）
+	  index.jsonl        … 追記専用のインデックス
+	                        {"op": "add", "_id", "user_id", "segment", "offset", "length", "last_accessed"}
+	                        {"op": "delete", "_id"}
+	                        {"op": "segment", "segment"}（インデックス書き直し時の書き込み中セグメント番号）
+	- セグメントが segment_size を超えたら次の番号のセグメントへ切り替える
+	- TTL切れの会話は purge() でインデックスから削除し、全件が消えたセグメントはファイルごと削除する
+	- 1件の読み込みはインデックスの位置情報から該当部分だけを読んで展開する
+	- 複数ワーカー構成では書き込むのは1ワーカーのみ（DataStore側でリースを取る）。
+	  他のワーカーは見つからない会話を要求された時にインデックスの続きを読んで反映する
+	"""
+
+	def __init__(self, data_dir: Path = DATA_DIR, segment_size: int = ARCHIVE_SEGMENT_SIZE, fsync: bool = WAL_FSYNC):
+		self.archive_dir = Path(data_dir, "archive")
+		self.index_file = Path(self.archive_dir, "index.jsonl")
+		self.segment_size = segment_size
+		self.fsync = fsync
+		# session_id → (segment, offset, length, last_accessed(timestamp), user_id)
+		self._entries: Dict[str, Tuple[int, int, int, float, str]] = {}
+		# segment → 有効な会話数
+		self._segment_live: Dict[int, int] = {}
+		self._segment = 0
+		self._index_lines = 0
+		# 読み込み済みのインデックスの位置（他のプロセスの追記・書き直しを検出するため）
+		self._index_pos = 0
+		self._index_ino: Optional[int] = None
+		self._lock = threading.Lock()
+		self._load_index()
+
+	def _segment_path(self, segment: int) -> Path:
+		return Path(self.archive_dir, f"segment-{segment:06d}.bin")
+
+	def _load_index(self) -> None:
+		"""
+		インデックスの未読部分を読み込む。
+		複数ワーカー構成では他のプロセスが追記・書き直しをするため、読み込み済みの位置から続きを読む。
+		"""
+		try:
+			stat = os.stat(self.index_file)
+		except FileNotFoundError:
+			return
+		if stat.st_ino != self._index_ino or stat.st_size < self._index_pos:
+			# 書き直された（別のファイルに置き換わった）場合は最初から読み直す
+			self._entries = {}
+			self._segment_live = {}
+			self._index_lines = 0
+			self._index_pos = 0
+			self._index_ino = stat.st_ino
+		if stat.st_size == self._index_pos:
+			return
+		with open(self.index_file, "rb") as f:
+			f.seek(self._index_pos)
+			for line in f:
+				# 書きかけの行（追記中・クラッシュ時）以降は次回に読む
+				if not line.endswith(b"\n"):
+					break
+				if line.strip():
+					try:
+						record = json.loads(line)
+					except Exception as e:
+						logger.warning(f"[WARNING] Archive index replay stopped at offset {self._index_pos}: {e}")
+						break
+					self._apply(record)
+					self._index_lines += 1
+				self._index_pos += len(line)
+
+	def _apply(self, record: dict) -> None:
+		if record["op"] == "add":
+			self._segment = max(self._segment, record["segment"])
+			self._add_entry(record["_id"], (
+				record["segment"], record["offset"], record["length"],
+				record["last_accessed"], record["user_id"]
+			))
+		elif record["op"] == "delete":
+			self._remove_entry(record["_id"])
+		elif record["op"] == "segment":
+			self._segment = max(self._segment, record["segment"])
+
+	def _add_entry(self, session_id: str, entry: Tuple[int, int, int, float, str]) -> None:
+		self._remove_entry(session_id)
+		self._entries[session_id] = entry
+		self._segment_live[entry[0]] = self._segment_live.get(entry[0], 0) + 1
+
+	def _remove_entry(self, session_id: str) -> Optional[int]:
+		"""エントリを削除し、そのセグメント番号を返す。"""
+		entry = self._entries.pop(session_id, None)
+		if entry is None:
+			return None
+		self._segment_live[entry[0]] -= 1
+		return entry[0]
+
+	def _append_index(self, records: List[dict]) -> None:
+		"""インデックスへ追記し、追記した分（と他のプロセスの追記）をメモリへ反映する。"""
+		with open(self.index_file, "a", encoding="utf-8") as f:
+			f.write("".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records))
+			f.flush()
+			if self.fsync:
+				os.fsync(f.fileno())
+		self._load_index()
+
+	def __contains__(self, session_id: str) -> bool:
+		return session_id in self._entries
+
+	def __len__(self) -> int:
+		return len(self._entries)
+
+	def append_many(self, conversations: Iterable[Conversation]) -> int:
+		"""
+		会話をまとめてアーカイブへ追記する。追記した件数を返す。
+		セグメントへの書き込みを終えてからインデックスに追記するため、
+		インデックスが存在しないデータを指すことはない。
+		"""
+		conversations = list(conversations)
+		if not conversations:
+			return 0
+		with self._lock:
+			self.archive_dir.mkdir(parents=True, exist_ok=True)
+			self._load_index()
+			records = []
+			f = None
+			try:
+				for conv in conversations:
+					data = zlib.compress(json.dumps(conv.model_dump(by_alias=True), default=str, ensure_ascii=False).encode("utf-8"))
+					if f is None:
+						f = open(self._segment_path(self._segment), "ab")
+					# セグメントが上限に達したら次の番号へ切り替える
+					if f.tell() >= self.segment_size:
+						f.close()
+						self._segment += 1
+						f = open(self._segment_path(self._segment), "ab")
+					offset = f.tell()
+					f.write(data)
+					records.append({
+						"op": "add", "_id": conv.session_id, "user_id": conv.user_id,
+						"segment": self._segment, "offset": offset, "length": len(data),
+						"last_accessed": conv.last_accessed.timestamp(),
+					})
+				f.flush()
+				if self.fsync:
+					os.fsync(f.fileno())
+			finally:
+				if f is not None:
+					f.close()
+			self._append_index(records)
+		return len(records)
+
+	def get(self, session_id: str) -> Optional[Conversation]:
+		"""アーカイブ済みの会話を1件読み込む。なければNone。"""
+		entry = self._entries.get(session_id)
+		if entry is None:
+			# 他のプロセスがアーカイブした会話かもしれないので、インデックスの続きを読む
+			with self._lock:
+				self._load_index()
+			entry = self._entries.get(session_id)
+			if entry is None:
+				return None
+		segment, offset, length, _, _ = entry
+		try:
+			with open(self._segment_path(segment), "rb") as f:
+				f.seek(offset)
+				data = f.read(length)
+			return Conversation(**json.loads(zlib.decompress(data)))
+		except Exception as e:
+			logger.error(f"[ERROR] Failed to read archived conversation {session_id}: {e}")
+			return None
+
+	def purge(self, cutoff: datetime) -> int:
+		"""
+		last_accessed が cutoff より前の会話を削除する。削除した件数を返す。
+		有効な会話がなくなったセグメントはファイルごと削除する。
+		"""
+		cutoff_ts = cutoff.timestamp()
+		with self._lock:
+			self._load_index()
+			expired = [session_id for session_id, entry in self._entries.items() if entry[3] < cutoff_ts]
+			if not expired:
+				return 0
+			segments = {self._entries[session_id][0] for session_id in expired}
+			self._append_index([{"op": "delete", "_id": session_id} for session_id in expired])
+			for segment in segments:
+				# 書き込み中のセグメントは残す
+				if self._segment_live.get(segment) == 0 and segment != self._segment:
+					self._segment_path(segment).unlink(missing_ok=True)
+					del self._segment_live[segment]
+			# 削除レコードが溜まったらインデックスを書き直す
+			if self._index_lines > 2 * len(self._entries) + 1000:
+				self._rewrite_index()
+		return len(expired)
+
+	def _rewrite_index(self) -> None:
+		tmp_path = self.index_file.with_name(self.index_file.name + ".tmp")
+		with open(tmp_path, "w", encoding="utf-8") as f:
+			# 書き込み中のセグメント番号（有効な会話がなくても番号を引き継ぐため）
+			f.write(json.dumps({"op": "segment", "segment": self._segment}) + "\n")
+			for session_id, (segment, offset, length, last_accessed, user_id) in self._entries.items():
+				f.write(json.dumps({
+					"op": "add", "_id": session_id, "user_id": user_id,
+					"segment": segment, "offset": offset, "length": length, "last_accessed": last_accessed,
+				}, ensure_ascii=False) + "\n")
+		os.replace(tmp_path, self.index_file)
+		stat = os.stat(self.index_file)
+		self._index_ino = stat.st_ino
+		self._index_pos = stat.st_size
+		self._index_lines = len(self._entries) + 1
@@ -0,0 +1,146 @@
+# Storage: DataStoreの永続化バックエンド共通インターフェース
+
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from ..models import ChatStatus, User, Conversation, NfcUser
+
+
+class Storage:
+	"""
+	DataStoreの永続化バックエンドの基底クラス。
+	DataStoreはメモリ上のdictを正として扱い、変更のあったレコードだけを
+	put_* / delete_* でStorageへ渡す。書き込み方式（全件書き出し、追記ログ等）は
+	各バックエンドが決める。
+	"""
+	name = "base"
+	# Trueのバックエンドは put_* を即座に書き出さない（WriteBehindStorage）。
+	# DataStoreはこの場合に限り（incremental のバックエンドなら）、アクティブな会話も更新のたびに put_conversation する
+	deferred = False
+	# Trueのバックエンドは put_conversation で該当する会話だけを書く（追記ログ・1行の更新等）。
+	# Falseのバックエンド（json）はファイル全体を書き直すため、アクティブな会話の定期保存は行わない
+	incremental = False
+
+	def load(self) -> Tuple[Dict[str, User], Dict[str, Conversation], Dict[str, NfcUser]]:
+		"""
+		起動時にデータを読み込み、(users, conversations, nfc_users) を返す。
+		closed以外の会話とその所有ユーザー、NFCの紐付けは必ず含めること。
+		それ以外を省略したバックエンドは get_user / get_conversation で個別に返す。
+		返すdictはDataStore側で自由に変更してよい（Storage内部のdictとは別物）。
+		"""
+		raise NotImplementedError
+
+	def _load_owners(self, conversations: Dict[str, Conversation]) -> Dict[str, User]:
+		"""closed以外の会話の所有ユーザーだけを読み込む（起動時用）。"""
+		users: Dict[str, User] = {}
+		for conv in conversations.values():
+			if conv.status == ChatStatus.closed or not conv.user_id or conv.user_id in users:
+				continue
+			user = self.get_user(conv.user_id)
+			if user is not None:
+				users[user.user_id] = user
+		return users
+
+	def get_user(self, user_id: str) -> Optional[User]:
+		"""永続化済みのユーザーを1件取得する。存在しなければNone。"""
+		raise NotImplementedError
+
+	def get_conversation(self, session_id: str) -> Optional[Conversation]:
+		"""永続化済みの会話を1件取得する。存在しなければNone。"""
+		raise NotImplementedError
+
+	def put_user(self, user: User) -> None:
+		"""ユーザー1件を保存する。"""
+		raise NotImplementedError
+
+	def put_conversation(self, conv: Conversation) -> None:
+		"""会話1件を保存する。"""
+		raise NotImplementedError
+
+	def put_nfc_user(self, nfc_user: NfcUser) -> None:
+		"""NFCの紐付け1件を保存する。"""
+		raise NotImplementedError
+
+	def delete_nfc_user(self, nfc_id: str) -> None:
+		"""NFCの紐付け1件を削除する。"""
+		raise NotImplementedError
+
+	def delete_conversation(self, session_id: str) -> None:
+		"""会話1件を削除する（アーカイブへ移した後などに使う）。"""
+		raise NotImplementedError
+
+	def evict_user(self, user_id: str) -> None:
+		"""
+		DataStoreがメモリから追い出したユーザーのコピーを手放す（保存済みであること）。
+		既定では何もしない。メモリ上にコピーを持つバックエンドは上書きする。
+		"""
+		pass
+
+	def evict_conversation(self, session_id: str) -> None:
+		"""
+		DataStoreが本文を追い出したclosedの会話のコピーを手放す（保存済みであること）。
+		手放した会話も get_conversation で読めること。既定では何もしない。
+		"""
+		pass
+
+	def closed_before(self, cutoff: datetime) -> List[str]:
+		"""last_accessed が cutoff より前の closed の会話のIDを返す（アーカイブ用）。"""
+		raise NotImplementedError
+
+	def put_prompt(self, prompt_hash: str, text: str) -> None:
+		"""
+		システムプロンプトを保存する（PromptStore用。キーは本文のsha256）。
+		保存済みなら最後に使われた時刻だけを更新する。
+		"""
+		raise NotImplementedError
+
+	def get_prompt(self, prompt_hash: str) -> Optional[str]:
+		"""保存済みのシステムプロンプトを取得する。存在しなければNone。"""
+		raise NotImplementedError
+
+	def delete_prompts_before(self, cutoff: datetime) -> int:
+		"""最後に使われた時刻が cutoff より前のシステムプロンプトを削除し、件数を返す（TTL用）。"""
+		raise NotImplementedError
+
+	def put_batch(
+		self,
+		users: Iterable[User] = (),
+		conversations: Iterable[Conversation] = (),
+		nfc_users: Iterable[NfcUser] = (),
+		deleted_nfc_ids: Iterable[str] = (),
+		deleted_session_ids: Iterable[str] = ()
+	) -> None:
+		"""
+		複数レコードをまとめて保存する（WriteBehindStorageのフラッシュ用）。
+		デフォルトは1件ずつ put_* / delete_* を呼ぶ。まとめて書いた方が安いバックエンドは上書きする。
+		"""
+		for user in users:
+			self.put_user(user)
+		for conv in conversations:
+			self.put_conversation(conv)
+		for nfc_user in nfc_users:
+			self.put_nfc_user(nfc_user)
+		for nfc_id in deleted_nfc_ids:
+			self.delete_nfc_user(nfc_id)
+		for session_id in deleted_session_ids:
+			self.delete_conversation(session_id)
+
+	def save_all(
+		self,
+		users: Dict[str, User],
+		conversations: Dict[str, Conversation],
+		nfc_users: Dict[str, NfcUser]
+	) -> None:
+		"""メモリ上の全データをスナップショットとして保存する。"""
+		raise NotImplementedError
+
+	def sync(self) -> None:
+		"""
+		書き出し済みのデータをディスクへ確実に反映する（fsync）。
+		既定では何もしない。ファイルに書くバックエンドは自分のファイルだけをfsyncするよう上書きする。
+		"""
+		pass
+
+	def close(self) -> None:
+		"""ファイルハンドル等を解放する。"""
+		pass
@@ -0,0 +1,51 @@
+# JSONファイルの読み書きヘルパー
+
+import json
+import os
+from pathlib import Path
+from typing import Any, Iterable, Optional
+
+
+def write_json_atomic(path: Path, data: Any, indent: Optional[int] = 2) -> None:
+	"""
+	一時ファイルに書き出してから置き換える（書き込み途中のクラッシュでファイルを壊さない）。
+	"""
+	tmp_path = path.with_name(path.name + ".tmp")
+	with open(tmp_path, 'w', encoding='utf-8') as f:
+		json.dump(data, f, indent=indent, default=str, ensure_ascii=False)
+	os.replace(tmp_path, path)
+
+
+def fsync_paths(paths: Iterable[Path]) -> None:
+	"""
+	ファイルをfsyncし、それらのディレクトリもfsyncする（置き換え・削除をディスクへ反映する）。
+	存在しないファイルは飛ばす。ディレクトリをfsyncできないOS（Windows）ではファイルのみ。
+	"""
+	directories = set()
+	for path in paths:
+		path = Path(path)
+		if path.is_file():
+			with open(path, "rb") as f:
+				os.fsync(f.fileno())
+			directories.add(path.parent)
+		elif path.is_dir():
+			directories.add(path)
+	if os.name != "posix":
+		return
+	for directory in directories:
+		fd = os.open(directory, os.O_RDONLY)
+		try:
+			os.fsync(fd)
+		finally:
+			os.close(fd)
+
+
+def read_json(path: Path, default: Any) -> Any:
+	"""JSONファイルを読み込む。存在しない・空・壊れている場合はdefaultを返す。"""
+	if not path.exists():
+		return default
+	with open(path, "r", encoding="utf-8") as f:
+		try:
+			return json.load(f)
+		except Exception:
+			return default
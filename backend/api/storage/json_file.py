@@ -0,0 +1,249 @@
+# JsonStorage: users.json / conversations.json / nfc_users.json への全件書き出し方式
+
+import json
+import logging
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Union
+
+from .base import Storage
+from .fileio import fsync_paths, read_json, write_json_atomic
+from .nfc import NfcMappingFile
+from .prompts import PromptFiles
+from ..models import ChatStatus, User, Conversation, NfcUser
+
+from backend import DATA_DIR
+
+# ロガー設定
+logger = logging.getLogger("uvicorn.error")
+
+
+def _encode(record: dict) -> str:
+	"""手放すレコードをコンパクトなJSON文字列にする。"""
+	return json.dumps(record, default=str, ensure_ascii=False, separators=(",", ":"))
+
+
+def _decode(record: Union[dict, str]) -> dict:
+	return json.loads(record) if isinstance(record, str) else record
+
+
+class JsonStorage(Storage):
+	"""
+	従来どおり3つのJSONファイルに全件を書き出すバックエンド。
+	put_* は該当する種類のファイルだけを書き直す。
+	NFCの紐付けは NfcMappingFile により1件単位の追記で保存する。
+
+	ユーザーは起動時に user_id → 未検証レコード のインデックスだけを作り、
+	get_user で要求された1件だけを User に変換する。
+	一度も読み込まれていないユーザーは書き出し時も元のレコードをそのまま使う。
+
+	DataStoreが追い出したユーザー・closedの会話（evict_*）はJSON文字列に変換して持ち、
+	モデルオブジェクトは手放す（ファイル全体を書き直すため、内容自体はメモリに残す）。
+	"""
+	name = "json"
+
+	def __init__(self, data_dir: Path = DATA_DIR):
+		self.data_dir = Path(data_dir)
+		self.data_dir.mkdir(parents=True, exist_ok=True)
+		self.users_file = Path(self.data_dir, "users.json")
+		self.conversations_file = Path(self.data_dir, "conversations.json")
+		self._nfc_file = NfcMappingFile(self.data_dir)
+		self._prompt_files = PromptFiles(self.data_dir)
+		# 書き出し対象（モデルオブジェクトはDataStoreと共有する）
+		self._users: Dict[str, User] = {}  # 読み込み済み（検証済み）のユーザー
+		self._user_records: Dict[str, Optional[Union[dict, str]]] = {}  # user_id → 未検証レコード（読み込み済みならNone）
+		self._conversations: Dict[str, Conversation] = {}
+		# 手放したclosedの会話（session_id → (last_accessed, JSON文字列。snapshotではmsgpackのバイト列)）
+		self._evicted_conversations: Dict[str, Tuple[datetime, Union[str, bytes]]] = {}
+		self._nfc_users: Dict[str, NfcUser] = {}
+		# 前回の sync() 以降に書き直した・削除したファイル（とディレクトリ）
+		self._unsynced: Set[Path] = set()
+
+	def _load_files(self) -> None:
+		"""スナップショット（3つのJSONファイル）を内部dictへ読み込む。"""
+		self._load_users()
+		self._load_conversations()
+		self._load_nfc_users()
+
+	def _load_users(self) -> None:
+		"""user_id → レコードのインデックスを作る（ここではUserへの変換は行わない）。"""
+		self._users = {}
+		self._user_records = {}
+		for user_dict in read_json(self.users_file, []):
+			user_id = user_dict.get("_id") if isinstance(user_dict, dict) else None
+			if user_id:
+				self._user_records[user_id] = user_dict
+
+	def _load_conversations(self) -> None:
+		self._evicted_conversations = {}
+		try:
+			self._conversations = {}
+			for conv_dict in read_json(self.conversations_file, {}).values():
+				conv = Conversation(**conv_dict)
+				self._conversations[conv.session_id] = conv
+		except Exception as e:
+			logger.warning(f"[WARNING] Failed to load {self.conversations_file.name}: {e}")
+			self._conversations = {}
+
+	def _load_nfc_users(self) -> None:
+		self._nfc_users = self._nfc_file.load()
+
+	def load(self) -> Tuple[Dict[str, User], Dict[str, Conversation], Dict[str, NfcUser]]:
+		self._load_files()
+		conversations = dict(self._conversations)
+		return self._load_owners(conversations), conversations, dict(self._nfc_users)
+
+	def get_user(self, user_id: str) -> Optional[User]:
+		user = self._users.get(user_id)
+		if user is not None:
+			return user
+		record = self._user_records.get(user_id)
+		if record is None:
+			return None
+		# 該当ユーザー1件だけを検証してキャッシュする
+		user = User(**_decode(record))
+		self._remember_user(user)
+		return user
+
+	def user_ids(self) -> List[str]:
+		"""保存されている全ユーザーのIDを返す（移行・変換用）。"""
+		return list(self._user_records)
+
+	def _remember_user(self, user: User) -> None:
+		"""検証済みのUserをインデックスに登録する。"""
+		self._users[user.user_id] = user
+		self._user_records[user.user_id] = None
+
+	def _set_user_record(self, user_id: str, record: dict) -> None:
+		"""未検証のレコードでユーザーを置き換える（WAL再生用）。"""
+		self._users.pop(user_id, None)
+		self._user_records[user_id] = record
+
+	def get_conversation(self, session_id: str) -> Optional[Conversation]:
+		conv = self._conversations.get(session_id)
+		if conv is not None:
+			return conv
+		evicted = self._evicted_conversations.get(session_id)
+		return Conversation(**json.loads(evicted[1])) if evicted is not None else None
+
+	def evict_user(self, user_id: str) -> None:
+		user = self._users.pop(user_id, None)
+		if user is not None:
+			self._user_records[user_id] = _encode(user.model_dump(by_alias=True))
+
+	def evict_conversation(self, session_id: str) -> None:
+		conv = self._conversations.get(session_id)
+		if conv is None or conv.status != ChatStatus.closed:
+			return
+		del self._conversations[session_id]
+		self._evicted_conversations[session_id] = (conv.last_accessed, _encode(conv.model_dump(by_alias=True)))
+
+	def _conversation_records(self) -> Dict[str, dict]:
+		"""書き出す全会話のレコード（手放した会話も含む）。"""
+		records = {k: json.loads(text) for k, (_, text) in self._evicted_conversations.items()}
+		records.update((k, v.model_dump(by_alias=True)) for k, v in self._conversations.items())
+		return records
+
+	# 書き出し
+	def _write_users(self) -> None:
+		records = []
+		for user_id, record in self._user_records.items():
+			user = self._users.get(user_id)
+			records.append(user.model_dump(by_alias=True) if user is not None else _decode(record))
+		write_json_atomic(self.users_file, records)
+		self._unsynced.add(self.users_file)
+
+	def _write_conversations(self) -> None:
+		write_json_atomic(self.conversations_file, self._conversation_records())
+		self._unsynced.add(self.conversations_file)
+
+	def _write_nfc_users(self) -> None:
+		self._nfc_file.write_snapshot(self._nfc_users)
+
+	def sync(self) -> None:
+		# 書き直したファイルとNFCの紐付けのファイルだけをfsyncする
+		paths = self._unsynced | set(self._nfc_file.paths())
+		self._unsynced = set()
+		fsync_paths(paths)
+
+	def _write_all(self) -> None:
+		self._write_users()
+		self._write_conversations()
+		self._write_nfc_users()
+
+	def _put_conversations(self, conversations: Iterable[Conversation]) -> None:
+		for conv in conversations:
+			self._conversations[conv.session_id] = conv
+			self._evicted_conversations.pop(conv.session_id, None)
+		self._write_conversations()
+
+	def _delete_conversations(self, session_ids: Iterable[str]) -> None:
+		removed = False
+		for session_id in session_ids:
+			removed = self._conversations.pop(session_id, None) is not None or removed
+			removed = self._evicted_conversations.pop(session_id, None) is not None or removed
+		if removed:
+			self._write_conversations()
+
+	def closed_before(self, cutoff: datetime) -> List[str]:
+		result = [
+			session_id for session_id, conv in self._conversations.items()
+			if conv.status == ChatStatus.closed and conv.last_accessed < cutoff
+		]
+		result.extend(session_id for session_id, (last_accessed, _) in self._evicted_conversations.items() if last_accessed < cutoff)
+		return result
+
+	def put_user(self, user: User) -> None:
+		self._remember_user(user)
+		self._write_users()
+
+	def put_conversation(self, conv: Conversation) -> None:
+		self._put_conversations([conv])
+
+	def put_nfc_user(self, nfc_user: NfcUser) -> None:
+		self._nfc_users[nfc_user.nfc_id] = nfc_user
+		self._nfc_file.put(nfc_user)
+
+	def delete_nfc_user(self, nfc_id: str) -> None:
+		if self._nfc_users.pop(nfc_id, None) is not None:
+			self._nfc_file.delete(nfc_id)
+
+	def delete_conversation(self, session_id: str) -> None:
+		self._delete_conversations([session_id])
+
+	# システムプロンプトは system_prompts/ に1件1ファイルで保存する（書き込み時にfsync済み）
+	def put_prompt(self, prompt_hash: str, text: str) -> None:
+		self._prompt_files.put_prompt(prompt_hash, text)
+
+	def get_prompt(self, prompt_hash: str) -> Optional[str]:
+		return self._prompt_files.get_prompt(prompt_hash)
+
+	def delete_prompts_before(self, cutoff: datetime) -> int:
+		return self._prompt_files.delete_prompts_before(cutoff)
+
+	def put_batch(self, users=(), conversations=(), nfc_users=(), deleted_nfc_ids=(), deleted_session_ids=()) -> None:
+		# 種類ごとにファイルを1回だけ書き直す
+		users = list(users)
+		conversations = list(conversations)
+		if users:
+			for user in users:
+				self._remember_user(user)
+			self._write_users()
+		if conversations:
+			self._put_conversations(conversations)
+		for nfc_user in nfc_users:
+			self.put_nfc_user(nfc_user)
+		for nfc_id in deleted_nfc_ids:
+			self.delete_nfc_user(nfc_id)
+		deleted_session_ids = list(deleted_session_ids)
+		if deleted_session_ids:
+			self._delete_conversations(deleted_session_ids)
+
+	def save_all(self, users, conversations, nfc_users) -> None:
+		for user in users.values():
+			self._remember_user(user)
+		self._conversations.update(conversations)
+		for session_id in conversations:
+			self._evicted_conversations.pop(session_id, None)
+		self._nfc_users = dict(nfc_users)
+		self._write_all()
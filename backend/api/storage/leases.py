@@ -0,0 +1,139 @@
+# SqliteLeases: 複数ワーカー（プロセス）間で user_id / session_id を排他するためのリース
+
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, Optional
+
+from ..locks import LockTimeout
+
+from backend import SHARED_LOCK_TTL, SHARED_LOCK_WAIT
+
+# ロガー設定
+logger = logging.getLogger("uvicorn.error")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS leases (
+	key        TEXT PRIMARY KEY,
+	owner      TEXT NOT NULL,
+	expires_at REAL NOT NULL
+);
+"""
+
+# 期限切れ、または自分が持っているリースだけを取得（更新）できる
+_SQL_ACQUIRE = (
+	"INSERT INTO leases (key, owner, expires_at) VALUES (?, ?, ?) "
+	"ON CONFLICT(key) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+	"WHERE leases.expires_at < ? OR leases.owner = excluded.owner"
+)
+_SQL_RELEASE = "DELETE FROM leases WHERE key = ? AND owner = ?"
+_SQL_RENEW = "UPDATE leases SET expires_at = ? WHERE key = ? AND owner = ?"
+
+# 取得できなかった場合に再試行するまでの間隔（秒）
+_POLL_INTERVAL = 0.05
+
+
+class SqliteLeases:
+	"""
+	SQLiteの leases テーブルを使ったワーカー間のロック（リース）。
+	- 1つのキーを持てるのは1プロセスのみ。プロセス内のスレッド間の排他は KeyedLock で行う前提
+	- 同じプロセスからの入れ子の hold() は参照数を数え、最も外側を抜けた時に解放する
+	- リースには期限（ttl秒）があり、ワーカーが異常終了しても期限が過ぎれば他のワーカーが取得できる
+	- 保持している間はバックグラウンドのスレッドが ttl/3 秒ごとに期限を延長する（LLMのターンがttlより長くかかっても失効しない）
+	"""
+
+	def __init__(self, db_file: Path, ttl: float = SHARED_LOCK_TTL, wait: float = SHARED_LOCK_WAIT):
+		self.db_file = Path(db_file)
+		self.ttl = ttl
+		self.wait = wait
+		self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+		self._lock = threading.Lock()
+		self._held: Dict[str, int] = {}
+		self._conn = sqlite3.connect(str(self.db_file), check_same_thread=False, isolation_level=None, timeout=wait)
+		self._conn.execute("PRAGMA journal_mode=WAL")
+		self._conn.executescript(_SCHEMA)
+		self._stop = threading.Event()
+		self._renewer: Optional[threading.Thread] = None
+
+	def _try_acquire(self, key: str) -> bool:
+		now = time.time()
+		with self._lock:
+			cursor = self._conn.execute(_SQL_ACQUIRE, (key, self.owner, now + self.ttl, now))
+			return cursor.rowcount == 1
+
+	def _release(self, key: str) -> None:
+		with self._lock:
+			self._conn.execute(_SQL_RELEASE, (key, self.owner))
+
+	def held(self, key: str) -> bool:
+		"""このプロセスがキーのリースを保持しているか。"""
+		with self._lock:
+			return key in self._held
+
+	def renew(self) -> None:
+		"""保持しているリースの期限を延長する。他のワーカーに奪われていたら警告を出す。"""
+		with self._lock:
+			expires_at = time.time() + self.ttl
+			for key in list(self._held):
+				cursor = self._conn.execute(_SQL_RENEW, (expires_at, key, self.owner))
+				if cursor.rowcount != 1:
+					logger.warning(f"[WARNING] Lease expired before renewal: {key}")
+
+	def _renew_loop(self) -> None:
+		while not self._stop.wait(self.ttl / 3):
+			try:
+				self.renew()
+			except sqlite3.Error as e:
+				logger.warning(f"[WARNING] Failed to renew leases: {e}")
+
+	def _start_renewer(self) -> None:
+		with self._lock:
+			if self._renewer is not None or self._stop.is_set():
+				return
+			self._renewer = threading.Thread(target=self._renew_loop, name="lease-renewer", daemon=True)
+			self._renewer.start()
+
+	@contextmanager
+	def hold(self, key: str, wait: Optional[float] = None) -> Iterator[bool]:
+		"""
+		キーのリースを取得して保持する。このプロセスで最も外側の hold() ならTrueを渡す。
+		wait秒（省略時は self.wait）以内に取得できなければ LockTimeout。
+		"""
+		with self._lock:
+			depth = self._held.get(key, 0)
+		if depth == 0:
+			deadline = time.monotonic() + (self.wait if wait is None else wait)
+			while not self._try_acquire(key):
+				if time.monotonic() >= deadline:
+					raise LockTimeout(f"Lease is held by another worker: {key}")
+				time.sleep(_POLL_INTERVAL)
+			self._start_renewer()
+		with self._lock:
+			self._held[key] = depth + 1
+		try:
+			yield depth == 0
+		finally:
+			with self._lock:
+				self._held[key] -= 1
+				outermost = self._held[key] == 0
+				if outermost:
+					del self._held[key]
+			if outermost:
+				try:
+					self._release(key)
+				except sqlite3.Error as e:
+					# 解放に失敗しても期限切れで他のワーカーが取得できる
+					logger.warning(f"[WARNING] Failed to release lease {key}: {e}")
+
+	def close(self) -> None:
+		self._stop.set()
+		if self._renewer is not None:
+			self._renewer.join()
+		with self._lock:
+			self._conn.close()
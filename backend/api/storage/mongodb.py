@@ -0,0 +1,239 @@
+# MongoStorage: MongoDBによる永続化（docs/technical_specs_backend.md のスキーマ）
+
+import logging
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from pymongo import ASCENDING, DeleteOne, MongoClient, ReplaceOne
+
+from .base import Storage
+from .prompts import PromptFiles
+from ..models import ChatStatus, User, Conversation, NfcUser
+
+from backend import DATA_DIR, MONGODB_URI, MONGODB_DB, CONVERSATIONS_TTL_DAYS
+
+# ロガー設定
+logger = logging.getLogger("uvicorn.error")
+
+# closedの会話を CONVERSATIONS_TTL_DAYS で自動削除するTTLインデックスの名前
+_TTL_INDEX = "ttl_closed_conversations"
+
+
+class MongoStorage(Storage):
+	"""
+	users / conversations / nfc_users をMongoDBのコレクションに保存するバックエンド。
+	- 会話のmessagesはドキュメントに埋め込み、追記分だけを $push で書き込む
+	  （前回保存した件数を message_count に持ち、一致しない場合は全体を書き直す）
+	- インデックス: conversations(user_id), conversations(status, last_accessed), nfc_users(user_id)
+	- CONVERSATIONS_TTL_DAYS が設定されていれば、closedの会話をTTLインデックスでサーバー側で削除する。
+	  RECOMMEND_LOG_TTL_DAYS / AI_INSIGHTS_TTL_DAYS はドキュメント内のフィールドのため、
+	  これまで通りDataStoreがユーザーの読み込み時・アーカイブ処理時に適用する
+	- 起動時に読み込むのは closed 以外の会話とその所有ユーザー、NFCの紐付けのみ
+
+	DataStoreはワーカースレッドから同期的に呼び出すため、pymongoの同期クライアントを使う
+	（クライアントはスレッドセーフで、接続プールを内部に持つ）。
+	テストでは client に mongomock.MongoClient() 等を渡せる。
+	"""
+	name = "mongodb"
+	incremental = True
+
+	def __init__(
+		self,
+		data_dir: Path = DATA_DIR,
+		uri: str = MONGODB_URI,
+		db_name: str = MONGODB_DB,
+		client: Optional[Any] = None,
+		conversations_ttl_days: Optional[int] = CONVERSATIONS_TTL_DAYS
+	):
+		# アーカイブの保存先（以前のバージョンが書いたシステムプロンプトのファイルもここにある）
+		self.data_dir = Path(data_dir)
+		self.data_dir.mkdir(parents=True, exist_ok=True)
+		self._owns_client = client is None
+		self._client = client if client is not None else MongoClient(uri, tz_aware=False)
+		db = self._client[db_name]
+		self._users = db["users"]
+		self._conversations = db["conversations"]
+		self._nfc_users = db["nfc_users"]
+		# システムプロンプト（_id: 本文のsha256, text, last_used）。全ホストから同じプロンプトを読めるようDBに置く
+		self._prompts = db["system_prompts"]
+		# 会話ごとに保存済みの (messagesの件数, 最後のメッセージ)。$push で追記できるかの判定に使う
+		self._stored: Dict[str, Tuple[int, Optional[dict]]] = {}
+		self._ensure_indexes(conversations_ttl_days)
+
+	def _ensure_indexes(self, ttl_days: Optional[int]) -> None:
+		self._conversations.create_index([("user_id", ASCENDING)], name="user_id")
+		self._conversations.create_index([("status", ASCENDING), ("last_accessed", ASCENDING)], name="status_last_accessed")
+		self._nfc_users.create_index([("user_id", ASCENDING)], name="user_id")
+		self._prompts.create_index([("last_used", ASCENDING)], name="last_used")
+
+		# TTLの日数が変わった場合は作り直す（無効にした場合は削除する）
+		existing = self._conversations.index_information().get(_TTL_INDEX)
+		expire = ttl_days * 86400 if ttl_days is not None else None
+		if existing is not None and existing.get("expireAfterSeconds") != expire:
+			self._conversations.drop_index(_TTL_INDEX)
+			existing = None
+		if existing is None and expire is not None:
+			self._conversations.create_index(
+				[("last_accessed", ASCENDING)],
+				name=_TTL_INDEX,
+				expireAfterSeconds=expire,
+				partialFilterExpression={"status": ChatStatus.closed.value}
+			)
+			logger.info(f"[INFO] MongoDB TTL index: closed conversations expire after {ttl_days} day(s)")
+
+	# ドキュメントとモデルの変換
+	# 日時はTTLインデックス・範囲検索に使えるようBSONの日時として保存する
+	@staticmethod
+	def _user_document(user: User) -> dict:
+		doc = user.model_dump(by_alias=True, mode="json")
+		doc["lastlogin"] = user.lastlogin
+		return doc
+
+	@staticmethod
+	def _conversation_document(conv: Conversation) -> dict:
+		doc = conv.model_dump(by_alias=True, mode="json", exclude={"messages"})
+		doc["last_accessed"] = conv.last_accessed
+		return doc
+
+	def _to_conversation(self, doc: dict) -> Conversation:
+		doc.pop("message_count", None)
+		conv = Conversation(**doc)
+		self._remember(conv)
+		return conv
+
+	def _remember(self, conv: Conversation) -> None:
+		"""
+		保存済みの件数と最後のメッセージを記録する。
+		closedの会話は追記されないため記録しない（読み込み・保存のたびに増え続けないように）。
+		再開された会話は最初の保存で全体を書き直し、そこから記録する。
+		"""
+		if conv.status == ChatStatus.closed:
+			self._stored.pop(conv.session_id, None)
+			return
+		messages = conv.messages
+		self._stored[conv.session_id] = (len(messages), messages[-1] if messages else None)
+
+	def load(self) -> Tuple[Dict[str, User], Dict[str, Conversation], Dict[str, NfcUser]]:
+		conversations: Dict[str, Conversation] = {}
+		for doc in self._conversations.find({"status": {"$ne": ChatStatus.closed.value}}):
+			conv = self._to_conversation(doc)
+			conversations[conv.session_id] = conv
+
+		# 開いている会話の所有ユーザーのみ読み込む（残りはget_userで遅延読み込み）
+		users = self._load_owners(conversations)
+
+		nfc_users = {doc["_id"]: NfcUser(**doc) for doc in self._nfc_users.find()}
+		return users, conversations, nfc_users
+
+	def get_user(self, user_id: str) -> Optional[User]:
+		doc = self._users.find_one({"_id": user_id})
+		return User(**doc) if doc else None
+
+	def get_conversation(self, session_id: str) -> Optional[Conversation]:
+		doc = self._conversations.find_one({"_id": session_id})
+		return self._to_conversation(doc) if doc else None
+
+	def get_nfc_user(self, nfc_id: str) -> Optional[NfcUser]:
+		doc = self._nfc_users.find_one({"_id": nfc_id})
+		return NfcUser(**doc) if doc else None
+
+	def get_nfc_id_by_user(self, user_id: str) -> Optional[str]:
+		doc = self._nfc_users.find_one({"user_id": user_id}, {"_id": 1})
+		return doc["_id"] if doc else None
+
+	def put_user(self, user: User) -> None:
+		self._users.replace_one({"_id": user.user_id}, self._user_document(user), upsert=True)
+
+	def put_conversation(self, conv: Conversation) -> None:
+		session_id = conv.session_id
+		doc = self._conversation_document(conv)
+		messages = conv.messages
+		count = len(messages)
+
+		# 前回保存した履歴の続きであれば、メタデータの更新と追記分の $push だけを送る
+		stored = self._stored.get(session_id)
+		if stored is not None and stored[0] <= count and (stored[0] == 0 or messages[stored[0] - 1] == stored[1]):
+			doc.pop("_id")
+			doc["message_count"] = count
+			update: Dict[str, Any] = {"$set": doc}
+			if count > stored[0]:
+				update["$push"] = {"messages": {"$each": messages[stored[0]:]}}
+			# 他のプロセスが書き換えていれば message_count が一致せず、全体を書き直す
+			result = self._conversations.update_one({"_id": session_id, "message_count": stored[0]}, update)
+			if result.matched_count == 1:
+				self._remember(conv)
+				return
+			doc["_id"] = session_id
+
+		doc["messages"] = messages
+		doc["message_count"] = count
+		self._conversations.replace_one({"_id": session_id}, doc, upsert=True)
+		self._remember(conv)
+
+	def put_nfc_user(self, nfc_user: NfcUser) -> None:
+		self._nfc_users.replace_one({"_id": nfc_user.nfc_id}, nfc_user.model_dump(by_alias=True), upsert=True)
+
+	def delete_nfc_user(self, nfc_id: str) -> None:
+		self._nfc_users.delete_one({"_id": nfc_id})
+
+	def delete_conversation(self, session_id: str) -> None:
+		self._conversations.delete_one({"_id": session_id})
+		self._stored.pop(session_id, None)
+
+	def evict_conversation(self, session_id: str) -> None:
+		self._stored.pop(session_id, None)
+
+	def closed_before(self, cutoff: datetime) -> List[str]:
+		# (status, last_accessed) のインデックスで範囲検索する
+		cursor = self._conversations.find(
+			{"status": ChatStatus.closed.value, "last_accessed": {"$lt": cutoff}},
+			{"_id": 1}
+		)
+		return [doc["_id"] for doc in cursor]
+
+	def put_prompt(self, prompt_hash: str, text: str) -> None:
+		self._prompts.update_one(
+			{"_id": prompt_hash},
+			{"$set": {"last_used": datetime.now()}, "$setOnInsert": {"text": text}},
+			upsert=True
+		)
+
+	def get_prompt(self, prompt_hash: str) -> Optional[str]:
+		doc = self._prompts.find_one({"_id": prompt_hash}, {"text": 1})
+		if doc:
+			return doc["text"]
+		# 以前のバージョンが data_dir/system_prompts/ に書いたプロンプトは、見つかった時に取り込む
+		text = PromptFiles(self.data_dir).get_prompt(prompt_hash)
+		if text is not None:
+			self.put_prompt(prompt_hash, text)
+		return text
+
+	def delete_prompts_before(self, cutoff: datetime) -> int:
+		deleted = self._prompts.delete_many({"last_used": {"$lt": cutoff}}).deleted_count
+		return deleted + PromptFiles(self.data_dir).delete_prompts_before(cutoff)
+
+	def put_batch(self, users=(), conversations=(), nfc_users=(), deleted_nfc_ids=(), deleted_session_ids=()) -> None:
+		# ユーザーとNFCはまとめて1回のbulk_writeで送る。会話は追記判定があるため1件ずつ
+		user_ops = [ReplaceOne({"_id": u.user_id}, self._user_document(u), upsert=True) for u in users]
+		nfc_ops = [ReplaceOne({"_id": n.nfc_id}, n.model_dump(by_alias=True), upsert=True) for n in nfc_users]
+		nfc_ops += [DeleteOne({"_id": nfc_id}) for nfc_id in deleted_nfc_ids]
+		if user_ops:
+			self._users.bulk_write(user_ops, ordered=False)
+		for conv in conversations:
+			self.put_conversation(conv)
+		if nfc_ops:
+			self._nfc_users.bulk_write(nfc_ops, ordered=True)
+		for session_id in deleted_session_ids:
+			self.delete_conversation(session_id)
+
+	def save_all(self, users, conversations, nfc_users) -> None:
+		self.put_batch(users=users.values(), conversations=conversations.values(), nfc_users=nfc_users.values())
+
+	def sync(self) -> None:
+		# 書き込みの永続性はMongoDBのwrite concern（URIの w= / journal=）に従う
+		pass
+
+	def close(self) -> None:
+		if self._owns_client:
+			self._client.close()
@@ -0,0 +1,91 @@
+# NfcMappingFile: NFC ID ⇔ ユーザーIDの紐付けを1件単位で保存するファイル
+
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Dict, List
+
+from .fileio import read_json, write_json_atomic
+from ..models import NfcUser
+
+from backend import WAL_FSYNC
+
+# ロガー設定
+logger = logging.getLogger("uvicorn.error")
+
+
+class NfcMappingFile:
+	"""
+	nfc_users.json（スナップショット）と nfc_users.log（追記ログ）の組。
+	- 登録・解除はログへ1行追記するだけで、スナップショットは書き直さない
+	- 起動時（load）にログを再生し、スナップショットへ畳み込んでログを空にする
+	スナップショットの形式は従来の nfc_users.json と同じ。
+	"""
+
+	def __init__(self, data_dir: Path, fsync: bool = WAL_FSYNC):
+		self.snapshot_file = Path(data_dir, "nfc_users.json")
+		self.log_file = Path(data_dir, "nfc_users.log")
+		self.fsync = fsync
+
+	def load(self) -> Dict[str, NfcUser]:
+		nfc_users: Dict[str, NfcUser] = {}
+		try:
+			for nfc_dict in read_json(self.snapshot_file, []):
+				nfc_user = NfcUser(**nfc_dict)
+				nfc_users[nfc_user.nfc_id] = nfc_user
+		except Exception as e:
+			logger.warning(f"[WARNING] Failed to load {self.snapshot_file.name}: {e}")
+			nfc_users = {}
+
+		replayed = self._replay(nfc_users)
+		if replayed > 0:
+			# 再生結果をスナップショットへ畳み込む
+			self.write_snapshot(nfc_users)
+		return nfc_users
+
+	def _replay(self, nfc_users: Dict[str, NfcUser]) -> int:
+		if not self.log_file.exists():
+			return 0
+
+		count = 0
+		with open(self.log_file, "r", encoding="utf-8") as f:
+			for line in f:
+				line = line.strip()
+				if not line:
+					continue
+				try:
+					record = json.loads(line)
+					if record["op"] == "put":
+						nfc_users[record["_id"]] = NfcUser(**{"_id": record["_id"], "user_id": record["user_id"]})
+					elif record["op"] == "delete":
+						nfc_users.pop(record["_id"], None)
+					count += 1
+				except Exception as e:
+					# 書きかけの行（クラッシュ時）以降は無視する
+					logger.warning(f"[WARNING] NFC log replay stopped: {e}")
+					break
+		return count
+
+	def _append(self, record: dict) -> None:
+		with open(self.log_file, "a", encoding="utf-8") as f:
+			f.write(json.dumps(record, ensure_ascii=False) + "\n")
+			f.flush()
+			if self.fsync:
+				os.fsync(f.fileno())
+
+	def paths(self) -> List[Path]:
+		"""このファイルの組を構成するパス（fsync用）。"""
+		return [self.snapshot_file, self.log_file]
+
+	def put(self, nfc_user: NfcUser) -> None:
+		self._append({"op": "put", "_id": nfc_user.nfc_id, "user_id": nfc_user.user_id})
+
+	def delete(self, nfc_id: str) -> None:
+		self._append({"op": "delete", "_id": nfc_id})
+
+	def write_snapshot(self, nfc_users: Dict[str, NfcUser]) -> None:
+		"""全件をスナップショットへ書き出し、ログを空にする。"""
+		write_json_atomic(self.snapshot_file, [v.model_dump(by_alias=True) for v in nfc_users.values()])
+		if self.log_file.exists():
+			open(self.log_file, "w", encoding="utf-8").close()
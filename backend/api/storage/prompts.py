@@ -0,0 +1,145 @@
+# PromptStore: システムプロンプトを内容のハッシュで1回だけ保存する
+
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Optional, Tuple
+
+from backend import DATA_DIR
+
+# ロガー設定
+logger = logging.getLogger("uvicorn.error")
+
+# 最後に使われた時刻を保存先に書く最短の間隔（秒）。削除の判定は日単位のため、毎ターン書く必要はない
+_TOUCH_INTERVAL = 3600
+
+
+class PromptNotFound(LookupError):
+	"""履歴が参照しているシステムプロンプトが保存先にない。"""
+
+
+def is_prompt_hash(prompt_hash: str) -> bool:
+	"""sha256の16進表記か（ハッシュ以外の文字列ではファイルを開かない。パス操作対策）。"""
+	return len(prompt_hash) == 64 and all(c in "0123456789abcdef" for c in prompt_hash)
+
+
+class PromptFiles:
+	"""
+	system_prompts/<sha256>.txt にプロンプト本文を保存する（ファイルに書くバックエンド用）。
+	ファイル名が内容のハッシュなので、一度書いたファイルは書き換えない。
+	ファイルの更新時刻を最後に使われた時刻として扱う。
+	"""
+
+	def __init__(self, data_dir: Path = DATA_DIR):
+		self.prompt_dir = Path(data_dir, "system_prompts")
+
+	def path(self, prompt_hash: str) -> Path:
+		return Path(self.prompt_dir, f"{prompt_hash}.txt")
+
+	def put_prompt(self, prompt_hash: str, text: str) -> Path:
+		"""保存してファイルのパスを返す。保存済みなら更新時刻だけを更新する。"""
+		path = self.path(prompt_hash)
+		try:
+			os.utime(path)
+			return path
+		except FileNotFoundError:
+			pass
+		self.prompt_dir.mkdir(parents=True, exist_ok=True)
+		tmp_path = path.with_name(f"{path.name}.{threading.get_ident()}.tmp")
+		with open(tmp_path, "w", encoding="utf-8") as f:
+			f.write(text)
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(tmp_path, path)
+		return path
+
+	def get_prompt(self, prompt_hash: str) -> Optional[str]:
+		if not is_prompt_hash(prompt_hash):
+			return None
+		try:
+			with open(self.path(prompt_hash), "r", encoding="utf-8") as f:
+				return f.read()
+		except FileNotFoundError:
+			return None
+
+	def delete_prompts_before(self, cutoff: datetime) -> int:
+		if not self.prompt_dir.exists():
+			return 0
+		cutoff_ts = cutoff.timestamp()
+		deleted = 0
+		for path in self.prompt_dir.glob("*.txt"):
+			try:
+				if path.stat().st_mtime < cutoff_ts:
+					path.unlink()
+					deleted += 1
+			except FileNotFoundError:
+				continue
+		return deleted
+
+
+class PromptStore:
+	"""
+	システムプロンプトを内容のハッシュで1回だけ保存する。
+	会話履歴にはハッシュだけを持たせ、LLMに送る時に get() で本文へ戻す。
+	- 保存先は storage（put_prompt / get_prompt を持つStorage）。省略時は data_dir のファイル
+	- 保存先には最後に使われた時刻を記録し（_TOUCH_INTERVAL 秒に1回まで）、
+	  DataStoreのTTL処理で長く使われていないもの（ユーザーのai_insightsを含む）を削除する
+	"""
+
+	def __init__(self, data_dir: Path = DATA_DIR, cache_size: int = 256, storage: Optional[Any] = None):
+		self._backend = storage if storage is not None else PromptFiles(data_dir)
+		self.cache_size = cache_size
+		# 最近使ったプロンプト（ハッシュ → (本文, 最後に保存先の時刻を更新した時刻)）
+		self._cache: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+		self._lock = threading.Lock()
+
+	@staticmethod
+	def digest(text: str) -> str:
+		return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+	def _remember(self, prompt_hash: str, text: str) -> None:
+		with self._lock:
+			self._cache[prompt_hash] = (text, time.monotonic())
+			self._cache.move_to_end(prompt_hash)
+			while len(self._cache) > self.cache_size:
+				self._cache.popitem(last=False)
+
+	def _cached(self, prompt_hash: str) -> Tuple[Optional[str], bool]:
+		"""キャッシュの本文と、保存先の時刻の更新が必要かを返す。"""
+		with self._lock:
+			entry = self._cache.get(prompt_hash)
+			if entry is None:
+				return None, False
+			self._cache.move_to_end(prompt_hash)
+			return entry[0], time.monotonic() - entry[1] >= _TOUCH_INTERVAL
+
+	def put(self, text: str) -> str:
+		"""プロンプトを保存してハッシュを返す（保存済みなら最後に使われた時刻だけを更新する）。"""
+		prompt_hash = self.digest(text)
+		cached, stale = self._cached(prompt_hash)
+		if cached is None or stale:
+			self._backend.put_prompt(prompt_hash, text)
+			self._remember(prompt_hash, text)
+		return prompt_hash
+
+	def get(self, prompt_hash: str) -> Optional[str]:
+		"""ハッシュからプロンプト本文を取得する。見つからなければNone。"""
+		text, stale = self._cached(prompt_hash)
+		if text is None:
+			if not is_prompt_hash(prompt_hash):
+				return None
+			text = self._backend.get_prompt(prompt_hash)
+			if text is None:
+				logger.warning(f"[WARNING] System prompt not found: {prompt_hash}")
+				return None
+			stale = True
+		if stale:
+			# 使われている間は削除されないよう、最後に使われた時刻を更新する
+			self._backend.put_prompt(prompt_hash, text)
+			self._remember(prompt_hash, text)
+		return text
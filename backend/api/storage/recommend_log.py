@@ -0,0 +1,195 @@
+# RecommendationLog: 推薦ログをユーザーとは別の追記専用ファイルに保存する
+
+import json
+import logging
+import os
+import threading
+from collections import Counter, deque
+from datetime import datetime
+from pathlib import Path
+from typing import Deque, Dict, Iterable, List, Optional, Tuple
+
+from ..models import RecommendationLogEntry
+
+from backend import DATA_DIR, RECOMMEND_LOG_MAX_PER_USER, WAL_FSYNC
+
+# ロガー設定
+logger = logging.getLogger("uvicorn.error")
+
+
+class RecommendationLog:
+	"""
+	recommend_log.jsonl に推薦1件を1行で追記する（Userのドキュメントには埋め込まない）。
+	  {"user_id", "reason", "timestamp", "book_data": {"_id", "title", "genre"}}
+	メモリ上に持つもの:
+	- ユーザーごとの直近 max_per_user 件（超えたら古いものから捨てる。0で無制限）
+	- ユーザーごとの推薦済みISBN（ISBN → 件数）。推薦済みかの判定は O(1)
+	- 全体のISBNごと・ジャンルごとの推薦数
+	集計は保持しているエントリ（件数上限とTTLの範囲内）に対する値で、エントリを捨てる時に減らす。
+	捨てたエントリの行はファイルに残るため、有効な行より多くなったら expire() でファイルを書き直す。
+	複数ワーカー構成では他のプロセスの追記を読み込み前に反映する（書き直しはアーカイブ処理と同じく1ワーカーのみ）。
+	"""
+
+	def __init__(self, data_dir: Path = DATA_DIR, max_per_user: int = RECOMMEND_LOG_MAX_PER_USER, fsync: bool = WAL_FSYNC):
+		self.log_file = Path(data_dir, "recommend_log.jsonl")
+		self.max_per_user = max_per_user
+		self.fsync = fsync
+		self._entries: Dict[str, Deque[RecommendationLogEntry]] = {}
+		self._seen: Dict[str, Counter] = {}
+		self._isbn_counts: Counter = Counter()
+		self._genre_counts: Counter = Counter()
+		# ファイルに残っているが捨てたエントリの行数
+		self._dead = 0
+		# 読み込み済みの位置（他のプロセスの追記・書き直しを検出するため）
+		self._pos = 0
+		self._ino: Optional[int] = None
+		self._lock = threading.Lock()
+		with self._lock:
+			self._refresh()
+
+	def _refresh(self) -> None:
+		"""ファイルの未読部分を読み込む（_lock を持って呼ぶ）。"""
+		try:
+			stat = os.stat(self.log_file)
+		except FileNotFoundError:
+			return
+		if stat.st_ino != self._ino or stat.st_size < self._pos:
+			# 書き直された（別のファイルに置き換わった）場合は最初から読み直す
+			self._entries = {}
+			self._seen = {}
+			self._isbn_counts = Counter()
+			self._genre_counts = Counter()
+			self._dead = 0
+			self._pos = 0
+			self._ino = stat.st_ino
+		if stat.st_size == self._pos:
+			return
+		with open(self.log_file, "rb") as f:
+			f.seek(self._pos)
+			for line in f:
+				# 書きかけの行（追記中・クラッシュ時）以降は次回に読む
+				if not line.endswith(b"\n"):
+					break
+				if line.strip():
+					try:
+						record = json.loads(line)
+						user_id = record.pop("user_id")
+						entry = RecommendationLogEntry(**record)
+					except Exception as e:
+						logger.warning(f"[WARNING] Recommendation log replay stopped at offset {self._pos}: {e}")
+						break
+					self._add(user_id, entry)
+				self._pos += len(line)
+
+	def _add(self, user_id: str, entry: RecommendationLogEntry) -> None:
+		entries = self._entries.setdefault(user_id, deque())
+		entries.append(entry)
+		self._count(user_id, entry, 1)
+		while self.max_per_user > 0 and len(entries) > self.max_per_user:
+			self._count(user_id, entries.popleft(), -1)
+			self._dead += 1
+
+	def _count(self, user_id: str, entry: RecommendationLogEntry, delta: int) -> None:
+		"""エントリ1件分の集計を増減する。"""
+		isbn = entry.book_data.isbn
+		genre = entry.book_data.genre
+		seen = self._seen.setdefault(user_id, Counter())
+		for counter, key in ((seen, isbn), (self._isbn_counts, isbn), (self._genre_counts, genre)):
+			if key is None:
+				continue
+			counter[key] += delta
+			if counter[key] <= 0:
+				del counter[key]
+		if not seen:
+			del self._seen[user_id]
+
+	@staticmethod
+	def _line(user_id: str, entry: RecommendationLogEntry) -> str:
+		record = {"user_id": user_id, **entry.model_dump(by_alias=True, mode="json")}
+		return json.dumps(record, ensure_ascii=False) + "\n"
+
+	def append(self, user_id: str, entries: Iterable[RecommendationLogEntry]) -> None:
+		"""ユーザーの推薦ログへ追記する（古い順に渡す）。"""
+		data = "".join(self._line(user_id, entry) for entry in entries)
+		if not data:
+			return
+		with self._lock:
+			self.log_file.parent.mkdir(parents=True, exist_ok=True)
+			with open(self.log_file, "a", encoding="utf-8") as f:
+				f.write(data)
+				f.flush()
+				if self.fsync:
+					os.fsync(f.fileno())
+			# 追記した分（と他のプロセスの追記）をメモリへ反映する
+			self._refresh()
+
+	def entries(self, user_id: str) -> List[RecommendationLogEntry]:
+		"""ユーザーの推薦ログ（古い順）。"""
+		with self._lock:
+			self._refresh()
+			return list(self._entries.get(user_id, ()))
+
+	def has_recommended(self, user_id: str, isbn: str) -> bool:
+		"""そのユーザーにこの本を推薦済みか。"""
+		with self._lock:
+			self._refresh()
+			seen = self._seen.get(user_id)
+			return seen is not None and isbn in seen
+
+	def top_isbns(self, limit: int = 10) -> List[Tuple[str, int]]:
+		"""全ユーザーでよく推薦されている本（ISBN, 推薦数）。"""
+		with self._lock:
+			self._refresh()
+			return self._isbn_counts.most_common(limit)
+
+	def top_genres(self, limit: int = 10) -> List[Tuple[str, int]]:
+		"""全ユーザーでよく推薦されているジャンル（ジャンル, 推薦数）。"""
+		with self._lock:
+			self._refresh()
+			return self._genre_counts.most_common(limit)
+
+	def expire(self, cutoff: Optional[datetime]) -> int:
+		"""
+		cutoff より前のエントリを捨て、捨てた件数を返す（cutoffがNoneなら件数上限で捨てた分の整理のみ）。
+		捨てた行が有効な行より多くなったらファイルを書き直す。
+		"""
+		removed = 0
+		with self._lock:
+			self._refresh()
+			if cutoff is not None:
+				for user_id in list(self._entries):
+					entries = self._entries[user_id]
+					kept = deque(entry for entry in entries if entry.timestamp >= cutoff)
+					if len(kept) == len(entries):
+						continue
+					for entry in entries:
+						if entry.timestamp < cutoff:
+							self._count(user_id, entry, -1)
+					removed += len(entries) - len(kept)
+					if kept:
+						self._entries[user_id] = kept
+					else:
+						del self._entries[user_id]
+				self._dead += removed
+			if self._dead > 0 and self._dead >= sum(len(entries) for entries in self._entries.values()):
+				self._rewrite()
+		return removed
+
+	def _rewrite(self) -> None:
+		"""有効なエントリだけでファイルを書き直す（_lock を持って呼ぶ）。"""
+		tmp_path = self.log_file.with_name(self.log_file.name + ".tmp")
+		with open(tmp_path, "w", encoding="utf-8") as f:
+			for user_id, entries in self._entries.items():
+				f.write("".join(self._line(user_id, entry) for entry in entries))
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(tmp_path, self.log_file)
+		stat = os.stat(self.log_file)
+		self._ino = stat.st_ino
+		self._pos = stat.st_size
+		logger.info(f"[INFO] Recommendation log compacted: dropped {self._dead} line(s)")
+		self._dead = 0
+
+	def __len__(self) -> int:
+		with self._lock:
+			return sum(len(entries) for entries in self._entries.values())
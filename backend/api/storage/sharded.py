@@ -0,0 +1,205 @@
+# ShardedStorage: 会話を1件1ファイルに分割し、小さなインデックスで管理する方式
+
+import json
+import logging
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional
+
+from .fileio import read_json, write_json_atomic
+from .json_file import JsonStorage
+from ..models import ChatStatus, Conversation
+
+from backend import DATA_DIR, WAL_COMPACT_THRESHOLD
+
+# ロガー設定
+logger = logging.getLogger("uvicorn.error")
+
+
+class ShardedStorage(JsonStorage):
+	"""
+	users.json / nfc_users.json はJsonStorageと同じ。会話だけを
+	  conversations/<session_id>.json  … 会話本体（messages含む）
+	  conversations_index.json         … session_id → {user_id, status, last_accessed}
+	  conversations_index.log          … インデックスの変更（put / delete）の追記ログ
+	に分けて保存するバックエンド。
+	- 起動時に読むのはインデックスと、closed以外の会話本体のみ
+	- closedの会話本体は get_conversation で要求されるまでディスクに置いたまま
+	- 会話の保存はその会話のファイルを書き直し、インデックスの変更はログへ1行追記する。
+	  ログのレコード数が compact_threshold に達したら（と起動時に）インデックスへ畳み込む
+	"""
+	name = "sharded"
+	incremental = True
+
+	def __init__(self, data_dir: Path = DATA_DIR, compact_threshold: int = WAL_COMPACT_THRESHOLD):
+		super().__init__(data_dir)
+		self.shard_dir = Path(self.data_dir, "conversations")
+		self.shard_dir.mkdir(parents=True, exist_ok=True)
+		self.index_file = Path(self.data_dir, "conversations_index.json")
+		self.index_log = Path(self.data_dir, "conversations_index.log")
+		self.compact_threshold = compact_threshold
+		# session_id → メタデータ
+		self._index: Dict[str, Dict[str, Any]] = {}
+		# インデックスへ畳み込んでいないログのレコード数
+		self._log_records = 0
+
+	def _shard_path(self, session_id: str) -> Path:
+		return Path(self.shard_dir, f"{session_id}.json")
+
+	@staticmethod
+	def _index_entry(conv: Conversation) -> Dict[str, Any]:
+		return {
+			"user_id": conv.user_id,
+			"status": conv.status.value,
+			"last_accessed": conv.last_accessed,
+		}
+
+	def _load_conversations(self) -> None:
+		"""インデックスを読み込み、closed以外の会話本体だけをメモリに載せる。"""
+		if not self.index_file.exists() and self.conversations_file.exists():
+			self._migrate_from_json()
+
+		self._index = read_json(self.index_file, {})
+		if self._replay_index() > 0:
+			# 再生結果をインデックスへ畳み込む
+			self._write_index()
+		self._conversations = {}
+		for session_id, entry in self._index.items():
+			if entry.get("status") == ChatStatus.closed.value:
+				continue
+			conv = self.get_conversation(session_id)
+			if conv is not None:
+				self._conversations[session_id] = conv
+
+	def _replay_index(self) -> int:
+		"""インデックスのログを再生して self._index へ反映する。再生したレコード数を返す。"""
+		if not self.index_log.exists():
+			return 0
+
+		count = 0
+		with open(self.index_log, "r", encoding="utf-8") as f:
+			for line in f:
+				line = line.strip()
+				if not line:
+					continue
+				try:
+					record = json.loads(line)
+					if record["op"] == "put":
+						self._index[record["key"]] = record["entry"]
+					elif record["op"] == "delete":
+						self._index.pop(record["key"], None)
+					count += 1
+				except Exception as e:
+					# 書きかけの行（クラッシュ時）以降は無視する
+					logger.warning(f"[WARNING] Conversation index log replay stopped: {e}")
+					break
+		return count
+
+	def _migrate_from_json(self) -> None:
+		"""既存の conversations.json を1件1ファイルへ分割する。"""
+		super()._load_conversations()
+		if not self._conversations:
+			return
+		for conv in self._conversations.values():
+			self._write_shard(conv)
+			self._index[conv.session_id] = self._index_entry(conv)
+		self._write_index()
+		logger.info(f"[INFO] Split {len(self._conversations)} conversation(s) into {self.shard_dir.name}/")
+
+	def get_conversation(self, session_id: str) -> Optional[Conversation]:
+		# インデックスにないIDではファイルを開かない（パス操作対策も兼ねる）
+		if session_id not in self._index:
+			return None
+		data = read_json(self._shard_path(session_id), None)
+		if data is None:
+			logger.warning(f"[WARNING] Conversation shard missing: {session_id}")
+			return None
+		return Conversation(**data)
+
+	def evict_conversation(self, session_id: str) -> None:
+		# 会話本体は1件ずつファイルにあるため、文字列にせずそのまま手放す
+		conv = self._conversations.get(session_id)
+		if conv is not None and conv.status == ChatStatus.closed:
+			del self._conversations[session_id]
+
+	# 書き出し
+	def _write_shard(self, conv: Conversation) -> None:
+		path = self._shard_path(conv.session_id)
+		write_json_atomic(path, conv.model_dump(by_alias=True), indent=None)
+		self._unsynced.add(path)
+
+	def _write_index(self) -> None:
+		"""
+		インデックス全体を書き出し、ログを空にする。
+		書き出し後・ログを空にする前にクラッシュしても、レコードは冪等なので再生結果は変わらない。
+		"""
+		write_json_atomic(self.index_file, self._index, indent=None)
+		self._unsynced.add(self.index_file)
+		if self.index_log.exists():
+			open(self.index_log, "w", encoding="utf-8").close()
+			self._unsynced.add(self.index_log)
+		self._log_records = 0
+
+	def _append_index(self, records: List[Dict[str, Any]]) -> None:
+		"""インデックスの変更をログへ追記し、閾値を超えたらインデックスへ畳み込む。"""
+		if not records:
+			return
+		with open(self.index_log, "a", encoding="utf-8") as f:
+			f.write("".join(json.dumps(r, default=str, ensure_ascii=False) + "\n" for r in records))
+		self._unsynced.add(self.index_log)
+		self._log_records += len(records)
+		if self._log_records >= self.compact_threshold:
+			self._write_index()
+
+	def _write_conversations(self) -> None:
+		for conv in self._conversations.values():
+			self._write_shard(conv)
+			self._index[conv.session_id] = self._index_entry(conv)
+		self._write_index()
+
+	def _put_conversations(self, conversations: Iterable[Conversation]) -> None:
+		# 会話ごとにファイルを書き、インデックスの変更は最後にまとめてログへ追記する
+		records = []
+		for conv in conversations:
+			self._write_shard(conv)
+			entry = self._index_entry(conv)
+			self._index[conv.session_id] = entry
+			records.append({"op": "put", "key": conv.session_id, "entry": entry})
+			# closedになった会話本体は保持しない（必要ならget_conversationで読み直す）
+			if conv.status == ChatStatus.closed:
+				self._conversations.pop(conv.session_id, None)
+			else:
+				self._conversations[conv.session_id] = conv
+		self._append_index(records)
+
+	def _delete_conversations(self, session_ids: Iterable[str]) -> None:
+		records = []
+		for session_id in session_ids:
+			if self._index.pop(session_id, None) is None:
+				continue
+			self._conversations.pop(session_id, None)
+			self._shard_path(session_id).unlink(missing_ok=True)
+			self._unsynced.add(self.shard_dir)
+			records.append({"op": "delete", "key": session_id})
+		self._append_index(records)
+
+	def closed_before(self, cutoff: datetime) -> List[str]:
+		# インデックスだけで判定する（会話本体は読まない）
+		result = []
+		for session_id, entry in self._index.items():
+			if entry.get("status") != ChatStatus.closed.value:
+				continue
+			last_accessed = entry.get("last_accessed")
+			if isinstance(last_accessed, str):
+				last_accessed = datetime.fromisoformat(last_accessed)
+			if last_accessed is not None and last_accessed < cutoff:
+				result.append(session_id)
+		return result
+
+	def save_all(self, users, conversations, nfc_users) -> None:
+		for user in users.values():
+			self._remember_user(user)
+		self._nfc_users = dict(nfc_users)
+		self._conversations = dict(conversations)
+		self._write_all()
+		self._conversations = {k: v for k, v in self._conversations.items() if v.status != ChatStatus.closed}
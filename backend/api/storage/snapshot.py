@@ -0,0 +1,379 @@
+# SnapshotStorage: msgpackのバイナリスナップショット + WAL方式
+
+import gc
+import logging
+import os
+from array import array
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import msgpack
+
+from .wal import WalStorage
+from ..models import (
+	ChatStatus, UserStatus, User, Conversation, NfcUser,
+	Personal, BookData, RecommendationLogEntry
+)
+
+from backend import DATA_DIR, WAL_COMPACT_THRESHOLD, WAL_FSYNC
+
+# ロガー設定
+logger = logging.getLogger("uvicorn.error")
+
+SNAPSHOT_VERSION = 1
+
+# 会話インデックスのstatus列（1件1バイト）
+_STATUS_CODES = {ChatStatus.active: 0, ChatStatus.pause: 1, ChatStatus.closed: 2}
+
+
+# msgpack変換
+def _default(obj: Any) -> Any:
+	"""msgpackが直接扱えない型（datetime）を変換する。"""
+	if isinstance(obj, datetime):
+		return obj.isoformat()
+	raise TypeError(f"Cannot serialize {type(obj).__name__}")
+
+
+def _pack(data: Any) -> bytes:
+	return msgpack.packb(data, default=_default, use_bin_type=True)
+
+
+def _unpack(data: bytes) -> Any:
+	return msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+
+def _datetime(value: Any) -> datetime:
+	return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+
+# 検証なしでのモデル構築（自分で書き出したレコード専用）
+# model_construct はネストしたモデルを変換しないため、ここで組み立てる
+def construct_user(record: Dict[str, Any]) -> User:
+	personal = record.get("personal")
+	return User.model_construct(
+		user_id=record["_id"],
+		ai_insights=record.get("ai_insights", ""),
+		personal=Personal.model_construct(**personal) if isinstance(personal, dict) else personal,
+		status=UserStatus(record.get("status", UserStatus.logout)),
+		active_session=record.get("active_session"),
+		old_session=record.get("old_session", []),
+		recommend_log=[
+			RecommendationLogEntry.model_construct(
+				reason=entry["reason"],
+				timestamp=_datetime(entry["timestamp"]),
+				book_data=BookData.model_construct(
+					isbn=entry["book_data"]["_id"], title=entry["book_data"]["title"], genre=entry["book_data"].get("genre")
+				)
+			)
+			for entry in record.get("recommend_log", [])
+		],
+		lastlogin=_datetime(record["lastlogin"]),
+	)
+
+
+def construct_conversation(record: Dict[str, Any]) -> Conversation:
+	return Conversation.model_construct(
+		session_id=record["_id"],
+		user_id=record["user_id"],
+		status=ChatStatus(record.get("status", ChatStatus.active)),
+		messages=record.get("messages", []),
+		summary=record.get("summary"),
+		last_accessed=_datetime(record["last_accessed"]),
+	)
+
+
+class SnapshotStorage(WalStorage):
+	"""
+	WalStorageのスナップショットをJSONの代わりにmsgpackで保存するバックエンド。
+	  datastore.snapshot            … users / nfc_users / 会話インデックス
+	  conversations.<世代>.bin      … 会話本体（msgpackレコードの連結）
+	- 会話インデックスは列ごとの配列（session_id, user_id, status, 位置, 長さ）で持つため、
+	  会話が数十万件あってもデコードするオブジェクトはほぼ文字列のみ
+	- ユーザーは1件ずつmsgpackのバイト列のまま保持し、get_user で要求された時にデコードする
+	- 起動時に本体を読むのはclosed以外の会話のみ。closedの会話は要求時に位置を指定して1件だけ読む
+	- 自分で書き出したレコードは検証せずに model_construct で組み立てる
+	- 変更はWalStorageと同じく datastore.wal に追記し、圧縮時にスナップショットを書き直す
+	- evict_* で手放したユーザー・会話はJSON文字列ではなくmsgpackのバイト列で持つ
+
+	スナップショットがなく users.json 等がある場合は、起動時にJSONから取り込んで変換する。
+	"""
+	name = "snapshot"
+
+	def __init__(
+		self,
+		data_dir: Path = DATA_DIR,
+		compact_threshold: int = WAL_COMPACT_THRESHOLD,
+		fsync: bool = WAL_FSYNC
+	):
+		super().__init__(data_dir, compact_threshold, fsync)
+		self.snapshot_file = Path(self.data_dir, "datastore.snapshot")
+		# 会話インデックス（列ごと）。_conv_pos は session_id → 行番号
+		self._conv_pos: Dict[str, int] = {}
+		self._conv_owners: List[str] = []
+		self._conv_status = b""
+		self._conv_offsets = array("q")
+		self._conv_lengths = array("q")
+		# 最終アクセス時刻（UNIX時刻）。アーカイブ対象の判定に使う
+		self._conv_accessed = array("d")
+		self._bodies_file: Optional[Path] = None
+		self._bodies_fd: Optional[int] = None
+		self._generation = 0
+
+	# 読み込み
+	def load(self):
+		if not self.snapshot_file.exists() and self.users_file.exists():
+			# JSONから取り込み、WALを再生した結果をバイナリで書き出す
+			result = super().load()
+			self.compact()
+			logger.info(f"[INFO] Converted JSON data into {self.snapshot_file.name}")
+			return result
+		return super().load()
+
+	def _load_files(self) -> None:
+		if not self.snapshot_file.exists():
+			super()._load_files()
+			return
+
+		with open(self.snapshot_file, "rb") as f:
+			data = f.read()
+		# 大量のコンテナを一度に作るため、デコード中はGCを止める
+		gc_enabled = gc.isenabled()
+		gc.disable()
+		try:
+			snapshot = _unpack(data)
+		finally:
+			if gc_enabled:
+				gc.enable()
+		if snapshot.get("version") != SNAPSHOT_VERSION:
+			raise ValueError(f"Unsupported snapshot version: {snapshot.get('version')}")
+
+		self._users = {}
+		self._user_records = snapshot["users"]
+		self._evicted_conversations = {}
+		self._nfc_users = {
+			nfc_id: NfcUser.model_construct(nfc_id=nfc_id, user_id=user_id)
+			for nfc_id, user_id in snapshot["nfc_users"].items()
+		}
+		session_ids = snapshot["sessions"]
+		self._conv_pos = dict(zip(session_ids, range(len(session_ids))))
+		self._conv_owners = snapshot["owners"]
+		self._conv_status = snapshot["statuses"]
+		self._conv_offsets = array("q", snapshot["offsets"])
+		self._conv_lengths = array("q", snapshot["lengths"])
+		# accessed列がない古いスナップショットでは、判定時に本体を読む
+		self._conv_accessed = array("d", snapshot.get("accessed", b""))
+		self._generation = snapshot["generation"]
+		self._open_bodies(Path(self.data_dir, snapshot["bodies"]))
+
+		self._conversations = {}
+		closed = _STATUS_CODES[ChatStatus.closed]
+		for pos, code in enumerate(self._conv_status):
+			if code != closed:
+				conv = construct_conversation(self._read_body(pos))
+				self._conversations[conv.session_id] = conv
+
+	def _open_bodies(self, path: Path) -> None:
+		if self._bodies_fd is not None:
+			os.close(self._bodies_fd)
+		self._bodies_file = path
+		self._bodies_fd = os.open(path, os.O_RDONLY)
+
+	def _read_raw(self, pos: int) -> bytes:
+		# preadはファイル位置を共有しないため、複数スレッドから同時に読んでよい
+		return os.pread(self._bodies_fd, self._conv_lengths[pos], self._conv_offsets[pos])
+
+	def _read_body(self, pos: int) -> Dict[str, Any]:
+		return _unpack(self._read_raw(pos))
+
+	def get_user(self, user_id: str) -> Optional[User]:
+		user = self._users.get(user_id)
+		if user is not None:
+			return user
+		record = self._user_records.get(user_id)
+		if record is None:
+			return None
+		if isinstance(record, bytes):
+			record = _unpack(record)
+		user = construct_user(record)
+		self._remember_user(user)
+		return user
+
+	def get_conversation(self, session_id: str) -> Optional[Conversation]:
+		conv = self._conversations.get(session_id)
+		if conv is not None:
+			return conv
+		evicted = self._evicted_conversations.get(session_id)
+		if evicted is not None:
+			return construct_conversation(_unpack(evicted[1]))
+		pos = self._conv_pos.get(session_id)
+		if pos is None:
+			return None
+		return construct_conversation(self._read_body(pos))
+
+	def user_ids(self) -> List[str]:
+		return list(self._user_records)
+
+	def evict_user(self, user_id: str) -> None:
+		user = self._users.pop(user_id, None)
+		if user is not None:
+			self._user_records[user_id] = _pack(user.model_dump(by_alias=True))
+
+	def evict_conversation(self, session_id: str) -> None:
+		conv = self._conversations.get(session_id)
+		if conv is None or conv.status != ChatStatus.closed:
+			return
+		del self._conversations[session_id]
+		self._evicted_conversations[session_id] = (conv.last_accessed, _pack(conv.model_dump(by_alias=True)))
+
+	def closed_before(self, cutoff: datetime) -> List[str]:
+		# スナップショット上のclosedはインデックスの列だけで判定する
+		closed = _STATUS_CODES[ChatStatus.closed]
+		cutoff_ts = cutoff.timestamp()
+		has_accessed = len(self._conv_accessed) == len(self._conv_status)
+		result = []
+		for session_id, pos in self._conv_pos.items():
+			if session_id in self._conversations or session_id in self._evicted_conversations or self._conv_status[pos] != closed:
+				continue
+			if has_accessed:
+				accessed = self._conv_accessed[pos]
+			else:
+				accessed = _datetime(self._read_body(pos)["last_accessed"]).timestamp()
+			if accessed < cutoff_ts:
+				result.append(session_id)
+		# メモリ上の会話（スナップショット後に変更されたもの）
+		result.extend(
+			session_id for session_id, conv in self._conversations.items()
+			if conv.status == ChatStatus.closed and conv.last_accessed < cutoff
+		)
+		result.extend(session_id for session_id, (last_accessed, _) in self._evicted_conversations.items() if last_accessed < cutoff)
+		return result
+
+	def delete_conversation(self, session_id: str) -> None:
+		found = self._conversations.pop(session_id, None) is not None
+		found = self._evicted_conversations.pop(session_id, None) is not None or found
+		found = self._conv_pos.pop(session_id, None) is not None or found
+		if found:
+			self._append({"op": "delete", "kind": "conversation", "key": session_id})
+
+	def _apply(self, record: Dict[str, Any]) -> None:
+		if record["op"] == "delete" and record["kind"] == "conversation":
+			# スナップショットの会話インデックスからも外す（行は次の圧縮で詰める）
+			self._conv_pos.pop(record["key"], None)
+		super()._apply(record)
+
+	# 書き出し
+	def _write_all(self) -> None:
+		"""
+		会話本体を新しい世代のファイルへ書き出してから、スナップショットを置き換える。
+		メモリにない会話本体は古いファイルからバイト列のままコピーする（デコードしない）。
+		スナップショットの置き換えまでは古い世代が有効なので、途中でクラッシュしても壊れない。
+		"""
+		generation = self._generation + 1
+		bodies_file = Path(self.data_dir, f"conversations.{generation}.bin")
+		session_ids: List[str] = []
+		owners: List[str] = []
+		statuses = bytearray()
+		offsets = array("q")
+		lengths = array("q")
+		accessed = array("d")
+		offset = 0
+		with open(bodies_file, "wb") as f:
+			for session_id in {**self._conv_pos, **self._evicted_conversations, **self._conversations}:
+				conv = self._conversations.get(session_id)
+				evicted = self._evicted_conversations.get(session_id)
+				if conv is not None:
+					data = _pack(conv.model_dump(by_alias=True))
+					owner, code = conv.user_id, _STATUS_CODES[conv.status]
+					accessed_ts = conv.last_accessed.timestamp()
+				elif evicted is not None:
+					# 手放した会話はバイト列のまま書き、所有者だけをデコードする
+					last_accessed, data = evicted
+					owner, code = _unpack(data)["user_id"], _STATUS_CODES[ChatStatus.closed]
+					accessed_ts = last_accessed.timestamp()
+				else:
+					pos = self._conv_pos[session_id]
+					data = self._read_raw(pos)
+					owner, code = self._conv_owners[pos], self._conv_status[pos]
+					if len(self._conv_accessed) == len(self._conv_status):
+						accessed_ts = self._conv_accessed[pos]
+					else:
+						accessed_ts = _datetime(_unpack(data)["last_accessed"]).timestamp()
+				f.write(data)
+				session_ids.append(session_id)
+				owners.append(owner)
+				statuses.append(code)
+				offsets.append(offset)
+				lengths.append(len(data))
+				accessed.append(accessed_ts)
+				offset += len(data)
+			if self.fsync:
+				f.flush()
+				os.fsync(f.fileno())
+
+		users = {}
+		for user_id, record in self._user_records.items():
+			user = self._users.get(user_id)
+			if user is not None:
+				users[user_id] = _pack(user.model_dump(by_alias=True))
+			else:
+				users[user_id] = record if isinstance(record, bytes) else _pack(record)
+		snapshot = {
+			"version": SNAPSHOT_VERSION,
+			"generation": generation,
+			"bodies": bodies_file.name,
+			"users": users,
+			"nfc_users": {nfc_id: n.user_id for nfc_id, n in self._nfc_users.items()},
+			"sessions": session_ids,
+			"owners": owners,
+			"statuses": bytes(statuses),
+			"offsets": offsets.tobytes(),
+			"lengths": lengths.tobytes(),
+			"accessed": accessed.tobytes(),
+		}
+		tmp_path = self.snapshot_file.with_name(self.snapshot_file.name + ".tmp")
+		with open(tmp_path, "wb") as f:
+			f.write(_pack(snapshot))
+			if self.fsync:
+				f.flush()
+				os.fsync(f.fileno())
+		os.replace(tmp_path, self.snapshot_file)
+		self._unsynced.update((bodies_file, self.snapshot_file))
+
+		old_bodies = self._bodies_file
+		self._conv_pos = dict(zip(session_ids, range(len(session_ids))))
+		self._conv_owners = owners
+		self._conv_status = bytes(statuses)
+		self._conv_offsets = offsets
+		self._conv_lengths = lengths
+		self._conv_accessed = accessed
+		self._generation = generation
+		self._open_bodies(bodies_file)
+		if old_bodies is not None and old_bodies != bodies_file:
+			old_bodies.unlink(missing_ok=True)
+		# closedの会話本体はファイルに任せてメモリから外す
+		self._conversations = {k: v for k, v in self._conversations.items() if v.status != ChatStatus.closed}
+		self._evicted_conversations = {}
+
+	def close(self) -> None:
+		super().close()
+		if self._bodies_fd is not None:
+			os.close(self._bodies_fd)
+			self._bodies_fd = None
+
+
+def convert_json_to_snapshot(data_dir: Path = DATA_DIR) -> Tuple[int, int, int]:
+	"""
+	data_dir の users.json / conversations.json / nfc_users.json（とWAL）から
+	datastore.snapshot を作成する。既存のスナップショットは作り直す。
+	(ユーザー数, 会話数, NFC登録数) を返す。
+	"""
+	storage = SnapshotStorage(data_dir)
+	storage.snapshot_file.unlink(missing_ok=True)
+	try:
+		storage.load()
+		if not storage.snapshot_file.exists():
+			storage.compact()
+		return len(storage._user_records), len(storage._conv_pos), len(storage._nfc_users)
+	finally:
+		storage.close()
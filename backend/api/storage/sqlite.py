@@ -0,0 +1,253 @@
+# SqliteStorage: SQLite（WALモード）による永続化
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from .base import Storage
+from .json_file import JsonStorage
+from .prompts import PromptFiles
+from ..models import ChatStatus, User, Conversation, NfcUser
+
+from backend import DATA_DIR
+
+# ロガー設定
+logger = logging.getLogger("uvicorn.error")
+
+# スキーマ
+# 検索に使う列だけを独立させ、レコード本体はJSONとしてdata列に保持する
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+	user_id   TEXT PRIMARY KEY,
+	status    TEXT NOT NULL,
+	lastlogin TEXT NOT NULL,
+	data      TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS conversations (
+	session_id    TEXT PRIMARY KEY,
+	user_id       TEXT NOT NULL,
+	status        TEXT NOT NULL,
+	last_accessed TEXT NOT NULL,
+	data          TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_conversations_user ON conversations (user_id);
+CREATE INDEX IF NOT EXISTS idx_conversations_status ON conversations (status, last_accessed);
+CREATE TABLE IF NOT EXISTS nfc_users (
+	nfc_id  TEXT PRIMARY KEY,
+	user_id TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_nfc_users_user ON nfc_users (user_id);
+CREATE TABLE IF NOT EXISTS system_prompts (
+	prompt_hash TEXT PRIMARY KEY,
+	text        TEXT NOT NULL,
+	last_used   REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_system_prompts_last_used ON system_prompts (last_used);
+"""
+
+# SQL（固定文字列にしておくことで sqlite3 のステートメントキャッシュが効く）
+_SQL_UPSERT_USER = (
+	"INSERT INTO users (user_id, status, lastlogin, data) VALUES (?, ?, ?, ?) "
+	"ON CONFLICT(user_id) DO UPDATE SET status = excluded.status, lastlogin = excluded.lastlogin, data = excluded.data"
+)
+_SQL_UPSERT_CONVERSATION = (
+	"INSERT INTO conversations (session_id, user_id, status, last_accessed, data) VALUES (?, ?, ?, ?, ?) "
+	"ON CONFLICT(session_id) DO UPDATE SET user_id = excluded.user_id, status = excluded.status, "
+	"last_accessed = excluded.last_accessed, data = excluded.data"
+)
+_SQL_UPSERT_NFC_USER = (
+	"INSERT INTO nfc_users (nfc_id, user_id) VALUES (?, ?) "
+	"ON CONFLICT(nfc_id) DO UPDATE SET user_id = excluded.user_id"
+)
+_SQL_SELECT_USER = "SELECT data FROM users WHERE user_id = ?"
+_SQL_SELECT_CONVERSATION = "SELECT data FROM conversations WHERE session_id = ?"
+_SQL_SELECT_OPEN_CONVERSATIONS = "SELECT data FROM conversations WHERE status != ?"
+_SQL_SELECT_NFC_USERS = "SELECT nfc_id, user_id FROM nfc_users"
+_SQL_SELECT_NFC_USER = "SELECT user_id FROM nfc_users WHERE nfc_id = ?"
+_SQL_SELECT_NFC_ID_BY_USER = "SELECT nfc_id FROM nfc_users WHERE user_id = ?"
+_SQL_DELETE_NFC_USER = "DELETE FROM nfc_users WHERE nfc_id = ?"
+_SQL_DELETE_CONVERSATION = "DELETE FROM conversations WHERE session_id = ?"
+_SQL_SELECT_CLOSED_BEFORE = "SELECT session_id FROM conversations WHERE status = ? AND last_accessed < ?"
+_SQL_UPSERT_PROMPT = (
+	"INSERT INTO system_prompts (prompt_hash, text, last_used) VALUES (?, ?, ?) "
+	"ON CONFLICT(prompt_hash) DO UPDATE SET last_used = excluded.last_used"
+)
+_SQL_SELECT_PROMPT = "SELECT text FROM system_prompts WHERE prompt_hash = ?"
+_SQL_DELETE_PROMPTS_BEFORE = "DELETE FROM system_prompts WHERE last_used < ?"
+
+
+def _dumps(model) -> str:
+	return json.dumps(model.model_dump(by_alias=True), default=str, ensure_ascii=False)
+
+
+class SqliteStorage(Storage):
+	"""
+	users / conversations / nfc_users を主キー付きのテーブルに保存するバックエンド。
+	- 1件の読み書きは主キー（B-tree）で O(log n)
+	- 起動時に読み込むのは closed 以外の会話とその所有ユーザー、NFCの紐付けのみ。
+	  それ以外は get_user / get_conversation で必要になった時に読み込む
+	- journal_mode=WAL により、読み込みが書き込みをブロックしない
+	"""
+	name = "sqlite"
+	incremental = True
+
+	def __init__(self, data_dir: Path = DATA_DIR, db_file: Optional[Path] = None):
+		self.data_dir = Path(data_dir)
+		self.data_dir.mkdir(parents=True, exist_ok=True)
+		self.db_file = Path(db_file) if db_file else Path(self.data_dir, "livraria.db")
+		is_new = not self.db_file.exists()
+		# DataStoreはBackgroundTasksやタイムアウト監視のスレッドからも使われるため、
+		# 1つの接続をロックで保護して共有する
+		self._lock = threading.Lock()
+		self._conn = sqlite3.connect(str(self.db_file), check_same_thread=False)
+		self._conn.execute("PRAGMA journal_mode=WAL")
+		self._conn.execute("PRAGMA synchronous=NORMAL")
+		self._conn.executescript(_SCHEMA)
+		self._conn.commit()
+		if is_new:
+			self._import_json()
+
+	def _import_json(self) -> None:
+		"""DBの新規作成時、既存のJSONスナップショットがあれば取り込む。"""
+		if not Path(self.data_dir, "users.json").exists():
+			return
+		json_storage = JsonStorage(self.data_dir)
+		_, conversations, nfc_users = json_storage.load()
+		users = {user_id: json_storage.get_user(user_id) for user_id in json_storage.user_ids()}
+		if users or conversations or nfc_users:
+			self.save_all(users, conversations, nfc_users)
+			logger.info(
+				f"[INFO] Imported JSON data into SQLite: "
+				f"{len(users)} user(s), {len(conversations)} conversation(s), {len(nfc_users)} NFC card(s)"
+			)
+
+	def load(self) -> Tuple[Dict[str, User], Dict[str, Conversation], Dict[str, NfcUser]]:
+		with self._lock:
+			conv_rows = self._conn.execute(_SQL_SELECT_OPEN_CONVERSATIONS, (ChatStatus.closed.value,)).fetchall()
+			nfc_rows = self._conn.execute(_SQL_SELECT_NFC_USERS).fetchall()
+
+		conversations: Dict[str, Conversation] = {}
+		for (data,) in conv_rows:
+			conv = Conversation(**json.loads(data))
+			conversations[conv.session_id] = conv
+
+		# 開いている会話の所有ユーザーのみ読み込む（残りはget_userで遅延読み込み）
+		users = self._load_owners(conversations)
+
+		nfc_users = {nfc_id: NfcUser(**{"_id": nfc_id, "user_id": user_id}) for nfc_id, user_id in nfc_rows}
+		return users, conversations, nfc_users
+
+	def get_user(self, user_id: str) -> Optional[User]:
+		with self._lock:
+			row = self._conn.execute(_SQL_SELECT_USER, (user_id,)).fetchone()
+		return User(**json.loads(row[0])) if row else None
+
+	def get_conversation(self, session_id: str) -> Optional[Conversation]:
+		with self._lock:
+			row = self._conn.execute(_SQL_SELECT_CONVERSATION, (session_id,)).fetchone()
+		return Conversation(**json.loads(row[0])) if row else None
+
+	# NFCの紐付け1件（複数ワーカー構成で、他のワーカーの変更を反映するために使う）
+	def get_nfc_user(self, nfc_id: str) -> Optional[NfcUser]:
+		with self._lock:
+			row = self._conn.execute(_SQL_SELECT_NFC_USER, (nfc_id,)).fetchone()
+		return NfcUser(**{"_id": nfc_id, "user_id": row[0]}) if row else None
+
+	def get_nfc_id_by_user(self, user_id: str) -> Optional[str]:
+		with self._lock:
+			row = self._conn.execute(_SQL_SELECT_NFC_ID_BY_USER, (user_id,)).fetchone()
+		return row[0] if row else None
+
+	# 書き込み用パラメータ
+	@staticmethod
+	def _user_params(user: User) -> tuple:
+		return (user.user_id, user.status.value, user.lastlogin.isoformat(), _dumps(user))
+
+	@staticmethod
+	def _conversation_params(conv: Conversation) -> tuple:
+		return (conv.session_id, conv.user_id, conv.status.value, conv.last_accessed.isoformat(), _dumps(conv))
+
+	def put_user(self, user: User) -> None:
+		params = self._user_params(user)
+		with self._lock, self._conn:
+			self._conn.execute(_SQL_UPSERT_USER, params)
+
+	def put_conversation(self, conv: Conversation) -> None:
+		params = self._conversation_params(conv)
+		with self._lock, self._conn:
+			self._conn.execute(_SQL_UPSERT_CONVERSATION, params)
+
+	def put_nfc_user(self, nfc_user: NfcUser) -> None:
+		with self._lock, self._conn:
+			self._conn.execute(_SQL_UPSERT_NFC_USER, (nfc_user.nfc_id, nfc_user.user_id))
+
+	def delete_nfc_user(self, nfc_id: str) -> None:
+		with self._lock, self._conn:
+			self._conn.execute(_SQL_DELETE_NFC_USER, (nfc_id,))
+
+	def delete_conversation(self, session_id: str) -> None:
+		with self._lock, self._conn:
+			self._conn.execute(_SQL_DELETE_CONVERSATION, (session_id,))
+
+	def closed_before(self, cutoff: datetime) -> List[str]:
+		# (status, last_accessed) のインデックスで範囲検索する
+		with self._lock:
+			rows = self._conn.execute(_SQL_SELECT_CLOSED_BEFORE, (ChatStatus.closed.value, cutoff.isoformat())).fetchall()
+		return [session_id for (session_id,) in rows]
+
+	def put_prompt(self, prompt_hash: str, text: str) -> None:
+		with self._lock, self._conn:
+			self._conn.execute(_SQL_UPSERT_PROMPT, (prompt_hash, text, time.time()))
+
+	def get_prompt(self, prompt_hash: str) -> Optional[str]:
+		with self._lock:
+			row = self._conn.execute(_SQL_SELECT_PROMPT, (prompt_hash,)).fetchone()
+		if row:
+			return row[0]
+		# 以前のバージョンが data_dir/system_prompts/ に書いたプロンプトは、見つかった時に取り込む
+		text = PromptFiles(self.data_dir).get_prompt(prompt_hash)
+		if text is not None:
+			self.put_prompt(prompt_hash, text)
+		return text
+
+	def delete_prompts_before(self, cutoff: datetime) -> int:
+		with self._lock, self._conn:
+			deleted = self._conn.execute(_SQL_DELETE_PROMPTS_BEFORE, (cutoff.timestamp(),)).rowcount
+		return deleted + PromptFiles(self.data_dir).delete_prompts_before(cutoff)
+
+	def put_batch(self, users=(), conversations=(), nfc_users=(), deleted_nfc_ids=(), deleted_session_ids=()) -> None:
+		# 1トランザクションでまとめて書き込む
+		user_params = [self._user_params(u) for u in users]
+		conv_params = [self._conversation_params(c) for c in conversations]
+		nfc_params = [(n.nfc_id, n.user_id) for n in nfc_users]
+		delete_params = [(nfc_id,) for nfc_id in deleted_nfc_ids]
+		delete_conv_params = [(session_id,) for session_id in deleted_session_ids]
+		with self._lock, self._conn:
+			self._conn.executemany(_SQL_UPSERT_USER, user_params)
+			self._conn.executemany(_SQL_UPSERT_CONVERSATION, conv_params)
+			self._conn.executemany(_SQL_UPSERT_NFC_USER, nfc_params)
+			self._conn.executemany(_SQL_DELETE_NFC_USER, delete_params)
+			self._conn.executemany(_SQL_DELETE_CONVERSATION, delete_conv_params)
+
+	def sync(self) -> None:
+		# synchronous=NORMAL ではコミットがfsyncされないため、チェックポイントでDBファイルへ反映する
+		with self._lock:
+			self._conn.execute("PRAGMA wal_checkpoint(FULL)")
+
+	def save_all(self, users, conversations, nfc_users) -> None:
+		user_params: List[tuple] = [self._user_params(u) for u in users.values()]
+		conv_params: List[tuple] = [self._conversation_params(c) for c in conversations.values()]
+		nfc_params: List[tuple] = [(n.nfc_id, n.user_id) for n in nfc_users.values()]
+		with self._lock, self._conn:
+			self._conn.executemany(_SQL_UPSERT_USER, user_params)
+			self._conn.executemany(_SQL_UPSERT_CONVERSATION, conv_params)
+			self._conn.executemany(_SQL_UPSERT_NFC_USER, nfc_params)
+
+	def close(self) -> None:
+		with self._lock:
+			self._conn.close()
@@ -0,0 +1,202 @@
+# TurnLog: アクティブな会話のターンごとの追記ログ（異常終了時の復元用）
+
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from backend import DATA_DIR, WAL_FSYNC
+
+# ロガー設定
+logger = logging.getLogger("uvicorn.error")
+
+
+class TurnLog:
+	"""
+	turns.jsonl にアクティブな会話の履歴の追記分を1ターン1行で書く。
+	  {"session_id", "user_id", "start", "messages"}
+	  start は追記分の先頭のメッセージ番号（それより前の履歴は以前の行か保存済みのmessagesにある）
+	- append() は行を作ってキューに入れるだけで、ファイルへの書き込みはバックグラウンドスレッドが行う
+	- 起動時に replay() で会話ごとの追記分を読み、復元・保存が終わったら reset() で空にする
+	- pause/close で保存した会話は discard() で {"session_id", "discard": true} を書き、
+	  それより前の行は replay() で使わない。compact() でそれらの行を取り除く
+	"""
+
+	def __init__(self, data_dir: Path = DATA_DIR, fsync: bool = WAL_FSYNC):
+		self.log_file = Path(data_dir, "turns.jsonl")
+		self.fsync = fsync
+		self._queue: "queue.Queue[Optional[str]]" = queue.Queue()
+		self._lock = threading.Lock()  # 行数の記録とキューへの追加を保護
+		self._io_lock = threading.Lock()  # ファイルへの書き込みを直列化
+		# 会話ごとのファイル上の行数と、そのうち保存済み（不要）になった先頭の行数
+		self._lines: Dict[str, int] = {}
+		self._dead: Dict[str, int] = {}
+		self._thread: Optional[threading.Thread] = None
+		self._closed = False
+
+	def append(self, session_id: str, user_id: str, start: int, messages: List[dict]) -> None:
+		"""会話の履歴の start 番目以降（messages_to_dict 形式）を追記する。"""
+		self._put(session_id, {"session_id": session_id, "user_id": user_id, "start": start, "messages": messages})
+
+	def _put(self, session_id: str, record: dict) -> None:
+		with self._lock:
+			self._enqueue(session_id, record)
+
+	def _enqueue(self, session_id: str, record: dict) -> None:
+		"""行をキューに入れる（_lock を持って呼ぶ）。"""
+		if self._closed:
+			return
+		if self._thread is None:
+			self._thread = threading.Thread(target=self._run, name="datastore-turn-log", daemon=True)
+			self._thread.start()
+			# close() を呼ばずにプロセスが終了した場合も残りを書き出す
+			atexit.register(self.close)
+		self._lines[session_id] = self._lines.get(session_id, 0) + 1
+		self._queue.put(json.dumps(record, ensure_ascii=False) + "\n")
+
+	def _run(self) -> None:
+		while True:
+			line = self._queue.get()
+			if line is None:
+				self._queue.task_done()
+				return
+			# 溜まっている行はまとめて1回で書く
+			lines = [line]
+			stop = False
+			while True:
+				try:
+					line = self._queue.get_nowait()
+				except queue.Empty:
+					break
+				if line is None:
+					stop = True
+					break
+				lines.append(line)
+			try:
+				self._write("".join(lines))
+			except Exception as e:
+				logger.error(f"[ERROR] Turn log write failed ({len(lines)} record(s)): {e}")
+			for _ in range(len(lines) + stop):
+				self._queue.task_done()
+			if stop:
+				return
+
+	def _write(self, data: str) -> None:
+		with self._io_lock:
+			self.log_file.parent.mkdir(parents=True, exist_ok=True)
+			with open(self.log_file, "a", encoding="utf-8") as f:
+				f.write(data)
+				f.flush()
+				if self.fsync:
+					os.fsync(f.fileno())
+
+	def flush(self) -> None:
+		"""キューに入っている行がすべて書き込まれるまで待つ。"""
+		self._queue.join()
+
+	def discard(self, session_id: str) -> None:
+		"""会話の履歴を保存した（これまでの行は復元に使わない）ことを記録する。"""
+		with self._lock:
+			if not self._lines.get(session_id):
+				return
+			self._enqueue(session_id, {"session_id": session_id, "discard": True})
+			self._dead[session_id] = self._lines[session_id]
+
+	def replay(self) -> Dict[str, Tuple[str, List[Tuple[int, List[dict]]]]]:
+		"""
+		ファイルを読み、session_id → (user_id, [(start, messages), ...]) を書かれた順に返す。
+		書きかけ・壊れた行以降は読まない（異常終了時の最後の行）。
+		"""
+		turns: Dict[str, Tuple[str, List[Tuple[int, List[dict]]]]] = {}
+		try:
+			f = open(self.log_file, "rb")
+		except FileNotFoundError:
+			return turns
+		with f:
+			for number, line in enumerate(f, 1):
+				if not line.endswith(b"\n"):
+					break
+				if not line.strip():
+					continue
+				try:
+					record = json.loads(line)
+					session_id = record["session_id"]
+					if record.get("discard"):
+						turns.pop(session_id, None)
+						continue
+					entry = (int(record["start"]), list(record["messages"]))
+					user_id = record.get("user_id") or ""
+				except Exception as e:
+					logger.warning(f"[WARNING] Turn log replay stopped at line {number}: {e}")
+					break
+				turns.setdefault(session_id, (user_id, []))[1].append(entry)
+		return turns
+
+	def reset(self) -> None:
+		"""ファイルを空にする（すべての会話を保存し終えた後に呼ぶ）。"""
+		with self._lock:
+			self.flush()
+			with self._io_lock:
+				if self.log_file.exists():
+					self.log_file.write_bytes(b"")
+			self._lines.clear()
+			self._dead.clear()
+
+	def compact(self) -> int:
+		"""
+		discard() した会話の行を取り除いてファイルを書き直す。取り除いた行数を返す。
+		不要な行が残りの行より少ない間は何もしない。
+		呼び出し側は discard() した会話の保存が永続化されてから呼ぶこと（write-behindの書き出し後）。
+		"""
+		with self._lock:
+			dead = sum(self._dead.values())
+			if dead == 0 or dead < sum(self._lines.values()) - dead:
+				return 0
+			self.flush()
+			with self._io_lock:
+				skip = dict(self._dead)
+				tmp_path = self.log_file.with_name(self.log_file.name + ".tmp")
+				with open(self.log_file, "rb") as src, open(tmp_path, "wb") as dst:
+					for line in src:
+						if not line.endswith(b"\n"):
+							break
+						try:
+							session_id = json.loads(line)["session_id"]
+						except Exception:
+							break
+						if skip.get(session_id, 0) > 0:
+							skip[session_id] -= 1
+							continue
+						dst.write(line)
+					dst.flush()
+					os.fsync(dst.fileno())
+				os.replace(tmp_path, self.log_file)
+			for session_id, count in self._dead.items():
+				remaining = self._lines[session_id] - count
+				if remaining > 0:
+					self._lines[session_id] = remaining
+				else:
+					del self._lines[session_id]
+			self._dead.clear()
+		logger.info(f"[INFO] Turn log compacted: dropped {dead} line(s)")
+		return dead
+
+	def __len__(self) -> int:
+		"""ファイル上の（書き込み待ちを含む）行数。"""
+		with self._lock:
+			return sum(self._lines.values())
+
+	def close(self) -> None:
+		"""残りの行を書き込んでからスレッドを止める。"""
+		with self._lock:
+			if self._closed:
+				return
+			self._closed = True
+			thread = self._thread
+		if thread is not None:
+			self._queue.put(None)
+			thread.join()
@@ -0,0 +1,182 @@
+# WalStorage: 追記型ログ（Write-Ahead Log）+ 定期スナップショット方式
+
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+from .base import Storage
+from .json_file import JsonStorage
+from ..models import User, Conversation, NfcUser
+
+from backend import DATA_DIR, WAL_COMPACT_THRESHOLD, WAL_FSYNC
+
+# ロガー設定
+logger = logging.getLogger("uvicorn.error")
+
+# レコード種別 → モデル
+_MODELS = {
+	"conversation": Conversation,
+	"nfc_user": NfcUser,
+}
+
+
+class WalStorage(JsonStorage):
+	"""
+	変更を1行1レコードのJSONとしてログへ追記するバックエンド。
+	- 書き込みコストは変更したレコードのサイズに比例する
+	- レコード数が compact_threshold に達したらJSONスナップショットへ圧縮しログを空にする
+	- 起動時はスナップショットを読み込んだ後、ログを先頭から再生する
+
+	スナップショットのファイル形式はJsonStorageと同じなので、json ⇔ wal の切り替えは
+	圧縮済みの状態であればそのまま行える。
+	"""
+	name = "wal"
+	incremental = True
+
+	def __init__(
+		self,
+		data_dir: Path = DATA_DIR,
+		compact_threshold: int = WAL_COMPACT_THRESHOLD,
+		fsync: bool = WAL_FSYNC
+	):
+		super().__init__(data_dir)
+		self.wal_file = Path(self.data_dir, "datastore.wal")
+		self.compact_threshold = compact_threshold
+		self.fsync = fsync
+		self._log = None
+		self._record_count = 0
+
+	def load(self) -> Tuple[Dict[str, User], Dict[str, Conversation], Dict[str, NfcUser]]:
+		self._load_files()
+		replayed = self._replay()
+		if replayed > 0:
+			logger.info(f"[INFO] Replayed {replayed} WAL record(s)")
+		self._record_count = replayed
+		self._open_log()
+		conversations = dict(self._conversations)
+		return self._load_owners(conversations), conversations, dict(self._nfc_users)
+
+	def _replay(self) -> int:
+		"""ログを再生して内部dictへ反映する。再生したレコード数を返す。"""
+		if not self.wal_file.exists():
+			return 0
+
+		count = 0
+		with open(self.wal_file, "r", encoding="utf-8") as f:
+			for line_no, line in enumerate(f, 1):
+				line = line.strip()
+				if not line:
+					continue
+				try:
+					record = json.loads(line)
+					self._apply(record)
+					count += 1
+				except Exception as e:
+					# 末尾の書きかけレコード（クラッシュ時）はここで打ち切る
+					logger.warning(f"[WARNING] WAL replay stopped at line {line_no}: {e}")
+					break
+		return count
+
+	def _apply(self, record: Dict[str, Any]) -> None:
+		"""WALレコード1件を内部dictへ反映する。"""
+		op = record["op"]
+		kind = record["kind"]
+		if kind == "user" and op == "put":
+			# ユーザーはスナップショットと同様、要求されるまでUserに変換しない
+			self._set_user_record(record["key"], record["data"])
+			return
+		target = self._target(kind)
+		if op == "put":
+			obj = _MODELS[kind](**record["data"])
+			target[record["key"]] = obj
+		elif op == "delete":
+			target.pop(record["key"], None)
+		else:
+			raise ValueError(f"Unknown WAL op: {op}")
+
+	def _target(self, kind: str) -> Dict[str, Any]:
+		if kind == "conversation":
+			return self._conversations
+		if kind == "nfc_user":
+			return self._nfc_users
+		raise ValueError(f"Unknown WAL kind: {kind}")
+
+	def _open_log(self) -> None:
+		if self._log is None:
+			self._log = open(self.wal_file, "a", encoding="utf-8")
+
+	def _append(self, record: Dict[str, Any]) -> None:
+		"""レコードをログへ追記し、閾値を超えたら圧縮する。"""
+		self._open_log()
+		self._log.write(json.dumps(record, default=str, ensure_ascii=False) + "\n")
+		self._log.flush()
+		if self.fsync:
+			os.fsync(self._log.fileno())
+		self._record_count += 1
+		if self._record_count >= self.compact_threshold:
+			self.compact()
+
+	def compact(self) -> None:
+		"""
+		内部dictをJSONスナップショットへ書き出し、ログを空にする。
+		スナップショット書き込み後・ログ削除前にクラッシュしても、
+		putレコードは冪等なので再生結果は変わらない。
+		"""
+		self._write_all()
+		if self._log is not None:
+			self._log.close()
+		self._log = open(self.wal_file, "w", encoding="utf-8")
+		if self.fsync:
+			os.fsync(self._log.fileno())
+		logger.info(f"[INFO] WAL compacted ({self._record_count} record(s))")
+		self._record_count = 0
+
+	def put_user(self, user: User) -> None:
+		self._remember_user(user)
+		self._append({"op": "put", "kind": "user", "key": user.user_id, "data": user.model_dump(by_alias=True)})
+
+	def put_conversation(self, conv: Conversation) -> None:
+		self._conversations[conv.session_id] = conv
+		self._evicted_conversations.pop(conv.session_id, None)
+		self._append({"op": "put", "kind": "conversation", "key": conv.session_id, "data": conv.model_dump(by_alias=True)})
+
+	def put_nfc_user(self, nfc_user: NfcUser) -> None:
+		self._nfc_users[nfc_user.nfc_id] = nfc_user
+		self._append({"op": "put", "kind": "nfc_user", "key": nfc_user.nfc_id, "data": nfc_user.model_dump(by_alias=True)})
+
+	def delete_nfc_user(self, nfc_id: str) -> None:
+		if self._nfc_users.pop(nfc_id, None) is not None:
+			self._append({"op": "delete", "kind": "nfc_user", "key": nfc_id})
+
+	def delete_conversation(self, session_id: str) -> None:
+		found = self._conversations.pop(session_id, None) is not None
+		found = self._evicted_conversations.pop(session_id, None) is not None or found
+		if found:
+			self._append({"op": "delete", "kind": "conversation", "key": session_id})
+
+	def put_batch(self, users=(), conversations=(), nfc_users=(), deleted_nfc_ids=(), deleted_session_ids=()) -> None:
+		# 変更はすべてログへ追記する（スナップショットは圧縮時のみ書き直す）
+		Storage.put_batch(self, users, conversations, nfc_users, deleted_nfc_ids, deleted_session_ids)
+
+	def sync(self) -> None:
+		# 変更はログに追記されるため、ログと、圧縮で書き直したスナップショットだけをfsyncすればよい
+		if self._log is not None:
+			self._log.flush()
+			os.fsync(self._log.fileno())
+		super().sync()
+
+	def save_all(self, users, conversations, nfc_users) -> None:
+		for user in users.values():
+			self._remember_user(user)
+		self._conversations.update(conversations)
+		for session_id in conversations:
+			self._evicted_conversations.pop(session_id, None)
+		self._nfc_users = dict(nfc_users)
+		self.compact()
+
+	def close(self) -> None:
+		if self._log is not None:
+			self._log.close()
+			self._log = None
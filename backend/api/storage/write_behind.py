@@ -0,0 +1,238 @@
+# WriteBehindStorage: 変更をメモリ上で集約し、バックグラウンドスレッドでまとめて書き出すラッパー
+
+import atexit
+import logging
+import threading
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from .base import Storage
+from ..models import User, Conversation, NfcUser
+
+from backend import WRITE_BEHIND_INTERVAL, WRITE_BEHIND_FSYNC
+
+# ロガー設定
+logger = logging.getLogger("uvicorn.error")
+
+# 削除予約を表す値
+_DELETED = None
+
+
+class WriteBehindStorage(Storage):
+	"""
+	他のStorageを包み、put_* / delete_* を「dirty」として記録するだけで即座に返すバックエンド。
+	- 同じレコードへの変更は最新の1件にまとめられる（キーは種類とID）
+	- interval 秒ごとにバックグラウンドスレッドが溜まった変更を inner.put_batch で書き出す
+	- fsync=True の場合は書き出しのたびに inner.sync() を呼ぶ
+	- close() でスレッドを止め、残っている変更をすべて書き出してから inner を閉じる
+	- evict_* は書き出し待ちのレコードなら、書き出した後で inner に渡す
+
+	書き出し前のレコードは get_user / get_conversation で返すため、読み込み側から見て
+	変更が失われることはない。
+	"""
+	deferred = True
+
+	def __init__(
+		self,
+		inner: Storage,
+		interval: float = WRITE_BEHIND_INTERVAL,
+		fsync: bool = WRITE_BEHIND_FSYNC
+	):
+		self.inner = inner
+		self.name = inner.name
+		self.incremental = inner.incremental
+		self.data_dir = getattr(inner, "data_dir", None)
+		self.interval = interval
+		self.fsync = fsync
+		# 書き出し直前に会話を変換するフック（DataStoreがメモリ上の履歴をmessagesへ詰める）
+		self.prepare_conversation: Optional[Callable[[Conversation], Conversation]] = None
+		# (種類, ID) → 書き出すオブジェクト（NFC・会話の削除は _DELETED）
+		self._dirty: Dict[Tuple[str, str], Optional[object]] = {}
+		# 書き出し後に inner で手放すレコード（種類, ID）
+		self._evictions: Set[Tuple[str, str]] = set()
+		self._lock = threading.Lock()  # _dirty を保護
+		self._io_lock = threading.Lock()  # inner への読み書きを直列化
+		self._stop = threading.Event()
+		self._closed = False
+		self._thread = threading.Thread(target=self._run, name="datastore-write-behind", daemon=True)
+		self._thread.start()
+		# close() を呼ばずにプロセスが終了した場合も残りを書き出す
+		atexit.register(self.close)
+
+	def _run(self) -> None:
+		while not self._stop.wait(self.interval):
+			self.flush()
+
+	def _mark(self, kind: str, key: str, obj: Optional[object]) -> None:
+		with self._lock:
+			self._dirty[(kind, key)] = obj
+
+	def _pending(self, kind: str, key: str) -> Tuple[bool, Optional[object]]:
+		with self._lock:
+			if (kind, key) in self._dirty:
+				return True, self._dirty[(kind, key)]
+		return False, None
+
+	def pending_count(self) -> int:
+		"""まだ書き出していない変更の件数。"""
+		with self._lock:
+			return len(self._dirty)
+
+	def flush(self) -> int:
+		"""
+		溜まった変更をまとめて書き出す。書き出した件数を返す。
+		失敗した場合、その間に新しい変更がなかったレコードは次回に再試行する。
+		"""
+		with self._lock:
+			batch = self._dirty
+			self._dirty = {}
+			evictions = self._evictions
+			self._evictions = set()
+		if not batch:
+			return 0
+
+		users = []
+		conversations = []
+		nfc_users = []
+		deleted_nfc_ids = []
+		deleted_session_ids = []
+		for (kind, key), obj in batch.items():
+			if kind == "user":
+				users.append(obj)
+			elif kind == "conversation":
+				if obj is _DELETED:
+					deleted_session_ids.append(key)
+				else:
+					conversations.append(self._prepare(obj))
+			elif obj is _DELETED:
+				deleted_nfc_ids.append(key)
+			else:
+				nfc_users.append(obj)
+
+		try:
+			with self._io_lock:
+				self.inner.put_batch(users, conversations, nfc_users, deleted_nfc_ids, deleted_session_ids)
+				if self.fsync:
+					self.inner.sync()
+				for kind, key in evictions:
+					self._evict_inner(kind, key)
+		except Exception as e:
+			logger.error(f"[ERROR] Write-behind flush failed ({len(batch)} record(s)): {e}")
+			with self._lock:
+				for k, obj in batch.items():
+					self._dirty.setdefault(k, obj)
+				self._evictions |= evictions
+			return 0
+		return len(batch)
+
+	def _prepare(self, conv: Conversation) -> Conversation:
+		if self.prepare_conversation is None:
+			return conv
+		try:
+			return self.prepare_conversation(conv)
+		except Exception as e:
+			# 履歴を変換できない場合でも、会話のメタデータは書き出す
+			logger.warning(f"[WARNING] Failed to snapshot history of {conv.session_id}: {e}")
+			return conv
+
+	# 読み込み
+	def load(self):
+		with self._io_lock:
+			return self.inner.load()
+
+	def get_user(self, user_id: str) -> Optional[User]:
+		found, user = self._pending("user", user_id)
+		if found:
+			return user
+		with self._io_lock:
+			return self.inner.get_user(user_id)
+
+	def get_conversation(self, session_id: str) -> Optional[Conversation]:
+		found, conv = self._pending("conversation", session_id)
+		if found:
+			return conv
+		with self._io_lock:
+			return self.inner.get_conversation(session_id)
+
+	# 書き込み（記録するだけ）
+	def put_user(self, user: User) -> None:
+		self._mark("user", user.user_id, user)
+
+	def put_conversation(self, conv: Conversation) -> None:
+		self._mark("conversation", conv.session_id, conv)
+
+	def put_nfc_user(self, nfc_user: NfcUser) -> None:
+		self._mark("nfc_user", nfc_user.nfc_id, nfc_user)
+
+	def delete_nfc_user(self, nfc_id: str) -> None:
+		self._mark("nfc_user", nfc_id, _DELETED)
+
+	def delete_conversation(self, session_id: str) -> None:
+		self._mark("conversation", session_id, _DELETED)
+
+	def evict_user(self, user_id: str) -> None:
+		self._evict("user", user_id)
+
+	def evict_conversation(self, session_id: str) -> None:
+		self._evict("conversation", session_id)
+
+	def _evict(self, kind: str, key: str) -> None:
+		with self._lock:
+			if (kind, key) in self._dirty:
+				# inner にはまだ古い内容しかないため、書き出した後で手放す
+				self._evictions.add((kind, key))
+				return
+		with self._io_lock:
+			self._evict_inner(kind, key)
+
+	def _evict_inner(self, kind: str, key: str) -> None:
+		if kind == "user":
+			self.inner.evict_user(key)
+		else:
+			self.inner.evict_conversation(key)
+
+	# システムプロンプトは会話より先に読めるよう、すぐ inner に書く
+	def put_prompt(self, prompt_hash: str, text: str) -> None:
+		with self._io_lock:
+			self.inner.put_prompt(prompt_hash, text)
+
+	def get_prompt(self, prompt_hash: str) -> Optional[str]:
+		with self._io_lock:
+			return self.inner.get_prompt(prompt_hash)
+
+	def delete_prompts_before(self, cutoff: datetime) -> int:
+		with self._io_lock:
+			return self.inner.delete_prompts_before(cutoff)
+
+	def closed_before(self, cutoff: datetime) -> List[str]:
+		# 書き出し前の変更を反映してから inner に問い合わせる
+		self.flush()
+		with self._io_lock:
+			return self.inner.closed_before(cutoff)
+
+	def save_all(self, users, conversations, nfc_users) -> None:
+		self.flush()
+		conversations = {k: self._prepare(v) for k, v in conversations.items()}
+		with self._io_lock:
+			self.inner.save_all(users, conversations, nfc_users)
+
+	def sync(self) -> None:
+		self.flush()
+		with self._io_lock:
+			self.inner.sync()
+
+	def close(self) -> None:
+		"""スレッドを止め、残りの変更を書き出してから inner を閉じる。"""
+		if self._closed:
+			return
+		self._closed = True
+		self._stop.set()
+		self._thread.join()
+		count = self.flush()
+		if count > 0:
+			logger.info(f"[INFO] Write-behind drained {count} record(s)")
+		if self.fsync:
+			with self._io_lock:
+				self.inner.sync()
+		with self._io_lock:
+			self.inner.close()
@@ -0,0 +1,647 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+DataStoreのスレッドセーフ性のストレステスト
+複数スレッド（と複数ワーカー構成では複数プロセス）から同時に操作し、終了後にデータの整合性を確認する
+一時ディレクトリを使うため、backend/api/data のデータには影響しない
+"""
+
+import sys
+import random
+import tempfile
+import time
+import threading
+from pathlib import Path
+from datetime import datetime, timedelta
+
+# プロジェクトルートをパスに追加
+project_root = Path(__file__).resolve().parent.parent.parent
+sys.path.insert(0, str(project_root))
+
+THREADS = 8
+USERS = 6
+ITERATIONS = 200
+
+
+def _run_threads(target, count=THREADS):
+	"""count個のスレッドで target(index) を同時に実行し、発生した例外のリストを返す。"""
+	errors = []
+	barrier = threading.Barrier(count)
+
+	def worker(index):
+		try:
+			barrier.wait()
+			target(index)
+		except Exception as e:
+			import traceback
+			errors.append((index, e, traceback.format_exc()))
+
+	threads = [threading.Thread(target=worker, args=(i,)) for i in range(count)]
+	for t in threads:
+		t.start()
+	for t in threads:
+		t.join()
+	return errors
+
+
+def _check_invariants(ds):
+	"""メモリ上のデータの整合性を確認する。"""
+	from backend.api.models import ChatStatus
+
+	# NFCの逆引きと正引きが一致する
+	for user_id, nfc_id in ds.nfc_by_user.items():
+		assert ds.nfc_users[nfc_id].user_id == user_id
+	assert len(ds.nfc_by_user) == len(ds.nfc_users)
+	# アクティブセッション索引と会話のstatusが一致する
+	for user_id, session_ids in ds.active_sessions.items():
+		for session_id in session_ids:
+			conv = ds.conversations[session_id]
+			assert conv.status == ChatStatus.active and conv.user_id == user_id
+	for session_id, conv in ds.conversations.items():
+		if conv.status == ChatStatus.active:
+			assert session_id in ds.active_sessions.get(conv.user_id, ())
+	# closedの会話はメモリ上の履歴を持たない
+	for session_id in ds.sessions:
+		assert ds.conversations[session_id].status != ChatStatus.closed
+
+
+def test_concurrent_history_updates():
+	"""同じセッションへの同時更新で履歴が失われないことのテスト"""
+	print("\n" + "=" * 60)
+	print("  同一セッション同時更新テスト")
+	print("=" * 60)
+
+	try:
+		from backend.api.storage import JsonStorage
+		from backend.api.datastore import DataStore
+		from backend.api.models import Personal
+		from langchain_core.messages import HumanMessage
+
+		with tempfile.TemporaryDirectory() as tmp:
+			ds = DataStore(storage=JsonStorage(data_dir=tmp))
+			user_id = "test_concurrency_user_001"
+			ds.create_user(user_id, Personal(name="Concurrent User", gender="male", age=20))
+			session_id = ds.create_session(user_id)
+
+			print(f"\n[TEST] {THREADS}スレッド × {ITERATIONS // 4}ターン...")
+			def chat(index):
+				for i in range(ITERATIONS // 4):
+					# server._chat_turn と同じく、取得 → 更新をセッションのロック内で行う
+					with ds.session_lock(session_id):
+						history = list(ds.get_history(session_id))
+						history.append(HumanMessage(content=f"{index}-{i}"))
+						ds.update_history(session_id, history)
+
+			errors = _run_threads(chat)
+			assert not errors, errors[0][2]
+			assert len(ds.get_history(session_id)) == THREADS * (ITERATIONS // 4)
+			print(f"[SUCCESS] {THREADS * (ITERATIONS // 4)}件すべての更新が残った")
+
+			ds.close_session(session_id)
+			ds.close()
+		return True
+	except Exception as e:
+		print(f"[ERROR] テストエラー: {e}")
+		import traceback
+		traceback.print_exc()
+		return False
+
+
+def test_concurrent_operations():
+	"""複数スレッドからのランダムな操作のテスト"""
+	print("\n" + "=" * 60)
+	print("  ランダム操作ストレステスト")
+	print("=" * 60)
+
+	try:
+		from backend.api.storage import JsonStorage, WriteBehindStorage
+		from backend.api.datastore import DataStore
+		from backend.api.models import Personal, BookData, ChatStatus
+		from langchain_core.messages import HumanMessage, AIMessage
+
+		with tempfile.TemporaryDirectory() as tmp:
+			# 書き出しスレッドも同時に動かす
+			storage = WriteBehindStorage(JsonStorage(data_dir=tmp), interval=0.01)
+			ds = DataStore(storage=storage)
+			user_ids = [f"test_concurrency_user_{i:03d}" for i in range(USERS)]
+			for i, user_id in enumerate(user_ids):
+				ds.create_user(user_id, Personal(name=f"Stress User {i}", gender="other", age=20 + i))
+
+			def worker(index):
+				rng = random.Random(index)
+				for i in range(ITERATIONS):
+					user_id = rng.choice(user_ids)
+					op = rng.random()
+					if op < 0.3:
+						# チャットの1ターン
+						with ds.user_lock(user_id):
+							user = ds.get_user(user_id)
+							session_id = user.active_session if user.active_session in ds.sessions else ds.create_session(user_id)
+						with ds.session_lock(session_id):
+							history = list(ds.get_history(session_id))
+							history += [HumanMessage(content=f"質問{index}-{i}"), AIMessage(content="回答")]
+							ds.update_history(session_id, history)
+					elif op < 0.4:
+						user = ds.get_user(user_id)
+						if user.active_session:
+							try:
+								ds.close_session(user.active_session)
+							except KeyError:
+								pass
+					elif op < 0.5:
+						# タイムアウト監視スレッドと同じ操作（期限を過去にしてから）
+						with ds.user_lock(user_id):
+							ds.users[user_id].lastlogin = datetime.now() - timedelta(days=1)
+							ds.reschedule_timeout(user_id)
+						ds.check_user_timeout()
+					elif op < 0.6:
+						ds.register_nfc(f"card_{index}_{i % 3}", user_id)
+					elif op < 0.65:
+						nfc_id = ds.get_nfc_by_user_id(user_id)
+						if nfc_id:
+							ds.unregister_nfc(nfc_id)
+					elif op < 0.75:
+						ds.add_recommendation(user_id, BookData(**{"_id": f"isbn-{index}-{i}", "title": "本"}), "テスト")
+					elif op < 0.85:
+						ds.update_user(user_id, ai_insights=f"insight {index}-{i}")
+					elif op < 0.95:
+						for session_id in list(ds.get_user(user_id).old_session[-3:]):
+							ds.get_history_dicts(session_id)
+					else:
+						ds.save_file()
+
+			print(f"\n[TEST] {THREADS}スレッド × {ITERATIONS}操作...")
+			errors = _run_threads(worker)
+			assert not errors, errors[0][2]
+			_check_invariants(ds)
+			print("[SUCCESS] 例外なし・メモリ上の索引は整合")
+
+			print("\n[TEST] 保存されたデータとの一致...")
+			for session_id in list(ds.sessions):
+				ds.close_session(session_id)
+			expected_users = {user_id: ds.get_user(user_id).model_dump() for user_id in user_ids}
+			expected_nfc = {nfc_id: n.user_id for nfc_id, n in ds.nfc_users.items()}
+			expected_convs = {session_id: len(conv.messages) for session_id, conv in ds.conversations.items()}
+			ds.close()
+
+			reloaded = DataStore(storage=JsonStorage(data_dir=tmp))
+			assert {nfc_id: n.user_id for nfc_id, n in reloaded.nfc_users.items()} == expected_nfc
+			for user_id in user_ids:
+				user = reloaded.get_user(user_id).model_dump()
+				for key in ("ai_insights", "active_session", "old_session", "recommend_log"):
+					assert user[key] == expected_users[user_id][key], key
+			for session_id, count in expected_convs.items():
+				conv = reloaded._get_conversation(session_id)
+				assert conv.status == ChatStatus.closed and len(conv.messages) == count
+			print(f"[SUCCESS] ユーザー{len(user_ids)}件・会話{len(expected_convs)}件が保存内容と一致")
+
+		return True
+	except Exception as e:
+		print(f"[ERROR] テストエラー: {e}")
+		import traceback
+		traceback.print_exc()
+		return False
+
+
+def _shared_worker(tmp, session_id, index, turns):
+	"""別プロセスのワーカー: 共有DBを開き、同じセッションに turns ターン追記する。"""
+	sys.path.insert(0, str(project_root))
+	from backend.api.storage import SqliteStorage
+	from backend.api.datastore import DataStore
+	from langchain_core.messages import HumanMessage
+
+	ds = DataStore(storage=SqliteStorage(data_dir=tmp), shared=True)
+	for i in range(turns):
+		with ds.session_lock(session_id):
+			history = list(ds.get_history(session_id))
+			history.append(HumanMessage(content=f"{index}-{i}"))
+			ds.update_history(session_id, history)
+	ds.close()
+
+
+def test_shared_workers():
+	"""複数ワーカー構成（sqliteの共有）で、同じセッションへの更新が失われないことのテスト"""
+	print("\n" + "=" * 60)
+	print("  複数ワーカー共有テスト")
+	print("=" * 60)
+
+	try:
+		import multiprocessing
+		from backend.api.storage import SqliteStorage, JsonStorage
+		from backend.api.datastore import DataStore
+		from backend.api.models import Personal, ChatStatus
+		from backend.api.locks import LockTimeout
+
+		with tempfile.TemporaryDirectory() as tmp:
+			print("\n[TEST] sqlite以外のバックエンドは拒否...")
+			try:
+				DataStore(storage=JsonStorage(data_dir=tmp), shared=True)
+				raise AssertionError("ValueError was not raised")
+			except ValueError:
+				pass
+			print("[SUCCESS] ValueError")
+
+			a = DataStore(storage=SqliteStorage(data_dir=tmp), shared=True)
+			b = DataStore(storage=SqliteStorage(data_dir=tmp), shared=True)
+			user_id = "test_shared_user_001"
+			a.create_user(user_id, Personal(name="Shared User", gender="female", age=30))
+
+			print("\n[TEST] 他のワーカーの変更が見える...")
+			session_id = a.create_session(user_id)
+			assert b.get_user(user_id).active_session == session_id
+			a.register_nfc("shared_card", user_id)
+			assert b.get_user_by_nfc("shared_card") == user_id
+			b.update_user(user_id, ai_insights="from b")
+			assert a.get_user(user_id).ai_insights == "from b"
+			print("[SUCCESS] セッション・NFC・ユーザーの変更が共有された")
+
+			print("\n[TEST] 他のワーカーが処理中のセッションは取得できない...")
+			a.leases.wait = 0.2
+			with b.session_lock(session_id):
+				try:
+					with a.session_lock(session_id):
+						raise AssertionError("LockTimeout was not raised")
+				except LockTimeout:
+					pass
+			with a.session_lock(session_id):
+				pass
+			print("[SUCCESS] LockTimeout")
+
+			print("\n[TEST] 他のワーカーが処理中のユーザーも読み込みは待たされない...")
+			b.leases.wait = 0.2
+			with a.user_lock(user_id):
+				assert b.get_user(user_id).user_id == user_id
+			print("[SUCCESS] lastloginを保存しない読み込みはリースを取らない")
+
+			print("\n[TEST] ai_insightsの保存で他のワーカーの変更を上書きしない...")
+			from backend.api import datastore as datastore_module
+			other_id = "test_shared_user_002"
+			a.create_user(other_id, Personal(name="Other User", gender="male", age=40))
+			first = a.create_session(other_id)
+			a.close_session(first)
+			a.conversations[first].summary = "要約"
+			new_sessions = []
+
+			def fake_summary(prompt_path, text, ai_insight=None):
+				# LLM呼び出しの間に他のワーカーで新しいセッションが始まる
+				new_sessions.append(b.create_session(other_id))
+				return "insight"
+
+			original_summary = datastore_module.summary_function
+			datastore_module.summary_function = fake_summary
+			try:
+				a._update_insights(first, a.conversations[first])
+			finally:
+				datastore_module.summary_function = original_summary
+			stored = SqliteStorage(data_dir=tmp).get_user(other_id)
+			assert stored.ai_insights == "insight"
+			assert stored.active_session == new_sessions[0]
+			print("[SUCCESS] ai_insightsだけを更新")
+
+			print("\n[TEST] ttlより長く保持してもリースが延長される...")
+			from backend.api.storage import SqliteLeases
+			first = SqliteLeases(Path(tmp) / "leases.sqlite3", ttl=0.3, wait=0.2)
+			second = SqliteLeases(Path(tmp) / "leases.sqlite3", ttl=0.3, wait=0.2)
+			with first.hold("session:long_turn"):
+				time.sleep(1.0)
+				try:
+					with second.hold("session:long_turn"):
+						raise AssertionError("LockTimeout was not raised")
+				except LockTimeout:
+					pass
+			with second.hold("session:long_turn"):
+				pass
+			first.close()
+			second.close()
+			print("[SUCCESS] 延長されたリースは他のワーカーに取得されない")
+			a.close()
+			b.close()
+
+			turns = 20
+			print(f"\n[TEST] 2プロセス × {turns}ターン...")
+			context = multiprocessing.get_context("spawn")
+			processes = [context.Process(target=_shared_worker, args=(tmp, session_id, i, turns)) for i in range(2)]
+			for process in processes:
+				process.start()
+			for process in processes:
+				process.join(timeout=120)
+				assert process.exitcode == 0, f"exitcode={process.exitcode}"
+
+			ds = DataStore(storage=SqliteStorage(data_dir=tmp), shared=True)
+			assert len(ds.get_history(session_id)) == 2 * turns
+			ds.close_session(session_id)
+			conv = ds._get_conversation(session_id)
+			assert conv.status == ChatStatus.closed and len(conv.messages) == 2 * turns
+			assert ds.get_user(user_id).active_session is None
+			ds.close()
+			print(f"[SUCCESS] {2 * turns}件すべての更新が残った")
+
+		return True
+	except Exception as e:
+		print(f"[ERROR] テストエラー: {e}")
+		import traceback
+		traceback.print_exc()
+		return False
+
+
+def test_llm_pool():
+	"""LLM用スレッドプールのテスト（同時実行数の上限と、待っている間のイベントループの応答）"""
+	print("\n" + "=" * 60)
+	print("  LLMスレッドプールテスト")
+	print("=" * 60)
+
+	try:
+		import asyncio
+		from backend.api.llm import run_in_llm_pool
+		from backend import LLM_MAX_CONCURRENCY
+
+		running = 0
+		peak = 0
+		lock = threading.Lock()
+
+		def slow_turn(index):
+			# 同期のLLM呼び出しの代わり
+			nonlocal running, peak
+			with lock:
+				running += 1
+				peak = max(peak, running)
+			time.sleep(0.2)
+			with lock:
+				running -= 1
+			return index
+
+		async def scenario():
+			ticks = 0
+			done = asyncio.Event()
+
+			async def heartbeat():
+				# ヘルスチェック等の軽いリクエストの代わり
+				nonlocal ticks
+				while not done.is_set():
+					ticks += 1
+					await asyncio.sleep(0.01)
+
+			beat = asyncio.create_task(heartbeat())
+			results = await asyncio.gather(*(run_in_llm_pool(slow_turn, i) for i in range(LLM_MAX_CONCURRENCY * 2)))
+			done.set()
+			await beat
+			return results, ticks
+
+		print(f"\n[TEST] {LLM_MAX_CONCURRENCY * 2}件の遅いターンを同時に実行...")
+		results, ticks = asyncio.run(scenario())
+		assert results == list(range(LLM_MAX_CONCURRENCY * 2))
+		assert peak == LLM_MAX_CONCURRENCY, f"peak={peak}"
+		# 2巡（約0.4秒）の間、イベントループは止まらない
+		assert ticks >= 10, f"ticks={ticks}"
+		print(f"[SUCCESS] 同時実行は最大{peak}件、その間のイベントループの処理: {ticks}回")
+		return True
+	except Exception as e:
+		print(f"[ERROR] テストエラー: {e}")
+		import traceback
+		traceback.print_exc()
+		return False
+
+
+def test_shared_agent():
+	"""コンパイル済みエージェントの共有テスト（ターンごとの検索結果・推薦が混ざらないこと）"""
+	print("\n" + "=" * 60)
+	print("  エージェント共有テスト")
+	print("=" * 60)
+
+	from backend.api import llm
+	from langchain_core.language_models.chat_models import BaseChatModel
+	from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+	from langchain_core.outputs import ChatGeneration, ChatResult
+
+	class ScriptedModel(BaseChatModel):
+		"""検索 → 推薦 → 応答の順にツールを呼ぶモデル（キーワードはユーザーの発言）"""
+		@property
+		def _llm_type(self) -> str:
+			return "scripted"
+
+		def bind_tools(self, tools, **kwargs):
+			return self
+
+		def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+			last = messages[-1]
+			tag = next(m.content for m in messages if isinstance(m, HumanMessage)).rsplit(" ", 1)[-1]
+			if isinstance(last, HumanMessage):
+				message = AIMessage(content="", tool_calls=[
+					{"name": "search_books", "args": {"keywords": [tag]}, "id": f"search-{tag}"},
+					{"name": "update_expression", "args": {"expression_type": "thinking"}, "id": f"expr-{tag}"},
+				])
+			elif isinstance(last, ToolMessage) and last.name != "recommend_books":
+				message = AIMessage(content="", tool_calls=[
+					{"name": "recommend_books", "args": {"selections": [{"number": 1, "reason": tag}]}, "id": f"rec-{tag}"},
+				])
+			else:
+				message = AIMessage(content=f"おすすめは{tag}の本です")
+			return ChatResult(generations=[ChatGeneration(message=message)])
+
+	original_get_llm = llm.get_llm
+	original_search = llm.rakuten_search_books
+	built = []
+
+	def scripted_llm(**kwargs):
+		built.append(kwargs)
+		return ScriptedModel()
+
+	try:
+		llm.get_llm = scripted_llm
+		llm.rakuten_search_books = lambda keywords, count=10, orflag=0: [{"title": f"{keywords[0]}の本", "authors": ["著者"]}]
+		llm._agents.clear()
+
+		with tempfile.TemporaryDirectory() as tmp:
+			prompt_file = Path(tmp, "prompt.md")
+			prompt_file.write_text("テスト用プロンプト", encoding="utf-8")
+			store = llm.PromptStore(data_dir=tmp)
+			results = {}
+
+			def worker(index):
+				tag = f"tag{index}"
+				for turn in range(3):
+					response, history, books, expression = llm.llm_chat(str(prompt_file), f"本を探して {tag}", [], store=store)
+					assert response == f"おすすめは{tag}の本です", response
+					assert [book["title"] for book in books] == [f"{tag}の本"], books
+					assert books[0]["recommendation_reason"] == tag
+					assert expression == "thinking"
+				results[index] = True
+
+			print(f"\n[TEST] {THREADS}スレッドから同時にチャット...")
+			errors = _run_threads(worker)
+			assert not errors, errors[0][2]
+			assert len(results) == THREADS
+			# モデルの作成・グラフのコンパイルは1回だけ
+			assert len(built) == 1, built
+			print(f"[SUCCESS] {THREADS * 3}ターンで検索結果・推薦が混ざらず、エージェントの作成は1回")
+		return True
+	except Exception as e:
+		print(f"[ERROR] テストエラー: {e}")
+		import traceback
+		traceback.print_exc()
+		return False
+	finally:
+		llm.get_llm = original_get_llm
+		llm.rakuten_search_books = original_search
+		llm._agents.clear()
+
+
+def test_insights_lock():
+	"""ai_insightsの生成中にユーザーのロックを持たないこと、生成中に書き換えられたら作り直すことを確認"""
+	print("\n" + "=" * 60)
+	print("  テスト: ai_insights生成中のロック")
+	print("=" * 60)
+
+	from backend.api import datastore as datastore_module
+	from backend.api.storage import JsonStorage
+	from backend.api.datastore import DataStore
+	from backend.api.models import Personal
+	from backend import PROMPT_SUMMARY
+	from langchain_core.messages import HumanMessage, AIMessage
+
+	original_summary = datastore_module.summary_function
+	prompts = []
+	blocked = []
+
+	try:
+		with tempfile.TemporaryDirectory() as tmp:
+			ds = DataStore(storage=JsonStorage(data_dir=tmp))
+			user_id = "test_insights_user_001"
+			ds.create_user(user_id, Personal(name="Insights User", gender="female", age=28))
+			session_id = ds.create_session(user_id)
+			ds.update_history(session_id, [HumanMessage(content="推理小説"), AIMessage(content="こちらです")])
+			ds.close_session(session_id)
+
+			def fake_summary(prompt_path, text, ai_insight=None):
+				if prompt_path == str(PROMPT_SUMMARY):
+					return "推理小説を探した"
+				prompts.append(text)
+				if len(prompts) == 1:
+					# LLM呼び出しの間に同じユーザーのリクエストが来て、ai_insightsを書き換える
+					worker = threading.Thread(target=ds.update_user, args=(user_id,), kwargs={"ai_insights": "他の要約"})
+					worker.start()
+					worker.join(timeout=2)
+					blocked.append(worker.is_alive())
+				return f"insight {len(prompts)}"
+
+			datastore_module.summary_function = fake_summary
+			print("\n[TEST] 生成中の同じユーザーへのリクエスト...")
+			ds.generate_summary_and_insights(session_id)
+			assert blocked == [False], blocked
+			print("[SUCCESS] 待たされずに処理された")
+
+			print("\n[TEST] compare-and-set...")
+			assert len(prompts) == 2 and "他の要約" in prompts[1]
+			assert ds.get_user(user_id).ai_insights == "insight 2"
+			reloaded = JsonStorage(data_dir=tmp)
+			reloaded.load()
+			assert reloaded.get_user(user_id).ai_insights == "insight 2"
+			assert reloaded.get_conversation(session_id).summary == "推理小説を探した"
+			print("[SUCCESS] 書き換えられた値を元に作り直して保存")
+			ds.close()
+		return True
+	except Exception as e:
+		print(f"[ERROR] テストエラー: {e}")
+		import traceback
+		traceback.print_exc()
+		return False
+	finally:
+		datastore_module.summary_function = original_summary
+
+
+def test_llm_registry():
+	"""LLMクライアントが設定ごとに1回だけ作られ、同時に取得しても同じインスタンスが返ることを確認"""
+	print("\n" + "=" * 60)
+	print("  テスト: LLMクライアントのレジストリ")
+	print("=" * 60)
+
+	from backend.api import llm
+
+	original_create = llm._create_llm
+	original_clients = dict(llm._llm_clients)
+	created = []
+
+	def counting_create(backend, model_name, temperature, max_tokens):
+		created.append((backend, model_name, temperature, max_tokens))
+		time.sleep(0.01)
+		return object()
+
+	try:
+		llm._create_llm = counting_create
+		llm._llm_clients.clear()
+		instances = {}
+
+		def worker(index):
+			instances[index] = llm.get_llm(backend="gemini", temperature=0.3, max_tokens=512)
+
+		print(f"\n[TEST] {THREADS}スレッドから同時に取得...")
+		errors = _run_threads(worker)
+		assert not errors, errors[0][2]
+		assert len(created) == 1, created
+		assert len({id(instance) for instance in instances.values()}) == 1
+		print("[SUCCESS] 作成は1回で、すべて同じインスタンス")
+
+		print("\n[TEST] 設定が違う場合は別のインスタンス...")
+		other = llm.get_llm(backend="gemini", temperature=0.7, max_tokens=512)
+		assert other is not instances[0]
+		assert llm.get_llm(backend="gemini", temperature=0.7, max_tokens=512) is other
+		assert len(created) == 2, created
+		print("[SUCCESS] (backend, model, temperature, max_tokens) ごとに1つ")
+		return True
+	except Exception as e:
+		print(f"[ERROR] テストエラー: {e}")
+		import traceback
+		traceback.print_exc()
+		return False
+	finally:
+		llm._create_llm = original_create
+		llm._llm_clients.clear()
+		llm._llm_clients.update(original_clients)
+
+
+def main():
+	"""メインテスト"""
+	print("\n" + "🚀" * 30)
+	print("  DataStoreスレッドセーフ性テスト開始")
+	print("🚀" * 30)
+
+	results = []
+
+	# テスト実行
+	results.append(("同一セッション同時更新テスト", test_concurrent_history_updates()))
+	results.append(("ランダム操作ストレステスト", test_concurrent_operations()))
+	results.append(("複数ワーカー共有テスト", test_shared_workers()))
+	results.append(("LLMスレッドプールテスト", test_llm_pool()))
+	results.append(("エージェント共有テスト", test_shared_agent()))
+	results.append(("LLMクライアントレジストリテスト", test_llm_registry()))
+	results.append(("ai_insights生成中のロックテスト", test_insights_lock()))
+
+	# 結果サマリー
+	print("\n" + "=" * 60)
+	print("  テスト結果サマリー")
+	print("=" * 60)
+
+	passed = sum(1 for _, result in results if result)
+	total = len(results)
+
+	for name, result in results:
+		status = "[PASS]" if result else "[FAIL]"
+		print(f"{status} {name}")
+
+	print("\n" + "=" * 60)
+	print(f"  合計: {passed}/{total} テスト成功")
+	print("=" * 60)
+
+	if passed == total:
+		print("\n" + "🎉" * 30)
+		print("  すべてのテストが成功しました！")
+		print("🎉" * 30)
+		return 0
+	else:
+		print("\n" + "❌" * 30)
+		print(f"  {total - passed}個のテストが失敗しました")
+		print("❌" * 30)
+		return 1
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -21,12 +21,15 @@ def test_restful_endpoints():
 		from backend.api.server import app
 		
 		print("\n[TEST] エンドポイントの確認...")
-		routes = {route.path: route.methods for route in app.routes}
+		# WebSocketのルートは methods を持たないため空集合にする
+		routes = {route.path: getattr(route, "methods", None) or set() for route in app.routes}
 		
 		# セッション関連エンドポイント
 		session_endpoints = {
 			"/sessions/{session_id}": {"GET"},
 			"/sessions/{session_id}/messages": {"POST"},
+			"/sessions/{session_id}/messages/stream": {"POST"},
+			"/sessions/{session_id}/events": {"GET"},
 			"/sessions/{session_id}/close": {"PUT"},
 		}
 		
@@ -34,6 +37,7 @@ def test_restful_endpoints():
 		user_endpoints = {
 			"/users": {"POST"},
 			"/users/{user_id}": {"GET", "PUT"},
+			"/users/{user_id}/sessions": {"GET"},
 		}
 		
 		# NFC関連エンドポイント
@@ -43,6 +47,9 @@ def test_restful_endpoints():
 			"/nfc/unregister": {"DELETE"},
 		}
 		
+		# WebSocketエンドポイント
+		websocket_endpoints = ["/sessions/{session_id}/messages/ws"]
+		
 		all_endpoints = {**session_endpoints, **user_endpoints, **nfc_endpoints}
 		
 		for path, expected_methods in all_endpoints.items():
@@ -66,6 +73,15 @@ def test_restful_endpoints():
 				print(f"[FAIL] エンドポイント {path} が見つかりません")
 				return False
 		
+		from fastapi.routing import APIWebSocketRoute
+		websocket_routes = {route.path for route in app.routes if isinstance(route, APIWebSocketRoute)}
+		for path in websocket_endpoints:
+			if path in websocket_routes:
+				print(f"[SUCCESS] {path}: WebSocket")
+			else:
+				print(f"[FAIL] WebSocketエンドポイント {path} が見つかりません")
+				return False
+		
 		# 削除されたエンドポイントの確認
 		print("\n[TEST] 削除されたエンドポイントの確認...")
 		removed_endpoints = ["/sessions", "/chat/default", "/chat/librarian", "/close_session"]
@@ -97,7 +113,7 @@ def test_status_codes():
 		created_endpoints = ["/users", "/sessions/{session_id}/messages"]
 		
 		for route in app.routes:
-			if route.path in created_endpoints and "POST" in route.methods:
+			if route.path in created_endpoints and "POST" in (getattr(route, "methods", None) or set()):
 				# FastAPIのルートから直接ステータスコードを取得するのは難しいため、
 				# エンドポイントが存在することのみ確認
 				print(f"[SUCCESS] {route.path}: POST (201 Created)")
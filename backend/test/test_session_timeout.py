@@ -48,6 +48,7 @@ def test_user_timeout():
 		print("\n[TEST] lastloginを古い時刻に設定...")
 		old_time = datetime.now() - timedelta(seconds=SESSION_TIMEOUT + 100)
 		user.lastlogin = old_time
+		ds.reschedule_timeout(user_id)  # 期限が早まったので監視ヒープへ登録し直す
 		print(f"  設定した時刻: {old_time}")
 		print(f"  タイムアウト閾値: {datetime.now() - timedelta(seconds=SESSION_TIMEOUT)}")
 		
@@ -72,6 +73,61 @@ def test_user_timeout():
 		traceback.print_exc()
 		return False
 
+def test_timeout_ordering():
+	"""期限順タイムアウトのテスト（期限切れのユーザーだけがcloseされる）"""
+	print("\n" + "=" * 60)
+	print("  期限順タイムアウトテスト")
+	print("=" * 60)
+	
+	try:
+		import tempfile
+		from backend.api.datastore import DataStore, SESSION_TIMEOUT
+		from backend.api.models import Personal, ChatStatus, UserStatus
+		from backend.api.storage import JsonStorage
+		from langchain_core.messages import HumanMessage
+		
+		with tempfile.TemporaryDirectory() as tmp:
+			ds = DataStore(storage=JsonStorage(Path(tmp)))
+			personal = Personal(name="Order User", gender="female", age=20)
+			
+			print("\n[TEST] ユーザー2人とセッション作成...")
+			expired_user = ds.create_user("test_order_expired", personal)
+			alive_user = ds.create_user("test_order_alive", personal)
+			expired_session = ds.create_session(expired_user.user_id)
+			alive_session = ds.create_session(alive_user.user_id)
+			ds.update_history(expired_session, [HumanMessage(content="hello")])
+			
+			# 片方だけ期限切れにする
+			expired_user.lastlogin = datetime.now() - timedelta(seconds=SESSION_TIMEOUT + 100)
+			ds.reschedule_timeout(expired_user.user_id)
+			
+			print("\n[TEST] タイムアウトチェック...")
+			closed_sessions = ds.check_user_timeout()
+			assert closed_sessions == [expired_session]
+			assert ds.conversations[expired_session].status == ChatStatus.closed
+			assert ds.conversations[alive_session].status == ChatStatus.active
+			assert ds.users[expired_user.user_id].status == UserStatus.logout
+			assert expired_user.user_id not in ds.active_sessions
+			assert alive_session in ds.active_sessions[alive_user.user_id]
+			print(f"[SUCCESS] 期限切れのユーザーのみclose: {closed_sessions}")
+			
+			# close時にメモリ上の履歴がmessagesへ保存されている
+			stored = ds.storage.get_conversation(expired_session)
+			assert stored.status == ChatStatus.closed
+			assert len(stored.messages) == 1
+			print(f"[SUCCESS] 履歴が保存されている: {len(stored.messages)}件")
+			
+			# 2回目のチェックでは何もcloseされない
+			assert ds.check_user_timeout() == []
+			print("[SUCCESS] 2回目のチェックでは対象なし")
+		
+		return True
+	except Exception as e:
+		print(f"[ERROR] テストエラー: {e}")
+		import traceback
+		traceback.print_exc()
+		return False
+
 def test_last_accessed_update():
 	"""最終アクセス時刻更新のテスト"""
 	print("\n" + "=" * 60)
@@ -192,6 +248,62 @@ def test_timeout_settings():
 		traceback.print_exc()
 		return False
 
+def test_timeout_retry():
+	"""タイムアウト処理が失敗したユーザーが次回のチェックで再試行されることのテスト"""
+	print("\n" + "=" * 60)
+	print("  タイムアウト再試行テスト")
+	print("=" * 60)
+	
+	try:
+		import tempfile
+		from backend.api.datastore import DataStore, SESSION_TIMEOUT
+		from backend.api.models import Personal, ChatStatus, UserStatus
+		from backend.api.storage import JsonStorage
+		
+		with tempfile.TemporaryDirectory() as tmp:
+			ds = DataStore(storage=JsonStorage(Path(tmp)))
+			user = ds.create_user("test_retry_user", Personal(name="Retry User", gender="male", age=30))
+			session_id = ds.create_session(user.user_id)
+			user.lastlogin = datetime.now() - timedelta(seconds=SESSION_TIMEOUT + 100)
+			ds.reschedule_timeout(user.user_id)
+			
+			print("\n[TEST] closeが失敗...")
+			close_session = ds._close_session
+			def failing_close(session_id):
+				raise RuntimeError("close failed")
+			ds._close_session = failing_close
+			assert ds.check_user_timeout() == []
+			assert ds.conversations[session_id].status == ChatStatus.active
+			assert user.user_id in ds._timeout_scheduled
+			print("[SUCCESS] 監視対象に残った")
+			
+			print("\n[TEST] セッションのロックを待ちきれない（複数ワーカー構成）...")
+			ds._close_session = close_session
+			from backend.api.locks import LockTimeout
+			session_lock = ds.session_lock
+			def busy_session_lock(session_id):
+				raise LockTimeout(f"session {session_id} is busy")
+			ds.session_lock = busy_session_lock
+			assert ds.check_user_timeout() == []
+			assert ds.users[user.user_id].status != UserStatus.logout
+			assert user.user_id in ds._timeout_scheduled
+			print("[SUCCESS] 監視対象に残った")
+			
+			print("\n[TEST] 次回のチェックで再試行...")
+			ds.session_lock = session_lock
+			assert ds.check_user_timeout() == [session_id]
+			assert ds.conversations[session_id].status == ChatStatus.closed
+			assert ds.users[user.user_id].status == UserStatus.logout
+			assert user.user_id not in ds._timeout_scheduled
+			print("[SUCCESS] logoutになった")
+		
+		return True
+	except Exception as e:
+		print(f"[ERROR] テストエラー: {e}")
+		import traceback
+		traceback.print_exc()
+		return False
+
 def main():
 	"""メインテスト"""
 	print("\n" + "🚀" * 30)
@@ -204,6 +316,8 @@ def main():
 	results.append(("タイムアウト設定テスト", test_timeout_settings()))
 	results.append(("lastlogin更新テスト", test_lastlogin_update()))
 	results.append(("ユーザータイムアウトテスト", test_user_timeout()))
+	results.append(("期限順タイムアウトテスト", test_timeout_ordering()))
+	results.append(("タイムアウト再試行テスト", test_timeout_retry()))
 	
 	# 結果サマリー
 	print("\n" + "=" * 60)
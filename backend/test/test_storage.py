@@ -0,0 +1,1440 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+永続化バックエンド（backend/api/storage）のテストスクリプト
+一時ディレクトリを使うため、backend/api/data のデータには影響しない
+"""
+
+import sys
+import tempfile
+from pathlib import Path
+
+# プロジェクトルートをパスに追加
+project_root = Path(__file__).resolve().parent.parent.parent
+sys.path.insert(0, str(project_root))
+
+def test_wal_replay():
+	"""WALの追記と再起動時の再生テスト"""
+	print("\n" + "=" * 60)
+	print("  WAL再生テスト")
+	print("=" * 60)
+
+	try:
+		from backend.api.storage import WalStorage
+		from backend.api.datastore import DataStore
+		from backend.api.models import Personal, ChatStatus
+		from langchain_core.messages import HumanMessage, AIMessage
+
+		with tempfile.TemporaryDirectory() as tmp:
+			# 圧縮が起きないよう閾値を大きくする
+			ds = DataStore(storage=WalStorage(data_dir=tmp, compact_threshold=10000))
+
+			print("\n[TEST] ユーザー作成・NFC登録・セッションクローズ...")
+			user_id = "test_wal_user_001"
+			ds.create_user(user_id, Personal(name="WAL User", gender="female", age=20))
+			ds.register_nfc("nfc_wal_001", user_id)
+			session_id = ds.create_session(user_id)
+			ds.update_history(session_id, [HumanMessage(content="こんにちは"), AIMessage(content="いらっしゃいませ")])
+			ds.close_session(session_id)
+			ds.close()
+
+			# スナップショットは書かれず、WALにのみ記録されている
+			wal_file = Path(tmp, "datastore.wal")
+			assert wal_file.exists() and wal_file.stat().st_size > 0
+			assert not Path(tmp, "users.json").exists()
+			print(f"[SUCCESS] WALに記録: {wal_file.stat().st_size} bytes")
+
+			print("\n[TEST] 再起動後の再生...")
+			ds2 = DataStore(storage=WalStorage(data_dir=tmp, compact_threshold=10000))
+			assert ds2.get_user_by_nfc("nfc_wal_001") == user_id
+			assert session_id in ds2.conversations
+			assert ds2.conversations[session_id].status == ChatStatus.closed
+			assert len(ds2.get_history(session_id)) == 2
+			assert session_id in ds2.get_user(user_id).old_session
+			ds2.close()
+			print("[SUCCESS] WALからユーザー・NFC・会話を復元")
+
+		return True
+	except Exception as e:
+		print(f"[ERROR] テストエラー: {e}")
+		import traceback
+		traceback.print_exc()
+		return False
+
+def test_wal_compaction():
+	"""WALの圧縮テスト"""
+	print("\n" + "=" * 60)
+	print("  WAL圧縮テスト")
+	print("=" * 60)
+
+	try:
+		from backend.api.storage import WalStorage, JsonStorage
+		from backend.api.datastore import DataStore
+		from backend.api.models import Personal
+
+		with tempfile.TemporaryDirectory() as tmp:
+			ds = DataStore(storage=WalStorage(data_dir=tmp, compact_threshold=5))
+
+			print("\n[TEST] 閾値を超える更新...")
+			user_id = "test_wal_user_002"
+			ds.create_user(user_id, Personal(name="Compact User", gender="male", age=30))
+			for i in range(6):
+				ds.update_user(user_id, ai_insights=f"insight {i}")
+			ds.close()
+
+			# 圧縮によりスナップショットが作られ、WALは圧縮後のレコードのみ
+			assert Path(tmp, "users.json").exists()
+			wal_lines = [l for l in Path(tmp, "datastore.wal").read_text(encoding="utf-8").splitlines() if l]
+			assert len(wal_lines) < 5
+			print(f"[SUCCESS] 圧縮後のWALレコード数: {len(wal_lines)}")
+
+			print("\n[TEST] 再起動後の値...")
+			ds2 = DataStore(storage=WalStorage(data_dir=tmp))
+			assert ds2.get_user(user_id).ai_insights == "insight 5"
+			ds2.save_file()
+			ds2.close()
+
+			# 圧縮済みならJSONバックエンドでそのまま読める
+			ds3 = DataStore(storage=JsonStorage(data_dir=tmp))
+			assert ds3.get_user(user_id).ai_insights == "insight 5"
+			print("[SUCCESS] スナップショットとWALの再生結果が一致")
+
+		return True
+	except Exception as e:
+		print(f"[ERROR] テストエラー: {e}")
+		import traceback
+		traceback.print_exc()
+		return False
+
+def test_user_index():
+	"""ユーザーの遅延読み込みテスト（インデックス経由で1件だけ読み込む）"""
+	print("\n" + "=" * 60)
+	print("  ユーザー遅延読み込みテスト")
+	print("=" * 60)
+
+	try:
+		from backend.api.storage import JsonStorage
+		from backend.api.datastore import DataStore
+		from backend.api.models import Personal
+
+		with tempfile.TemporaryDirectory() as tmp:
+			ds = DataStore(storage=JsonStorage(data_dir=tmp))
+			for i in range(5):
+				ds.create_user(f"test_index_user_{i:03d}", Personal(name=f"User {i}", gender="male", age=20 + i))
+
+			print("\n[TEST] 再起動後のユーザー読み込み...")
+			storage = JsonStorage(data_dir=tmp)
+			ds2 = DataStore(storage=storage)
+			# 起動時にはUserへの変換は行われない
+			assert len(ds2.users) == 0
+			assert len(storage.user_ids()) == 5
+
+			users_file = Path(tmp, "users.json")
+			mtime = users_file.stat().st_mtime_ns
+			user = ds2.get_user("test_index_user_003")
+			assert user.personal.age == 23
+			# 読み込まれたのは要求した1件のみ・書き込みも発生しない
+			assert list(ds2.users) == ["test_index_user_003"]
+			assert users_file.stat().st_mtime_ns == mtime
+			assert ds2.get_user("unknown_user") is None
+			print("[SUCCESS] 要求したユーザー1件のみ読み込み（書き込みなし）")
+
+			print("\n[TEST] 未読み込みのユーザーを保持したまま保存...")
+			ds2.update_user("test_index_user_003", ai_insights="SFが好き")
+			ds3 = DataStore(storage=JsonStorage(data_dir=tmp))
+			assert ds3.get_user("test_index_user_003").ai_insights == "SFが好き"
+			assert ds3.get_user("test_index_user_000").personal.name == "User 0"
+			# 既存ユーザーへのcreate_userは上書きしない
+			ds3.create_user("test_index_user_003", Personal(name="Other", gender="female", age=99))
+			assert ds3.get_user("test_index_user_003").personal.name == "User 3"
+			print("[SUCCESS] 他のユーザーのレコードも保持")
+
+		return True
+	except Exception as e:
+		print(f"[ERROR] テストエラー: {e}")
+		import traceback
+		traceback.print_exc()
+		return False
+
+def test_nfc_mapping():
+	"""NFCの逆引きと1件単位の保存テスト"""
+	print("\n" + "=" * 60)
+	print("  NFC紐付け保存テスト")
+	print("=" * 60)
+
+	try:
+		from backend.api.storage import JsonStorage
+		from backend.api.datastore import DataStore
+		from backend.api.models import Personal
+
+		with tempfile.TemporaryDirectory() as tmp:
+			ds = DataStore(storage=JsonStorage(data_dir=tmp))
+			ds.create_user("test_nfc_map_001", Personal(name="Card A", gender="male", age=20))
+			ds.create_user("test_nfc_map_002", Personal(name="Card B", gender="female", age=21))
+			ds.save_file()
+
+			print("\n[TEST] NFC登録時の書き込み範囲...")
+			mtimes = {name: Path(tmp, name).stat().st_mtime_ns for name in ["users.json", "conversations.json", "nfc_users.json"]}
+			ds.register_nfc("nfc_map_001", "test_nfc_map_001")
+			ds.register_nfc("nfc_map_002", "test_nfc_map_002")
+			# 既存のファイルは書き直さず、ログへの追記のみ
+			for name, mtime in mtimes.items():
+				assert Path(tmp, name).stat().st_mtime_ns == mtime, f"{name} was rewritten"
+			assert len(Path(tmp, "nfc_users.log").read_text(encoding="utf-8").splitlines()) == 2
+			print("[SUCCESS] 登録した1件のみ追記")
+
+			print("\n[TEST] 逆引き...")
+			assert ds.get_nfc_by_user_id("test_nfc_map_001") == "nfc_map_001"
+			# 別ユーザーへの同一カード再登録
+			ds.register_nfc("nfc_map_001", "test_nfc_map_002")
+			assert ds.get_nfc_by_user_id("test_nfc_map_001") is None
+			assert ds.get_nfc_by_user_id("test_nfc_map_002") == "nfc_map_001"
+			assert ds.get_user_by_nfc("nfc_map_002") is None
+			print("[SUCCESS] 逆引きが登録・解除に追従")
+
+			print("\n[TEST] 再起動後の復元...")
+			ds2 = DataStore(storage=JsonStorage(data_dir=tmp))
+			assert ds2.get_user_by_nfc("nfc_map_001") == "test_nfc_map_002"
+			assert ds2.get_nfc_by_user_id("test_nfc_map_002") == "nfc_map_001"
+			assert ds2.get_user_by_nfc("nfc_map_002") is None
+			# 起動時にログはスナップショットへ畳み込まれる
+			assert Path(tmp, "nfc_users.log").read_text(encoding="utf-8") == ""
+			print("[SUCCESS] ログを再生して復元")
+
+		return True
+	except Exception as e:
+		print(f"[ERROR] テストエラー: {e}")
+		import traceback
+		traceback.print_exc()
+		return False
+
+def test_sqlite_storage():
+	"""SQLiteバックエンドのテスト"""
+	print("\n" + "=" * 60)
+	print("  SQLiteバックエンドテスト")
+	print("=" * 60)
+
+	try:
+		from backend.api.storage import SqliteStorage
+		from backend.api.datastore import DataStore
+		from backend.api.models import Personal, ChatStatus
+		from langchain_core.messages import HumanMessage, AIMessage
+
+		with tempfile.TemporaryDirectory() as tmp:
+			ds = DataStore(storage=SqliteStorage(data_dir=tmp))
+
+			print("\n[TEST] ユーザー作成・NFC登録・セッション操作...")
+			closed_user = "test_sqlite_user_001"
+			paused_user = "test_sqlite_user_002"
+			ds.create_user(closed_user, Personal(name="Closed User", gender="male", age=40))
+			ds.create_user(paused_user, Personal(name="Paused User", gender="female", age=35))
+			ds.register_nfc("nfc_sqlite_001", closed_user)
+
+			closed_session = ds.create_session(closed_user)
+			ds.update_history(closed_session, [HumanMessage(content="SFの本"), AIMessage(content="こちらはいかがですか")])
+			ds.close_session(closed_session)
+
+			paused_session = ds.create_session(paused_user)
+			ds.update_history(paused_session, [HumanMessage(content="途中の会話")])
+			ds.pause_session(paused_session)
+			ds.close()
+			print("[SUCCESS] 保存完了")
+
+			print("\n[TEST] 再起動後の読み込み...")
+			ds2 = DataStore(storage=SqliteStorage(data_dir=tmp))
+			# 起動時に読み込まれるのはpauseセッションとその所有ユーザーのみ
+			# pauseの会話は読み込むが、履歴は最初にアクセスされるまで復元しない
+			assert paused_session in ds2.conversations and paused_session not in ds2.sessions
+			assert paused_user in ds2.users
+			assert closed_user not in ds2.users
+			assert closed_session not in ds2.conversations
+			print("[SUCCESS] closedの会話とそのユーザーは起動時に読み込まれない")
+
+			# 必要になった時点で1件ずつ読み込まれる
+			assert ds2.get_user_by_nfc("nfc_sqlite_001") == closed_user
+			assert ds2.has_user_session(closed_user, closed_session)
+			assert ds2.has_session(closed_session)
+			assert ds2.conversations[closed_session].status == ChatStatus.closed
+			assert len(ds2.get_history(closed_session)) == 2
+			ds2.close()
+			print("[SUCCESS] ユーザー・会話の遅延読み込み")
+
+		return True
+	except Exception as e:
+		print(f"[ERROR] テストエラー: {e}")
+		import traceback
+		traceback.print_exc()
+		return False
+
+def test_sharded_storage():
+	"""会話分割バックエンドのテスト"""
+	print("\n" + "=" * 60)
+	print("  会話分割バックエンドテスト")
+	print("=" * 60)
+
+	try:
+		from backend.api.storage import ShardedStorage, JsonStorage
+		from backend.api.datastore import DataStore
+		from backend.api.models import Personal
+		from langchain_core.messages import HumanMessage, AIMessage
+
+		with tempfile.TemporaryDirectory() as tmp:
+			# 既存のJSON形式で作成したデータから移行する
+			ds = DataStore(storage=JsonStorage(data_dir=tmp))
+
+			print("\n[TEST] JSON形式でセッション作成...")
+			user_id = "test_sharded_user_001"
+			ds.create_user(user_id, Personal(name="Shard User", gender="male", age=18))
+			closed_session = ds.create_session(user_id)
+			ds.update_history(closed_session, [HumanMessage(content="歴史の本"), AIMessage(content="おすすめです")])
+			ds.close_session(closed_session)
+			paused_session = ds.create_session(user_id)
+			ds.update_history(paused_session, [HumanMessage(content="続きは後で")])
+			ds.pause_session(paused_session)
+			ds.close()
+
+			print("\n[TEST] 分割形式での起動（移行）...")
+			ds2 = DataStore(storage=ShardedStorage(data_dir=tmp))
+			assert Path(tmp, "conversations_index.json").exists()
+			assert Path(tmp, "conversations", f"{closed_session}.json").exists()
+			# 起動時に本体を読み込むのはpauseの会話のみ
+			# pauseの会話は読み込むが、履歴は最初にアクセスされるまで復元しない
+			assert paused_session in ds2.conversations and paused_session not in ds2.sessions
+			assert closed_session not in ds2.conversations
+			print("[SUCCESS] インデックスとpauseの会話のみ読み込み")
+
+			print("\n[TEST] closedの会話の遅延読み込み...")
+			assert ds2.has_session(closed_session)
+			assert len(ds2.get_history(closed_session)) == 2
+			# インデックスにないIDはファイルを開かない
+			assert not ds2.has_session("../users")
+			print("[SUCCESS] closedの会話を要求時に読み込み")
+
+			print("\n[TEST] 分割形式での保存...")
+			ds2.close_session(paused_session)
+			ds2.close()
+			ds3 = DataStore(storage=ShardedStorage(data_dir=tmp))
+			assert paused_session not in ds3.sessions
+			assert len(ds3.get_history(paused_session)) == 1
+			print("[SUCCESS] 会話ファイルとインデックスを更新")
+
+			print("\n[TEST] インデックスの変更は追記のみ...")
+			import json
+			from backend.api.models import Conversation
+			storage = ShardedStorage(data_dir=tmp, compact_threshold=3)
+			storage.load()
+			index_file = Path(tmp, "conversations_index.json")
+			index_log = Path(tmp, "conversations_index.log")
+			snapshot = index_file.read_bytes()
+			storage.put_conversation(Conversation(**{"_id": "shard_log_1", "user_id": user_id}))
+			storage.delete_conversation(closed_session)
+			assert index_file.read_bytes() == snapshot
+			assert len(index_log.read_text(encoding="utf-8").splitlines()) == 2
+			# 再起動時にログを再生してインデックスへ畳み込む
+			storage = ShardedStorage(data_dir=tmp, compact_threshold=3)
+			storage.load()
+			assert storage.get_conversation("shard_log_1") is not None
+			assert storage.get_conversation(closed_session) is None
+			assert index_log.read_text(encoding="utf-8") == ""
+			# 閾値に達したらインデックスへ畳み込む
+			for i in range(3):
+				storage.put_conversation(Conversation(**{"_id": f"shard_log_{i + 2}", "user_id": user_id}))
+			assert index_log.read_text(encoding="utf-8") == ""
+			assert "shard_log_4" in json.loads(index_file.read_text(encoding="utf-8"))
+			print("[SUCCESS] 追記したログを再生・圧縮")
+
+		return True
+	except Exception as e:
+		print(f"[ERROR] テストエラー: {e}")
+		import traceback
+		traceback.print_exc()
+		return False
+
+def test_write_behind():
+	"""write-behind（変更の集約とバックグラウンド書き出し）のテスト"""
+	print("\n" + "=" * 60)
+	print("  write-behindテスト")
+	print("=" * 60)
+
+	try:
+		from backend.api.storage import WriteBehindStorage, JsonStorage, WalStorage
+		from backend.api.datastore import DataStore
+		from backend.api.models import Personal, ChatStatus
+		from langchain_core.messages import HumanMessage, AIMessage
+
+		class CountingStorage(JsonStorage):
+			"""put_batch の呼び出し回数を数える"""
+			batches = 0
+
+			def put_batch(self, *args, **kwargs):
+				CountingStorage.batches += 1
+				super().put_batch(*args, **kwargs)
+
+		with tempfile.TemporaryDirectory() as tmp:
+			# 自動では書き出さないよう間隔を長くし、flush() を明示的に呼ぶ
+			storage = WriteBehindStorage(CountingStorage(data_dir=tmp), interval=3600)
+			ds = DataStore(storage=storage)
+
+			print("\n[TEST] 変更の集約...")
+			user_id = "test_write_behind_user_001"
+			ds.create_user(user_id, Personal(name="Behind User", gender="female", age=40))
+			for i in range(5):
+				ds.update_user(user_id, ai_insights=f"insight {i}")
+			ds.register_nfc("wb_card_1", user_id)
+			ds.unregister_nfc("wb_card_1")
+			assert storage.pending_count() == 2  # user 1件 + NFC 1件（登録→解除）
+			assert not Path(tmp, "users.json").exists()  # まだ書き出していない
+			# 書き出し前でも読み込めること
+			assert storage.get_user(user_id).ai_insights == "insight 4"
+			assert storage.flush() == 2
+			assert CountingStorage.batches == 1
+			reloaded = JsonStorage(data_dir=tmp)
+			reloaded.load()
+			assert reloaded.get_user(user_id).ai_insights == "insight 4"
+			print("[SUCCESS] 6回の変更を1回の書き出しに集約")
+
+			print("\n[TEST] jsonではアクティブな履歴の書き出しで conversations.json を書き直さない...")
+			session_id = ds.create_session(user_id)
+			for i in range(3):
+				ds.create_user(f"test_write_behind_other_{i}", Personal(name="Other User", gender="male", age=20))
+				ds.create_session(f"test_write_behind_other_{i}")
+			storage.flush()
+			conversations_file = Path(tmp, "conversations.json")
+			written = conversations_file.stat().st_mtime_ns, conversations_file.read_bytes()
+			ds.update_history(session_id, [HumanMessage(content="旅行の本"), AIMessage(content="こちらです")])
+			assert storage.pending_count() == 0
+			storage.flush()
+			assert (conversations_file.stat().st_mtime_ns, conversations_file.read_bytes()) == written
+			print("[SUCCESS] 全件の書き直しなし（履歴はターンログに残る）")
+
+			print("\n[TEST] 異常終了後の復元...")
+			ds_crashed = DataStore(storage=JsonStorage(data_dir=tmp))
+			assert len(ds_crashed.get_history(session_id)) == 2
+			print("[SUCCESS] ターンログから復元")
+
+			print("\n[TEST] 終了時の書き出し...")
+			ds.update_history(session_id, [HumanMessage(content="旅行の本"), AIMessage(content="こちらです"), HumanMessage(content="ありがとう")])
+			ds.close_session(session_id)
+			ds.close()
+			assert storage.pending_count() == 0
+			ds2 = DataStore(storage=JsonStorage(data_dir=tmp))
+			assert len(ds2.get_history(session_id)) == 3
+			assert ds2.conversations[session_id].status == ChatStatus.closed
+			print("[SUCCESS] close() で残りの変更を書き出し")
+
+		with tempfile.TemporaryDirectory() as tmp:
+			print("\n[TEST] 追記型のバックエンドではアクティブな履歴を定期保存...")
+			storage = WriteBehindStorage(WalStorage(data_dir=tmp), interval=3600)
+			ds = DataStore(storage=storage)
+			user_id = "test_write_behind_user_002"
+			ds.create_user(user_id, Personal(name="Behind User", gender="female", age=40))
+			session_id = ds.create_session(user_id)
+			for i in range(3):
+				ds.create_user(f"test_write_behind_other_{i}", Personal(name="Other User", gender="male", age=20))
+				ds.create_session(f"test_write_behind_other_{i}")
+			storage.flush()
+			log_size = storage.inner.wal_file.stat().st_size
+			ds.update_history(session_id, [HumanMessage(content="旅行の本"), AIMessage(content="こちらです")])
+			assert storage.pending_count() == 1
+			storage.flush()
+			assert not Path(tmp, "conversations.json").exists()
+			assert storage.inner.wal_file.stat().st_size > log_size
+			_, conversations, _ = WalStorage(data_dir=tmp).load()
+			assert conversations[session_id].status == ChatStatus.active
+			assert len(conversations[session_id].messages) == 2
+			# メモリ上のConversationは書き換えない
+			assert ds.conversations[session_id].messages == []
+			ds.close()
+			print("[SUCCESS] 1件だけをログに追記")
+
+		return True
+	except Exception as e:
+		print(f"[ERROR] テストエラー: {e}")
+		import traceback
+		traceback.print_exc()
+		return False
+
+def test_snapshot_storage():
+	"""msgpackスナップショットバックエンドのテスト"""
+	print("\n" + "=" * 60)
+	print("  msgpackスナップショットテスト")
+	print("=" * 60)
+
+	try:
+		from backend.api.storage import SnapshotStorage, JsonStorage, convert_json_to_snapshot
+		from backend.api.datastore import DataStore
+		from backend.api.models import Personal, BookData, ChatStatus
+		from langchain_core.messages import HumanMessage, AIMessage
+
+		with tempfile.TemporaryDirectory() as tmp:
+			# 既存のJSON形式で作成したデータを変換する
+			ds = DataStore(storage=JsonStorage(data_dir=tmp))
+			user_id = "test_snapshot_user_001"
+			ds.create_user(user_id, Personal(name="Snap User", gender="female", age=33))
+			ds.add_recommendation(user_id, BookData(**{"_id": "9784000000000", "title": "テスト本"}), "テスト")
+			ds.update_user(user_id, ai_insights="歴史が好き")
+			ds.register_nfc("snap_card_1", user_id)
+			closed_session = ds.create_session(user_id)
+			ds.update_history(closed_session, [HumanMessage(content="歴史の本"), AIMessage(content="おすすめです")])
+			ds.close_session(closed_session)
+			paused_session = ds.create_session(user_id)
+			ds.update_history(paused_session, [HumanMessage(content="続きは後で")])
+			ds.pause_session(paused_session)
+			ds.close()
+
+			print("\n[TEST] JSONからの変換...")
+			assert convert_json_to_snapshot(Path(tmp)) == (1, 2, 1)
+			assert Path(tmp, "datastore.snapshot").exists()
+			print("[SUCCESS] ユーザー1件, 会話2件, NFC1件を変換")
+
+			print("\n[TEST] スナップショットからの起動...")
+			ds2 = DataStore(storage=SnapshotStorage(data_dir=tmp, compact_threshold=10000))
+			# pauseの会話は読み込むが、履歴は最初にアクセスされるまで復元しない
+			assert paused_session in ds2.conversations and paused_session not in ds2.sessions
+			assert closed_session not in ds2.conversations
+			user = ds2.get_user(user_id)
+			assert user.ai_insights == "歴史が好き"
+			assert ds2.get_recommendations(user_id)[0].book_data.title == "テスト本"
+			assert ds2.get_user_by_nfc("snap_card_1") == user_id
+			assert len(ds2.get_history(closed_session)) == 2
+			print("[SUCCESS] 検証なしで読み込み、closedの会話は要求時に読み込み")
+
+			print("\n[TEST] 追記と圧縮...")
+			ds2.close_session(paused_session)
+			ds2.storage.compact()
+			ds2.close()
+			ds3 = DataStore(storage=SnapshotStorage(data_dir=tmp))
+			assert ds3.get_user(user_id).status.value == "logout"
+			assert ds3.storage.get_conversation(paused_session).status == ChatStatus.closed
+			assert len(ds3.get_history(paused_session)) == 1
+			# 古い世代の会話本体ファイルは削除されている
+			assert len(list(Path(tmp).glob("conversations.*.bin"))) == 1
+			ds3.close()
+			print("[SUCCESS] 圧縮後も読み込み可能")
+
+		return True
+	except Exception as e:
+		print(f"[ERROR] テストエラー: {e}")
+		import traceback
+		traceback.print_exc()
+		return False
+
+def _mongo_client():
+	"""
+	テスト用のMongoDBクライアント。
+	MONGODB_TEST_URI が設定されていればそのmongodを、なければmongomock（インプロセス）を使う。
+	"""
+	import os
+	uri = os.getenv("MONGODB_TEST_URI")
+	if uri:
+		from pymongo import MongoClient
+		return MongoClient(uri)
+	import mongomock
+	return mongomock.MongoClient()
+
+def test_mongodb_storage():
+	"""MongoDBバックエンドのテスト"""
+	print("\n" + "=" * 60)
+	print("  MongoDBバックエンドテスト")
+	print("=" * 60)
+
+	try:
+		import uuid
+		from datetime import datetime, timedelta
+		from backend.api.storage import MongoStorage
+		from backend.api.datastore import DataStore
+		from backend.api.models import Personal, ChatStatus, Conversation
+		from langchain_core.messages import HumanMessage, AIMessage
+
+		client = _mongo_client()
+		db_name = f"livraria_test_{uuid.uuid4().hex[:8]}"
+		try:
+			with tempfile.TemporaryDirectory() as tmp:
+				ds = DataStore(storage=MongoStorage(data_dir=tmp, db_name=db_name, client=client))
+
+				print("\n[TEST] ユーザー作成・NFC登録・セッション操作...")
+				closed_user = "test_mongo_user_001"
+				paused_user = "test_mongo_user_002"
+				ds.create_user(closed_user, Personal(name="Closed User", gender="male", age=40))
+				ds.create_user(paused_user, Personal(name="Paused User", gender="female", age=35))
+				ds.register_nfc("nfc_mongo_001", closed_user)
+
+				closed_session = ds.create_session(closed_user)
+				ds.update_history(closed_session, [HumanMessage(content="SFの本"), AIMessage(content="こちらはいかがですか")])
+				ds.close_session(closed_session)
+
+				paused_session = ds.create_session(paused_user)
+				ds.update_history(paused_session, [HumanMessage(content="途中の会話")])
+				ds.pause_session(paused_session)
+				ds.close()
+				print("[SUCCESS] 保存完了")
+
+				print("\n[TEST] 再起動後の読み込み...")
+				ds2 = DataStore(storage=MongoStorage(data_dir=tmp, db_name=db_name, client=client))
+				# pauseの会話は読み込むが、履歴は最初にアクセスされるまで復元しない
+				assert paused_session in ds2.conversations and paused_session not in ds2.sessions
+				assert paused_user in ds2.users
+				assert closed_user not in ds2.users
+				assert closed_session not in ds2.conversations
+				assert ds2.get_user_by_nfc("nfc_mongo_001") == closed_user
+				assert ds2.has_user_session(closed_user, closed_session)
+				assert ds2.has_session(closed_session)
+				assert ds2.conversations[closed_session].status == ChatStatus.closed
+				assert len(ds2.get_history(closed_session)) == 2
+				assert ds2.storage.closed_before(datetime.now() + timedelta(seconds=1)) == [closed_session]
+				ds2.close()
+				print("[SUCCESS] closedの会話とそのユーザーは要求時に読み込み")
+
+				print("\n[TEST] 追記分だけの $push...")
+				storage = MongoStorage(data_dir=tmp, db_name=db_name, client=client)
+				collection = client[db_name]["conversations"]
+				messages = [{"type": "human", "data": {"content": f"m{i}"}} for i in range(3)]
+				conv = Conversation(**{"_id": "mongo_push", "user_id": paused_user, "messages": messages[:2]})
+				storage.put_conversation(conv)
+				storage.put_conversation(conv.model_copy(update={"messages": messages}))
+				doc = collection.find_one({"_id": "mongo_push"})
+				assert doc["messages"] == messages and doc["message_count"] == 3
+				# 他のプロセスが書き換えた場合・履歴が短くなった場合は全体を書き直す
+				collection.update_one({"_id": "mongo_push"}, {"$set": {"messages": messages[:1], "message_count": 1}})
+				storage.put_conversation(conv.model_copy(update={"messages": messages + messages[:1]}))
+				assert collection.find_one({"_id": "mongo_push"})["message_count"] == 4
+				storage.put_conversation(conv.model_copy(update={"messages": messages[:1]}))
+				assert collection.find_one({"_id": "mongo_push"})["messages"] == messages[:1]
+				print("[SUCCESS] 追記・書き直しとも保存内容が一致")
+
+				print("\n[TEST] 保存済み件数の記録を手放す...")
+				assert "mongo_push" in storage._stored
+				storage.evict_conversation("mongo_push")
+				assert "mongo_push" not in storage._stored
+				# closedの会話は保存・読み込みしても記録しない
+				closed = conv.model_copy(update={"messages": messages, "status": ChatStatus.closed})
+				storage.put_conversation(closed)
+				assert storage.get_conversation("mongo_push").messages == messages
+				assert "mongo_push" not in storage._stored
+				# 再開した会話は全体を書き直してから再び追記する
+				storage.put_conversation(conv.model_copy(update={"messages": messages + messages[:1]}))
+				assert collection.find_one({"_id": "mongo_push"})["message_count"] == 4
+				assert storage._stored["mongo_push"][0] == 4
+				print("[SUCCESS] closed・追い出した会話の記録は残らない")
+
+				print("\n[TEST] インデックスとTTL...")
+				indexes = collection.index_information()
+				assert "user_id" in indexes and "status_last_accessed" in indexes
+				assert "ttl_closed_conversations" not in indexes
+				MongoStorage(data_dir=tmp, db_name=db_name, client=client, conversations_ttl_days=30)
+				assert collection.index_information()["ttl_closed_conversations"]["expireAfterSeconds"] == 30 * 86400
+				MongoStorage(data_dir=tmp, db_name=db_name, client=client, conversations_ttl_days=7)
+				assert collection.index_information()["ttl_closed_conversations"]["expireAfterSeconds"] == 7 * 86400
+				MongoStorage(data_dir=tmp, db_name=db_name, client=client, conversations_ttl_days=None)
+				assert "ttl_closed_conversations" not in collection.index_information()
+				print("[SUCCESS] CONVERSATIONS_TTL_DAYS に合わせてTTLインデックスを作成・変更・削除")
+
+				print("\n[TEST] システムプロンプト...")
+				prompt_hash = "a" * 64
+				storage.put_prompt(prompt_hash, "司書です。")
+				# 他のホストのインスタンスからも読める（ローカルのファイルには書かない）
+				assert MongoStorage(data_dir=tmp, db_name=db_name, client=client).get_prompt(prompt_hash) == "司書です。"
+				assert not Path(tmp, "system_prompts").exists()
+				assert storage.delete_prompts_before(datetime.now() - timedelta(days=1)) == 0
+				assert storage.delete_prompts_before(datetime.now() + timedelta(seconds=1)) == 1
+				assert storage.get_prompt(prompt_hash) is None
+				print("[SUCCESS] DBに保存し、古いものを削除")
+		finally:
+			client.drop_database(db_name)
+
+		return True
+	except Exception as e:
+		print(f"[ERROR] テストエラー: {e}")
+		import traceback
+		traceback.print_exc()
+		return False
+
+def test_system_prompt_dedup():
+	"""システムプロンプトの重複排除テスト"""
+	print("\n" + "=" * 60)
+	print("  システムプロンプト重複排除テスト")
+	print("=" * 60)
+
+	try:
+		from backend.api.storage import PromptStore, PromptNotFound, JsonStorage, SqliteStorage
+		from backend.api.datastore import DataStore
+		from backend.api.llm import SYSTEM_PROMPT_REF, FIRST_MESSAGE_SEPARATOR, expand_system_prompt, history_view, _expand_or_rebuild
+		from backend.api.models import Personal
+		from langchain_core.messages import HumanMessage, AIMessage, messages_to_dict
+		from datetime import datetime, timedelta
+
+		with tempfile.TemporaryDirectory() as tmp:
+			store = PromptStore(data_dir=tmp)
+			system_prompt = "あなたは図書館の司書です。" * 200
+
+			print("\n[TEST] 内容のハッシュで1回だけ保存...")
+			prompt_hash = store.put(system_prompt)
+			assert store.put(system_prompt) == prompt_hash
+			assert len(list(Path(tmp, "system_prompts").iterdir())) == 1
+			assert PromptStore(data_dir=tmp).get(prompt_hash) == system_prompt
+			assert store.get("../users") is None
+			print(f"[SUCCESS] 保存: {prompt_hash[:12]}...")
+
+			print("\n[TEST] 履歴には参照のみを保存...")
+			ds = DataStore(storage=JsonStorage(data_dir=tmp))
+			user_id = "test_prompt_user_001"
+			ds.create_user(user_id, Personal(name="Prompt User", gender="male", age=50))
+			session_id = ds.create_session(user_id)
+			history = [
+				HumanMessage(content="おすすめの本は？", additional_kwargs={SYSTEM_PROMPT_REF: prompt_hash}),
+				AIMessage(content="こちらです"),
+			]
+			ds.update_history(session_id, history)
+			ds.close_session(session_id)
+			stored = Path(tmp, "conversations.json").read_text(encoding="utf-8")
+			assert "図書館の司書" not in stored
+			print("[SUCCESS] conversations.json にプロンプト本文が含まれない")
+
+			print("\n[TEST] LLMに送る時に本文へ戻す...")
+			restored = DataStore(storage=JsonStorage(data_dir=tmp)).get_history(session_id)
+			expanded = expand_system_prompt(restored, store)
+			assert expanded[0].content == f"{system_prompt}{FIRST_MESSAGE_SEPARATOR}おすすめの本は？"
+			assert SYSTEM_PROMPT_REF not in expanded[0].additional_kwargs
+			assert restored[0].content == "おすすめの本は？"  # 元の履歴は変更しない
+			print("[SUCCESS] 参照をプロンプト本文に展開")
+
+			print("\n[TEST] API用の表示...")
+			stored_messages = ds.get_history_dicts(session_id)
+			view = history_view(stored_messages)
+			assert view[0]["data"]["content"] == "おすすめの本は？"
+			assert SYSTEM_PROMPT_REF not in view[0]["data"]["additional_kwargs"]
+			# 保存されているdictは変更しない
+			assert SYSTEM_PROMPT_REF in stored_messages[0]["data"]["additional_kwargs"]
+			# 旧形式（本文埋め込み）の履歴からもプロンプトを除く
+			legacy = [HumanMessage(content=f"{system_prompt}{FIRST_MESSAGE_SEPARATOR}こんにちは"), AIMessage(content="はい")]
+			assert history_view(messages_to_dict(legacy))[0]["data"]["content"] == "こんにちは"
+			assert expand_system_prompt(legacy, store)[0].content == legacy[0].content
+			print("[SUCCESS] プロンプトを除いた履歴を返す")
+
+			print("\n[TEST] 参照先のプロンプトがない履歴...")
+			missing = [HumanMessage(content="こんにちは", additional_kwargs={SYSTEM_PROMPT_REF: "0" * 64})]
+			try:
+				expand_system_prompt(missing, store)
+				assert False, "PromptNotFound not raised"
+			except PromptNotFound:
+				pass
+			# llm_chatは現在のプロンプトで作り直して送る
+			prompt_file = Path(tmp, "prompt.txt")
+			prompt_file.write_text("あなたは司書です。", encoding="utf-8")
+			rebuilt = _expand_or_rebuild(missing, store, str(prompt_file), "SFが好き")
+			assert rebuilt[0].content.startswith("あなたは司書です。")
+			assert "SFが好き" in rebuilt[0].content and rebuilt[0].content.endswith("こんにちは")
+			print("[SUCCESS] PromptNotFound を送出し、llm_chatはプロンプトを作り直す")
+
+		print("\n[TEST] storageへの保存（sqlite）...")
+		with tempfile.TemporaryDirectory() as tmp:
+			# 以前のバージョンが書いたファイルは見つかった時に取り込む
+			legacy_hash = PromptStore(data_dir=tmp).put("旧プロンプト")
+			storage = SqliteStorage(data_dir=tmp)
+			store = PromptStore(storage=storage)
+			prompt_hash = store.put(system_prompt)
+			assert not Path(tmp, "system_prompts", f"{prompt_hash}.txt").exists()
+			assert PromptStore(storage=storage).get(prompt_hash) == system_prompt
+			assert PromptStore(storage=storage).get(legacy_hash) == "旧プロンプト"
+			# 最後に使われた時刻より後を指定すると削除される
+			assert storage.delete_prompts_before(datetime.now() - timedelta(days=1)) == 0
+			assert storage.delete_prompts_before(datetime.now() + timedelta(seconds=1)) == 3
+			assert storage.get_prompt(prompt_hash) is None
+			assert storage.get_prompt(legacy_hash) is None
+			storage.close()
+			print("[SUCCESS] DBに保存し、古いものを削除")
+
+		return True
+	except Exception as e:
+		print(f"[ERROR] テストエラー: {e}")
+		import traceback
+		traceback.print_exc()
+		return False
+
+def test_history_cache():
+	"""過去の会話履歴の取得テスト（dictのまま返す / 変換済み履歴のLRU）"""
+	print("\n" + "=" * 60)
+	print("  過去の会話履歴キャッシュテスト")
+	print("=" * 60)
+
+	try:
+		from backend.api.storage import JsonStorage
+		from backend.api.datastore import DataStore
+		from backend.api.models import Personal
+		from langchain_core.messages import HumanMessage, AIMessage
+		from backend import HISTORY_CACHE_SIZE
+
+		with tempfile.TemporaryDirectory() as tmp:
+			ds = DataStore(storage=JsonStorage(data_dir=tmp))
+			user_id = "test_history_cache_user_001"
+			ds.create_user(user_id, Personal(name="Cache User", gender="female", age=22))
+			session_ids = []
+			for i in range(HISTORY_CACHE_SIZE + 2):
+				session_id = ds.create_session(user_id)
+				ds.update_history(session_id, [HumanMessage(content=f"質問{i}"), AIMessage(content=f"回答{i}")])
+				ds.close_session(session_id)
+				session_ids.append(session_id)
+
+			print("\n[TEST] 保存済みの会話はdictのまま返す...")
+			assert ds.get_history_dicts(session_ids[0]) is ds.conversations[session_ids[0]].messages
+			print("[SUCCESS] messages_from_dict / messages_to_dict を経由しない")
+
+			print("\n[TEST] 変換済み履歴のLRU...")
+			first = ds.get_history(session_ids[0])
+			assert ds.get_history(session_ids[0])[0] is first[0]  # 2回目はキャッシュから
+			for session_id in session_ids[1:]:
+				ds.get_history(session_id)
+			assert len(ds._history_cache) == HISTORY_CACHE_SIZE
+			assert session_ids[0] not in ds._history_cache  # 最も古いものから追い出される
+			print(f"[SUCCESS] キャッシュ件数は上限 {HISTORY_CACHE_SIZE} 件まで")
+
+			print("\n[TEST] 再開した会話はキャッシュを使わない...")
+			ds.update_history(session_ids[-1], [HumanMessage(content="続き")])
+			assert session_ids[-1] not in ds._history_cache
+			assert ds.get_history(session_ids[-1])[0].content == "続き"
+			print("[SUCCESS] 履歴の更新でキャッシュを破棄")
+
+		return True
+	except Exception as e:
+		print(f"[ERROR] テストエラー: {e}")
+		import traceback
+		traceback.print_exc()
+		return False
+
+def test_archive():
+	"""古い会話のアーカイブとTTL削除のテスト"""
+	print("\n" + "=" * 60)
+	print("  会話アーカイブテスト")
+	print("=" * 60)
+
+	try:
+		from datetime import datetime, timedelta
+		from backend.api.storage import ConversationArchive, JsonStorage, SnapshotStorage, SqliteStorage, ShardedStorage
+		from backend.api.datastore import DataStore
+		from backend.api.models import Personal, BookData
+		from backend.api import datastore as datastore_module
+		from langchain_core.messages import HumanMessage, AIMessage
+		from backend import ARCHIVE_AFTER_DAYS
+
+		for storage_class in (JsonStorage, SnapshotStorage, SqliteStorage, ShardedStorage):
+			with tempfile.TemporaryDirectory() as tmp:
+				print(f"\n[TEST] {storage_class.__name__}: 古いclosedの会話をアーカイブへ移す...")
+				ds = DataStore(storage=storage_class(data_dir=tmp))
+				user_id = "test_archive_user_001"
+				ds.create_user(user_id, Personal(name="Archive User", gender="male", age=33))
+				session_ids = []
+				for i in range(3):
+					session_id = ds.create_session(user_id)
+					ds.update_history(session_id, [HumanMessage(content=f"質問{i}"), AIMessage(content=f"回答{i}")])
+					ds.close_session(session_id)
+					session_ids.append(session_id)
+				paused_id = ds.create_session(user_id)
+				ds.pause_session(paused_id)
+				ds.storage.close()
+
+				ds = DataStore(storage=storage_class(data_dir=tmp))
+				now = datetime.now() + timedelta(days=ARCHIVE_AFTER_DAYS + 1)
+				assert ds.archive_conversations(now=now) == (3, 0)
+				assert len(ds.archive) == 3
+				for session_id in session_ids:
+					assert ds.storage.get_conversation(session_id) is None
+					assert session_id not in ds.conversations
+				# pauseの会話は対象外
+				assert ds.storage.get_conversation(paused_id) is not None
+				# アーカイブ済みの会話も読める
+				assert ds.has_session(session_ids[0])
+				assert [m.content for m in ds.get_history(session_ids[1])] == ["質問1", "回答1"]
+				ds.storage.close()
+
+				# 再起動後もアーカイブから読める（storageからは削除されたまま）
+				ds = DataStore(storage=storage_class(data_dir=tmp))
+				assert ds.storage.get_conversation(session_ids[2]) is None
+				assert ds.get_history_dicts(session_ids[2])[0]["data"]["content"] == "質問2"
+				assert ds.archive_conversations(now=now) == (0, 0)
+				ds.storage.close()
+				print("[SUCCESS] 3件をアーカイブし、再起動後も読み込み可能")
+
+		print("\n[TEST] TTLを過ぎた会話とユーザーデータの削除...")
+		original = (datastore_module.CONVERSATIONS_TTL_DAYS, datastore_module.RECOMMEND_LOG_TTL_DAYS, datastore_module.AI_INSIGHTS_TTL_DAYS)
+		datastore_module.CONVERSATIONS_TTL_DAYS = 365
+		datastore_module.RECOMMEND_LOG_TTL_DAYS = 90
+		datastore_module.AI_INSIGHTS_TTL_DAYS = 180
+		try:
+			with tempfile.TemporaryDirectory() as tmp:
+				ds = DataStore(storage=JsonStorage(data_dir=tmp))
+				user_id = "test_archive_ttl_user_001"
+				ds.create_user(user_id, Personal(name="TTL User", gender="female", age=27))
+				session_id = ds.create_session(user_id)
+				ds.update_history(session_id, [HumanMessage(content="古い質問")])
+				ds.close_session(session_id)
+				ds.update_user(user_id, ai_insights="古い分析")
+				ds.add_recommendation(user_id, BookData(**{"_id": "9784000000001", "title": "古い推薦"}), "テスト")
+				prompt_hash = ds.prompts.put("司書です。\n古い分析")
+
+				# 1か月後にアーカイブ、1年後にアーカイブから削除
+				assert ds.archive_conversations(now=datetime.now() + timedelta(days=ARCHIVE_AFTER_DAYS + 1)) == (1, 0)
+				assert ds.archive_conversations(now=datetime.now() + timedelta(days=366)) == (0, 1)
+				assert not ds.has_session(session_id)
+				assert len(ds.archive) == 0
+				# 有効な会話がなくなったセグメントは書き込み中のもの以外削除される
+				assert len(list(Path(tmp, "archive").glob("segment-*.bin"))) <= 1
+				# 90日を過ぎた推薦ログは削除される
+				assert ds.get_recommendations(user_id) == []
+				# 使われなくなったシステムプロンプト（ai_insightsを含む）も削除される
+				assert ds.storage.get_prompt(prompt_hash) is None
+
+				# 長くログインしていないユーザーのai_insightsは破棄される
+				ds.users[user_id].lastlogin = datetime.now() - timedelta(days=181)
+				ds.archive_conversations()
+				assert ds.users[user_id].ai_insights == ""
+				print("[SUCCESS] TTLに従って会話・ai_insights・システムプロンプトを削除")
+		finally:
+			datastore_module.CONVERSATIONS_TTL_DAYS, datastore_module.RECOMMEND_LOG_TTL_DAYS, datastore_module.AI_INSIGHTS_TTL_DAYS = original
+
+		print("\n[TEST] セグメントの切り替え...")
+		with tempfile.TemporaryDirectory() as tmp:
+			from backend.api.models import Conversation
+			archive = ConversationArchive(tmp, segment_size=256)
+			convs = [
+				Conversation(**{"_id": f"seg_{i}", "user_id": "u", "messages": [{"type": "human", "data": {"content": "x" * 200}}]})
+				for i in range(5)
+			]
+			assert archive.append_many(convs) == 5
+			assert len(list(Path(tmp, "archive").glob("segment-*.bin"))) > 1
+			reopened = ConversationArchive(tmp, segment_size=256)
+			assert reopened.get("seg_4").messages == convs[4].messages
+			print("[SUCCESS] 上限を超えたら次のセグメントへ書き込む")
+
+		return True
+	except Exception as e:
+		print(f"[ERROR] テストエラー: {e}")
+		import traceback
+		traceback.print_exc()
+		return False
+
+def test_memory_budget():
+	"""メモリ上限（logoutユーザー・closedの会話本文の追い出し）のテスト"""
+	print("\n" + "=" * 60)
+	print("  メモリ上限テスト")
+	print("=" * 60)
+
+	try:
+		from backend.api.storage import SqliteStorage, JsonStorage, WalStorage, ShardedStorage, SnapshotStorage, WriteBehindStorage
+		from backend.api.datastore import DataStore
+		from backend.api.models import Personal, UserStatus
+		from backend.api import datastore as datastore_module
+		from langchain_core.messages import HumanMessage, AIMessage
+
+		backends = [
+			("sqlite", lambda tmp: SqliteStorage(data_dir=tmp)),
+			("json", lambda tmp: JsonStorage(data_dir=tmp)),
+			("wal", lambda tmp: WalStorage(data_dir=tmp)),
+			("sharded", lambda tmp: ShardedStorage(data_dir=tmp)),
+			("snapshot", lambda tmp: SnapshotStorage(data_dir=tmp)),
+			("json + write-behind", lambda tmp: WriteBehindStorage(JsonStorage(data_dir=tmp), interval=3600)),
+		]
+		original = (datastore_module.MEMORY_MAX_IDLE_USERS, datastore_module.MEMORY_MAX_CLOSED_BODIES)
+		datastore_module.MEMORY_MAX_IDLE_USERS = 2
+		datastore_module.MEMORY_MAX_CLOSED_BODIES = 2
+		try:
+			for name, create_storage in backends:
+				with tempfile.TemporaryDirectory() as tmp:
+					print(f"\n[TEST] {name}")
+					storage = create_storage(tmp)
+					ds = DataStore(storage=storage)
+					user_ids = [f"test_memory_user_{i:03d}" for i in range(4)]
+					session_ids = []
+					for i, user_id in enumerate(user_ids):
+						ds.create_user(user_id, Personal(name=f"Memory User {i}", gender="other", age=30 + i))
+						session_id = ds.create_session(user_id)
+						ds.update_history(session_id, [HumanMessage(content=f"質問{i}"), AIMessage(content=f"回答{i}")])
+						ds.close_session(session_id)
+						session_ids.append(session_id)
+					# write-behindは書き出した後で storage 側のコピーを手放す
+					inner = getattr(storage, "inner", storage)
+					if storage.deferred:
+						storage.flush()
+
+					print("\n[TEST] logoutユーザーの追い出し...")
+					assert ds.users[user_ids[-1]].status == UserStatus.logout
+					assert len(ds._idle_users) == 2
+					assert user_ids[0] not in ds.users and user_ids[1] not in ds.users
+					if isinstance(inner, JsonStorage):
+						assert user_ids[0] not in inner._users and user_ids[1] not in inner._users
+					# 追い出したユーザーはstorageから読み直せる
+					assert ds.get_user(user_ids[0]).active_session is None
+					assert session_ids[0] in ds.get_user(user_ids[0]).old_session
+					print("[SUCCESS] 上限を超えたlogoutユーザーを追い出し、要求時に読み直し")
+
+					print("\n[TEST] closedの会話本文の追い出し...")
+					assert ds.conversations[session_ids[0]].messages == []
+					assert ds.conversations[session_ids[0]].user_id == user_ids[0]  # メタデータは残る
+					if isinstance(inner, JsonStorage):
+						assert session_ids[0] not in inner._conversations and session_ids[1] not in inner._conversations
+					assert [m.content for m in ds.get_history(session_ids[0])] == ["質問0", "回答0"]
+					assert ds.memory_stats()["bodies_reloaded_total"] == 1
+					print("[SUCCESS] 本文だけを外し、要求時に読み直し")
+
+					print("\n[TEST] カウンタ...")
+					stats = ds.memory_stats()
+					assert stats["closed_bodies"] <= 2 and stats["idle_users"] <= 2
+					assert stats["users_evicted_total"] >= 2 and stats["bodies_evicted_total"] >= 2
+					print(f"[SUCCESS] {stats}")
+					ds.close()
+
+					print("\n[TEST] 追い出した後の書き出しで内容が失われない...")
+					ds = DataStore(storage=create_storage(tmp))
+					for i, (user_id, session_id) in enumerate(zip(user_ids, session_ids)):
+						assert session_id in ds.get_user(user_id).old_session
+						assert [m.content for m in ds.get_history(session_id)] == [f"質問{i}", f"回答{i}"]
+					ds.close()
+					print("[SUCCESS] 再起動後もすべて読める")
+		finally:
+			datastore_module.MEMORY_MAX_IDLE_USERS, datastore_module.MEMORY_MAX_CLOSED_BODIES = original
+
+		return True
+	except Exception as e:
+		print(f"[ERROR] テストエラー: {e}")
+		import traceback
+		traceback.print_exc()
+		return False
+
+def test_recommend_log():
+	"""推薦ログ（ユーザーとは別の追記専用ファイル）のテスト"""
+	print("\n" + "=" * 60)
+	print("  推薦ログテスト")
+	print("=" * 60)
+
+	try:
+		from datetime import datetime, timedelta
+		from backend.api.storage import JsonStorage, RecommendationLog
+		from backend.api.datastore import DataStore
+		from backend.api.models import Personal, BookData, RecommendationLogEntry
+
+		with tempfile.TemporaryDirectory() as tmp:
+			print("\n[TEST] 埋め込まれた推薦ログの移行...")
+			# 旧形式: ユーザーのドキュメントに推薦ログを埋め込んだデータ
+			storage = JsonStorage(data_dir=tmp)
+			ds = DataStore(storage=storage)
+			user_id = "test_recommend_user_001"
+			user = ds.create_user(user_id, Personal(name="Reco User", gender="male", age=22))
+			user.recommend_log = [
+				RecommendationLogEntry(book_data=BookData(**{"_id": f"old-{i}", "title": "旧形式", "genre": "001004"}), reason="旧")
+				for i in range(3)
+			]
+			storage.put_user(user)
+			ds.close()
+
+			ds = DataStore(storage=JsonStorage(data_dir=tmp), recommend_log=RecommendationLog(tmp, max_per_user=5))
+			assert ds.get_user(user_id).recommend_log == []
+			assert ds.storage.get_user(user_id).recommend_log == []
+			assert [entry.book_data.isbn for entry in ds.get_recommendations(user_id)] == ["old-0", "old-1", "old-2"]
+			print("[SUCCESS] 読み込み時にログへ移し、ユーザーからは削除")
+
+			print("\n[TEST] 件数上限と集計...")
+			for i in range(4):
+				ds.add_recommendation(user_id, BookData(**{"_id": f"new-{i}", "title": "新", "genre": "001017"}), "新")
+			ds.add_recommendation(user_id, BookData(**{"_id": "new-3", "title": "新", "genre": "001017"}), "再")
+			entries = ds.get_recommendations(user_id)
+			assert len(entries) == 5 and entries[0].book_data.isbn == "new-0"
+			assert ds.has_recommended(user_id, "new-3")
+			assert not ds.has_recommended(user_id, "old-2")
+			assert ds.recommend_log.top_isbns(1) == [("new-3", 2)]
+			assert ds.recommend_log.top_genres() == [("001017", 5)]
+			print("[SUCCESS] 古いエントリを捨て、集計からも除く")
+
+			print("\n[TEST] 再起動後の読み込みとTTL...")
+			reopened = RecommendationLog(tmp, max_per_user=5)
+			assert [entry.book_data.isbn for entry in reopened.entries(user_id)] == [entry.book_data.isbn for entry in entries]
+			assert reopened.top_isbns(1) == [("new-3", 2)]
+			size = Path(tmp, "recommend_log.jsonl").stat().st_size
+			assert reopened.expire(datetime.now() + timedelta(days=1)) == 5
+			assert len(reopened) == 0 and not reopened.has_recommended(user_id, "new-3")
+			assert reopened.top_genres() == []
+			assert Path(tmp, "recommend_log.jsonl").stat().st_size < size
+			# 書き直しは他のインスタンスからも反映される
+			assert ds.get_recommendations(user_id) == []
+			ds.close()
+			print("[SUCCESS] TTLを過ぎたエントリを削除してファイルを書き直し")
+
+		return True
+	except Exception as e:
+		print(f"[ERROR] テストエラー: {e}")
+		import traceback
+		traceback.print_exc()
+		return False
+
+
+def test_chat_history():
+	"""アクティブなセッションの履歴コンテナ（ChatHistory）のテスト"""
+	print("\n" + "=" * 60)
+	print("  履歴コンテナテスト")
+	print("=" * 60)
+
+	try:
+		from backend.api.storage import JsonStorage
+		from backend.api.datastore import DataStore
+		from backend.api.history import ChatHistory
+		from backend.api.llm import _append_turn
+		from backend.api.models import Personal
+		from langchain_core.messages import HumanMessage, AIMessage, ToolMessage, messages_to_dict
+
+		print("\n[TEST] messages_to_dict との互換性...")
+		messages = [
+			HumanMessage(content="こんにちは", additional_kwargs={"system_prompt_ref": "0" * 64}),
+			AIMessage(content="いらっしゃいませ"),
+			ToolMessage(content="検索結果", tool_call_id="call_1"),
+			AIMessage(content=[{"type": "text", "text": "おすすめです"}]),
+		]
+		history = ChatHistory(messages)
+		assert history.to_dicts() == messages_to_dict(messages)
+		assert ChatHistory.from_dicts(messages_to_dict(messages)).to_dicts() == messages_to_dict(messages)
+		assert list(history) == messages and history[1:] == messages[1:] and history[-1] == messages[-1]
+		assert ChatHistory.from_dicts([{"role": "user", "content": "仕様書の形式"}])[0] == HumanMessage(content="仕様書の形式")
+		print("[SUCCESS] 変換結果が一致")
+
+		print("\n[TEST] ターンの追記はコピーしない...")
+		before = len(history)
+		assert _append_turn(history, [HumanMessage(content="次"), AIMessage(content="はい")]) is history
+		assert len(history) == before + 2 and history[-2].content == "次"
+		# リストの履歴は従来通り新しいリストになる
+		plain = [HumanMessage(content="a")]
+		assert _append_turn(plain, [AIMessage(content="b")]) is not plain and len(plain) == 1
+		print("[SUCCESS] ChatHistoryはその場で追記")
+
+		with tempfile.TemporaryDirectory() as tmp:
+			print("\n[TEST] DataStoreでの保持と保存...")
+			ds = DataStore(storage=JsonStorage(data_dir=tmp))
+			user_id = "test_chat_history_user_001"
+			ds.create_user(user_id, Personal(name="History User", gender="female", age=28))
+			session_id = ds.create_session(user_id)
+			ds.update_history(session_id, [HumanMessage(content="質問"), AIMessage(content="回答")])
+			live = ds.get_history(session_id)
+			assert isinstance(live, ChatHistory) and len(live) == 2
+			ds.update_history(session_id, _append_turn(live, [HumanMessage(content="質問2"), AIMessage(content="回答2")]))
+			assert ds.get_history(session_id) is live
+			assert ds.get_history_dicts(session_id) == messages_to_dict(list(live))
+			ds.pause_session(session_id)
+			ds.close()
+
+			ds = DataStore(storage=JsonStorage(data_dir=tmp))
+			restored = ds.get_history(session_id)
+			assert isinstance(restored, ChatHistory) and [m.content for m in restored] == ["質問", "回答", "質問2", "回答2"]
+			ds.close()
+			print("[SUCCESS] 再起動後もChatHistoryとして復元")
+
+		return True
+	except Exception as e:
+		print(f"[ERROR] テストエラー: {e}")
+		import traceback
+		traceback.print_exc()
+		return False
+
+
+def test_turn_log():
+	"""ターンログ（アクティブな会話の追記ログ）からの復元テスト"""
+	print("\n" + "=" * 60)
+	print("  ターンログテスト")
+	print("=" * 60)
+
+	try:
+		from backend.api.storage import JsonStorage, TurnLog
+		from backend.api.datastore import DataStore
+		from backend.api.llm import _append_turn
+		from backend.api.models import Personal, UserStatus
+		from langchain_core.messages import HumanMessage, AIMessage
+
+		with tempfile.TemporaryDirectory() as tmp:
+			print("\n[TEST] ターンごとに追記分だけを書く...")
+			ds = DataStore(storage=JsonStorage(data_dir=tmp))
+			user_id = "test_turn_log_user_001"
+			ds.create_user(user_id, Personal(name="Turn User", gender="male", age=40))
+			session_id = ds.create_session(user_id)
+			history = ds.get_history(session_id)
+			for i in range(3):
+				ds.update_history(session_id, _append_turn(history, [HumanMessage(content=f"質問{i}"), AIMessage(content=f"回答{i}")]))
+			ds.turn_log.flush()
+			turns = ds.turn_log.replay()[session_id][1]
+			assert [(start, len(messages)) for start, messages in turns] == [(0, 2), (2, 2), (4, 2)]
+			print("[SUCCESS] 各行は1ターン分（2件）")
+
+			print("\n[TEST] 異常終了後の起動で復元...")
+			# close/pauseせずに終了した（storageには会話もactive_sessionも保存されていない）
+			ds.turn_log.close()
+			assert session_id not in JsonStorage(data_dir=tmp).load()[1]
+			ds = DataStore(storage=JsonStorage(data_dir=tmp))
+			restored = ds.get_history(session_id)
+			assert [m.content for m in restored] == ["質問0", "回答0", "質問1", "回答1", "質問2", "回答2"]
+			user = ds.get_user(user_id)
+			assert user.active_session == session_id and user.status == UserStatus.chatting
+			# 復元した会話はstorageへ保存し、ログは空になる
+			assert len(JsonStorage(data_dir=tmp).load()[1][session_id].messages) == 6
+			assert ds.turn_log.replay() == {}
+			print("[SUCCESS] 6件の履歴とactive_sessionを復元")
+
+			print("\n[TEST] 復元後のターンは保存済みの続きから書く...")
+			ds.update_history(session_id, _append_turn(restored, [HumanMessage(content="質問3"), AIMessage(content="回答3")]))
+			ds.turn_log.flush()
+			assert [(start, len(messages)) for start, messages in ds.turn_log.replay()[session_id][1]] == [(6, 2)]
+			ds.turn_log.close()
+			ds = DataStore(storage=JsonStorage(data_dir=tmp))
+			assert len(ds.get_history(session_id)) == 8
+			print("[SUCCESS] 保存済みの6件に2件を重ねて復元")
+
+			print("\n[TEST] close済みの会話は復元せず、compactで取り除く...")
+			ds.update_history(session_id, _append_turn(ds.get_history(session_id), [HumanMessage(content="質問4")]))
+			ds.close_session(session_id)
+			other = ds.create_session(user_id)
+			ds.update_history(other, [HumanMessage(content="別の会話")])
+			ds.turn_log.flush()
+			# closeした会話の行（追記1行 + discard）は復元に使わない
+			assert len(ds.turn_log) == 3 and list(ds.turn_log.replay()) == [other]
+			assert ds.turn_log.compact() == 2 and len(ds.turn_log) == 1 and list(ds.turn_log.replay()) == [other]
+			ds.close()
+			ds = DataStore(storage=JsonStorage(data_dir=tmp))
+			assert len(ds.get_history(session_id)) == 9
+			assert [m.content for m in ds.get_history(other)] == ["別の会話"]
+			ds.close()
+			print("[SUCCESS] closeした会話の行のみ削除")
+
+			print("\n[TEST] 書きかけの行は読まない...")
+			log = TurnLog(data_dir=tmp)
+			log.append("s1", "u1", 0, [{"type": "human", "data": {"content": "a"}}])
+			log.flush()
+			with open(log.log_file, "a", encoding="utf-8") as f:
+				f.write('{"session_id": "s1", "user_id": "u1", "start": 1, "mess')
+			assert [start for start, _ in log.replay()["s1"][1]] == [0]
+			log.close()
+			print("[SUCCESS] 最後の壊れた行を無視")
+
+		return True
+	except Exception as e:
+		print(f"[ERROR] テストエラー: {e}")
+		import traceback
+		traceback.print_exc()
+		return False
+
+
+def test_lazy_restore():
+	"""pauseセッションの遅延復元テスト"""
+	print("\n" + "=" * 60)
+	print("  pauseセッション遅延復元テスト")
+	print("=" * 60)
+
+	try:
+		from backend.api.storage import JsonStorage
+		from backend.api.datastore import DataStore
+		from backend.api.models import Personal, ChatStatus
+		from langchain_core.messages import HumanMessage, AIMessage
+
+		with tempfile.TemporaryDirectory() as tmp:
+			ds = DataStore(storage=JsonStorage(data_dir=tmp))
+			session_ids = []
+			for i in range(3):
+				user_id = f"test_lazy_user_{i:03d}"
+				ds.create_user(user_id, Personal(name=f"Lazy {i}", gender="female", age=20 + i))
+				session_id = ds.create_session(user_id)
+				ds.update_history(session_id, [HumanMessage(content=f"質問{i}"), AIMessage(content=f"回答{i}")])
+				ds.pause_session(session_id)
+				session_ids.append(session_id)
+			ds.close()
+
+			print("\n[TEST] 起動時は履歴を復元しない...")
+			ds = DataStore(storage=JsonStorage(data_dir=tmp))
+			assert ds.sessions == {}
+			assert ds.memory_stats()["unrestored_sessions"] == 3
+			print("[SUCCESS] 3件とも未復元")
+
+			print("\n[TEST] 最初のアクセスで1件ずつ復元...")
+			assert [m.content for m in ds.get_history(session_ids[0])] == ["質問0", "回答0"]
+			assert session_ids[0] in ds.sessions and session_ids[1] not in ds.sessions
+			# API応答用の履歴は復元せずに保存済みのmessagesを返す
+			assert ds.get_history_dicts(session_ids[1])[0]["data"]["content"] == "質問1"
+			assert session_ids[1] not in ds.sessions
+			ds.resume_session(session_ids[1])
+			assert len(ds.sessions[session_ids[1]]) == 2
+			assert ds.conversations[session_ids[1]].status == ChatStatus.active
+			print("[SUCCESS] get_history / resume_session で復元")
+
+			print("\n[TEST] 復元していない会話のclose...")
+			ds.close_session(session_ids[2])
+			assert ds.memory_stats()["unrestored_sessions"] == 0
+			ds.close()
+			ds = DataStore(storage=JsonStorage(data_dir=tmp))
+			assert ds.has_session(session_ids[2]) and ds.conversations[session_ids[2]].status == ChatStatus.closed
+			assert [m.content for m in ds.get_history(session_ids[2])] == ["質問2", "回答2"]
+			ds.close()
+			print("[SUCCESS] 保存済みの履歴のままclose")
+
+		return True
+	except Exception as e:
+		print(f"[ERROR] テストエラー: {e}")
+		import traceback
+		traceback.print_exc()
+		return False
+
+
+def test_session_list():
+	"""ユーザーごとの会話一覧（ページング）のテスト"""
+	print("\n" + "=" * 60)
+	print("  会話一覧テスト")
+	print("=" * 60)
+
+	try:
+		from backend.api.storage import SqliteStorage
+		from backend.api.datastore import DataStore
+		from backend.api.models import Personal, ChatStatus
+		from langchain_core.messages import HumanMessage, AIMessage
+
+		with tempfile.TemporaryDirectory() as tmp:
+			ds = DataStore(storage=SqliteStorage(data_dir=tmp))
+			user_id = "test_session_list_user_001"
+			ds.create_user(user_id, Personal(name="List User", gender="male", age=50))
+			closed_ids = []
+			for i in range(3):
+				session_id = ds.create_session(user_id)
+				ds.update_history(session_id, [HumanMessage(content=f"質問{i}"), AIMessage(content=f"回答{i}")])
+				ds.close_session(session_id)
+				closed_ids.append(session_id)
+			active_id = ds.create_session(user_id)
+			ds.update_history(active_id, [HumanMessage(content="今の会話")])
+			ds.close()
+
+			print("\n[TEST] 再起動後、closedの会話を含む一覧...")
+			ds = DataStore(storage=SqliteStorage(data_dir=tmp))
+			assert closed_ids[0] not in ds.conversations
+			total, page = ds.list_sessions(user_id, offset=0, limit=2)
+			assert total == 4
+			assert [summary.session_id for summary in page] == [active_id, closed_ids[2]]
+			assert page[0].status == ChatStatus.active and page[1].status == ChatStatus.closed
+			assert not hasattr(page[0], "messages")
+			# 一覧のために読んだ会話はメモリに載せない
+			assert closed_ids[0] not in ds.conversations
+			total, page = ds.list_sessions(user_id, offset=2, limit=2)
+			assert [summary.session_id for summary in page] == [closed_ids[1], closed_ids[0]]
+			print("[SUCCESS] 最終アクセスの新しい順に2件ずつ")
+
+			print("\n[TEST] 会話の変更を一覧に反映...")
+			ds.close_session(active_id)
+			ds.conversations[active_id].summary = "要約"
+			ds._summarize(ds.conversations[active_id])
+			new_id = ds.create_session(user_id)
+			total, page = ds.list_sessions(user_id, limit=2)
+			assert total == 5 and page[0].session_id == new_id
+			assert page[1].status == ChatStatus.closed and page[1].summary == "要約"
+			assert ds.list_sessions("no_such_user") is None
+			ds.close()
+			print("[SUCCESS] 新しい会話・close・要約を反映")
+
+		return True
+	except Exception as e:
+		print(f"[ERROR] テストエラー: {e}")
+		import traceback
+		traceback.print_exc()
+		return False
+
+
+def test_storage_sync():
+	"""sync() がホスト全体（os.sync）ではなく、書き出したファイルだけをfsyncすることのテスト"""
+	print("\n" + "=" * 60)
+	print("  storage.sync() テスト")
+	print("=" * 60)
+
+	import os
+	from unittest import mock
+	try:
+		from backend.api.storage import JsonStorage, ShardedStorage, WalStorage, SnapshotStorage
+		from backend.api.models import Conversation, ChatStatus
+
+		for storage_class in (JsonStorage, ShardedStorage, WalStorage, SnapshotStorage):
+			with tempfile.TemporaryDirectory() as tmp:
+				storage = storage_class(data_dir=tmp)
+				storage.load()
+				conv = Conversation(**{"_id": "sync_session", "user_id": "sync_user", "status": ChatStatus.active})
+				storage.put_conversation(conv)
+				if hasattr(storage, "compact"):
+					storage.compact()
+				synced = []
+				real_fsync = os.fsync
+
+				def recording_fsync(fd):
+					synced.append(fd)
+					real_fsync(fd)
+
+				with mock.patch.object(os, "sync", side_effect=AssertionError("os.sync() called")), \
+						mock.patch.object(os, "fsync", side_effect=recording_fsync):
+					storage.sync()
+					assert synced, f"{storage_class.__name__}: nothing fsynced"
+					count = len(synced)
+					# 書き出していなければ、2回目は書き直したファイルをfsyncしない
+					synced.clear()
+					storage.sync()
+					assert len(synced) < count, f"{storage_class.__name__}: fsynced again {synced}"
+				storage.close()
+				print(f"[SUCCESS] {storage_class.__name__}: 自分のファイルのみ（{count}件）")
+		return True
+	except Exception as e:
+		print(f"[ERROR] テストエラー: {e}")
+		import traceback
+		traceback.print_exc()
+		return False
+
+
+def main():
+	"""メインテスト"""
+	print("\n" + "🚀" * 30)
+	print("  永続化バックエンドテスト開始")
+	print("🚀" * 30)
+
+	results = []
+
+	# テスト実行
+	results.append(("WAL再生テスト", test_wal_replay()))
+	results.append(("WAL圧縮テスト", test_wal_compaction()))
+	results.append(("ユーザー遅延読み込みテスト", test_user_index()))
+	results.append(("NFC紐付け保存テスト", test_nfc_mapping()))
+	results.append(("SQLiteバックエンドテスト", test_sqlite_storage()))
+	results.append(("会話分割バックエンドテスト", test_sharded_storage()))
+	results.append(("write-behindテスト", test_write_behind()))
+	results.append(("msgpackスナップショットテスト", test_snapshot_storage()))
+	results.append(("MongoDBバックエンドテスト", test_mongodb_storage()))
+	results.append(("システムプロンプト重複排除テスト", test_system_prompt_dedup()))
+	results.append(("過去の会話履歴キャッシュテスト", test_history_cache()))
+	results.append(("会話アーカイブテスト", test_archive()))
+	results.append(("メモリ上限テスト", test_memory_budget()))
+	results.append(("推薦ログテスト", test_recommend_log()))
+	results.append(("履歴コンテナテスト", test_chat_history()))
+	results.append(("ターンログテスト", test_turn_log()))
+	results.append(("pauseセッション遅延復元テスト", test_lazy_restore()))
+	results.append(("会話一覧テスト", test_session_list()))
+	results.append(("storage.sync() テスト", test_storage_sync()))
+
+	# 結果サマリー
+	print("\n" + "=" * 60)
+	print("  テスト結果サマリー")
+	print("=" * 60)
+
+	passed = sum(1 for _, result in results if result)
+	total = len(results)
+
+	for name, result in results:
+		status = "[PASS]" if result else "[FAIL]"
+		print(f"{status} {name}")
+
+	print("\n" + "=" * 60)
+	print(f"  合計: {passed}/{total} テスト成功")
+	print("=" * 60)
+
+	if passed == total:
+		print("\n" + "🎉" * 30)
+		print("  すべてのテストが成功しました！")
+		print("🎉" * 30)
+		return 0
+	else:
+		print("\n" + "❌" * 30)
+		print(f"  {total - passed}個のテストが失敗しました")
+		print("❌" * 30)
+		return 1
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+チャット応答のストリーミング（SSE / WebSocket）のテストスクリプト
+LLMは決まった順にツールを呼ぶモデルに差し替え、一時ディレクトリのDataStoreを使う
+（backend/api/data のデータには影響しない）
+"""
+
+import sys
+import json
+import tempfile
+from pathlib import Path
+from typing import ClassVar
+
+# プロジェクトルートをパスに追加
+project_root = Path(__file__).resolve().parent.parent.parent
+sys.path.insert(0, str(project_root))
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+FINAL_TEXT = "おすすめはこの本です。ぜひ読んでみてください。"
+
+
+class ScriptedModel(BaseChatModel):
+	"""検索・表情 → 推薦 → 応答（数文字ずつストリーミング）の順に返すモデル"""
+	@property
+	def _llm_type(self) -> str:
+		return "scripted"
+
+	def bind_tools(self, tools, **kwargs):
+		return self
+
+	def _message(self, messages):
+		last = messages[-1]
+		if isinstance(last, HumanMessage):
+			return AIMessage(content="", tool_calls=[
+				{"name": "search_books", "args": {"keywords": ["SF"]}, "id": "search"},
+				{"name": "update_expression", "args": {"expression_type": "thinking"}, "id": "expr"},
+			])
+		if isinstance(last, ToolMessage) and last.name != "recommend_books":
+			return AIMessage(content="", tool_calls=[
+				{"name": "recommend_books", "args": {"selections": [{"number": 1, "reason": "入門向け"}]}, "id": "rec"},
+			])
+		return AIMessage(content=FINAL_TEXT)
+
+	def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+		return ChatResult(generations=[ChatGeneration(message=self._message(messages))])
+
+	def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+		message = self._message(messages)
+		if message.tool_calls:
+			yield ChatGenerationChunk(message=AIMessageChunk(content="", tool_call_chunks=[
+				{"name": call["name"], "args": json.dumps(call["args"]), "id": call["id"], "index": i}
+				for i, call in enumerate(message.tool_calls)
+			]))
+			return
+		for i in range(0, len(message.content), 4):
+			chunk = ChatGenerationChunk(message=AIMessageChunk(content=message.content[i:i + 4]))
+			if run_manager:
+				run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+			yield chunk
+
+
+class EmptyOnceModel(ScriptedModel):
+	"""最初の試行は空白だけの応答、2回目以降は FINAL_TEXT をツールを呼ばずに返すモデル"""
+	attempts: ClassVar[int] = 0
+
+	def _message(self, messages):
+		EmptyOnceModel.attempts += 1
+		return AIMessage(content="  \n" if EmptyOnceModel.attempts == 1 else FINAL_TEXT)
+
+
+class _Patched:
+	"""LLM・楽天API・プロンプトの保存先を差し替え、終了時に戻す"""
+
+	def __init__(self, tmp):
+		from backend.api import llm
+		self.llm = llm
+		self.tmp = tmp
+
+	def __enter__(self):
+		llm = self.llm
+		self.saved = (llm.get_llm, llm.rakuten_search_books, llm.prompt_store)
+		llm.get_llm = lambda **kwargs: ScriptedModel()
+		llm.rakuten_search_books = lambda keywords, count=10, orflag=0: [{"title": "SF入門", "authors": ["著者"]}]
+		llm.prompt_store = llm.PromptStore(data_dir=self.tmp)
+		llm._agents.clear()
+		return llm
+
+	def __exit__(self, *exc):
+		llm = self.llm
+		llm.get_llm, llm.rakuten_search_books, llm.prompt_store = self.saved
+		llm._agents.clear()
+
+
+def test_llm_chat_events():
+	"""llm_chatのon_eventで途中経過が通知されることを確認"""
+	print("\n" + "=" * 60)
+	print("  テスト: llm_chatの途中経過")
+	print("=" * 60)
+
+	try:
+		from backend import PROMPT_DEFAULT
+
+		with tempfile.TemporaryDirectory() as tmp, _Patched(tmp) as llm:
+			events = []
+			response, history, books, expression = llm.llm_chat(
+				str(PROMPT_DEFAULT), "SFの本を探して", [], on_event=lambda event, data: events.append((event, data))
+			)
+			assert response == FINAL_TEXT, response
+			names = [event for event, _ in events]
+			print(f"[INFO] イベント: {names}")
+
+			# ツールの実行時に表情・推薦、その後に応答のテキスト
+			assert ("expression", {"expression": "thinking"}) in events
+			recommended = [data for event, data in events if event == "recommended_books"]
+			assert len(recommended) == 1 and recommended[0]["books"][0]["title"] == "SF入門"
+			assert names.index("recommended_books") < names.index("token")
+			tokens = [data for event, data in events if event == "token"]
+			assert len(tokens) > 1
+			assert "".join(token["text"] for token in tokens) == FINAL_TEXT
+			assert len({token["step"] for token in tokens}) == 1
+			assert books == recommended[0]["books"] and expression == "thinking"
+			print(f"[SUCCESS] 表情・推薦の後にテキストが{len(tokens)}回に分けて届いた")
+
+			print("\n[TEST] on_eventなしは従来通り...")
+			response, history, books, expression = llm.llm_chat(str(PROMPT_DEFAULT), "SFの本を探して", [])
+			assert response == FINAL_TEXT and books[0]["title"] == "SF入門"
+			print("[SUCCESS] 同じ応答")
+
+			print("\n[TEST] 空の応答のやり直し...")
+			llm.get_llm = lambda **kwargs: EmptyOnceModel()
+			llm._agents.clear()
+			events = []
+			response, history, books, expression = llm.llm_chat(
+				str(PROMPT_DEFAULT), "こんにちは", [], on_event=lambda event, data: events.append((event, data))
+			)
+			assert response == FINAL_TEXT, response
+			names = [event for event, _ in events]
+			assert names.count("retry") == 1 and ("retry", {"attempt": 2}) in events
+			# retry より前の token は破棄された試行の分で、後の token だけで応答になる
+			retry_at = names.index("retry")
+			assert any(event == "token" for event, _ in events[:retry_at])
+			assert "".join(data["text"] for event, data in events[retry_at:] if event == "token") == FINAL_TEXT
+			print("[SUCCESS] やり直す前に retry を通知")
+		return True
+	except Exception as e:
+		print(f"[ERROR] テストエラー: {e}")
+		import traceback
+		traceback.print_exc()
+		return False
+
+
+def _parse_sse(text):
+	"""SSEの本文を (イベント名, データ) のリストにする"""
+	events = []
+	for block in text.strip().split("\n\n"):
+		fields = dict(line.split(": ", 1) for line in block.split("\n"))
+		events.append((fields["event"], json.loads(fields["data"])))
+	return events
+
+
+def test_stream_endpoints():
+	"""SSE / WebSocket のエンドポイントのテスト"""
+	print("\n" + "=" * 60)
+	print("  テスト: ストリーミングのエンドポイント")
+	print("=" * 60)
+
+	try:
+		from fastapi import FastAPI
+		from fastapi.testclient import TestClient
+		from backend.api import server as server_module
+		from backend.api.datastore import DataStore
+		from backend.api.models import Personal
+		from backend.api.storage import SqliteStorage
+
+		user_id = "test_stream_user_001"
+		original_verify = server_module.auth.verify_id_token
+		server_module.auth.verify_id_token = lambda token: {"uid": user_id}
+		try:
+			with tempfile.TemporaryDirectory() as tmp, _Patched(tmp):
+				ds = DataStore(storage=SqliteStorage(data_dir=tmp))
+				ds.create_user(user_id, Personal(name="Stream User", gender="female", age=20))
+				app = FastAPI()
+				server_module.Server(app, ds)
+				headers = {"Authorization": "Bearer test-token"}
+
+				with TestClient(app) as client:
+					print("\n[TEST] SSEで新規セッションに送信...")
+					response = client.post("/sessions/new/messages/stream", json={"message": "SFの本を探して"}, headers=headers)
+					assert response.status_code == 200
+					assert response.headers["content-type"].startswith("text/event-stream")
+					events = _parse_sse(response.text)
+					names = [event for event, _ in events]
+					print(f"[INFO] イベント: {names}")
+					assert names[0] == "session" and names[-1] == "done"
+					session_id = events[0][1]["session_id"]
+					done = events[-1][1]
+					assert done["session_id"] == session_id and done["response"] == FINAL_TEXT
+					assert done["expression"] == "thinking" and done["recommended_books"][0]["title"] == "SF入門"
+					assert "".join(data["text"] for event, data in events if event == "token") == FINAL_TEXT
+					assert ds.has_user_session(user_id, session_id)
+					assert len(ds.get_history(session_id)) == 2
+					print("[SUCCESS] session → 途中経過 → done の順に届き、履歴が保存された")
+
+					print("\n[TEST] 他人のセッションには送れない...")
+					response = client.post("/sessions/unknown/messages/stream", json={"message": "こんにちは"}, headers=headers)
+					assert response.status_code == 404
+					print("[SUCCESS] 404")
+
+					print("\n[TEST] WebSocketで2ターン...")
+					with client.websocket_connect("/sessions/new/messages/ws") as ws:
+						for turn, payload in enumerate([{"token": "test-token", "message": "SFの本を探して"}, {"message": "他には？"}]):
+							ws.send_json(payload)
+							received = []
+							while True:
+								message = ws.receive_json()
+								received.append(message["event"])
+								if message["event"] in ("done", "error"):
+									break
+							assert received[-1] == "done", received
+							assert "token" in received and "recommended_books" in received
+							# "new" でもアクティブなセッションがあれば再開する（SSEで作ったセッションに続く）
+							assert message["data"]["session_id"] == session_id
+					assert len(ds.get_history(session_id)) == 6
+					print("[SUCCESS] 同じ接続で2ターン")
+				ds.close()
+		finally:
+			server_module.auth.verify_id_token = original_verify
+		return True
+	except Exception as e:
+		print(f"[ERROR] テストエラー: {e}")
+		import traceback
+		traceback.print_exc()
+		return False
+
+
+def test_session_events():
+	"""セッションのイベントの購読（GET /sessions/{session_id}/events）のテスト"""
+	print("\n" + "=" * 60)
+	print("  テスト: セッションのイベント")
+	print("=" * 60)
+
+	try:
+		import threading
+		import time
+		from fastapi import FastAPI
+		from fastapi.testclient import TestClient
+		from backend.api import server as server_module
+		from backend.api.datastore import DataStore
+		from backend.api.models import Personal
+		from backend.api.storage import SqliteStorage
+
+		user_id = "test_events_user_001"
+		original_verify = server_module.auth.verify_id_token
+		server_module.auth.verify_id_token = lambda token: {"uid": user_id}
+		try:
+			with tempfile.TemporaryDirectory() as tmp, _Patched(tmp):
+				ds = DataStore(storage=SqliteStorage(data_dir=tmp))
+				ds.create_user(user_id, Personal(name="Events User", gender="male", age=30))
+				session_id = ds.create_session(user_id)
+				app = FastAPI()
+				server = server_module.Server(app, ds)
+				headers = {"Authorization": "Bearer test-token"}
+
+				with TestClient(app) as client:
+					print("\n[TEST] 購読中に通常の送信 → close...")
+					received = []
+
+					def subscribe():
+						with client.stream("GET", f"/sessions/{session_id}/events", headers=headers) as response:
+							assert response.status_code == 200
+							received.extend(_parse_sse(response.read().decode()))
+
+					thread = threading.Thread(target=subscribe)
+					thread.start()
+					deadline = time.time() + 10
+					while not server.events.has_subscribers(session_id) and time.time() < deadline:
+						time.sleep(0.01)
+					assert server.events.has_subscribers(session_id)
+
+					response = client.post(f"/sessions/{session_id}/messages", json={"message": "SFの本を探して"}, headers=headers)
+					assert response.status_code == 201
+					response = client.post(f"/sessions/{session_id}/close", headers=headers)
+					assert response.status_code == 200
+					thread.join(timeout=10)
+					assert not thread.is_alive()
+
+					names = [event for event, _ in received]
+					print(f"[INFO] イベント: {names}")
+					# 検索と表情のツールは並行に実行されるため、その間の順序は決まらない
+					assert names[0] == "turn_started" and names[-2:] == ["done", "closed"], names
+					assert sorted(names[1:-2]) == ["books_found", "expression", "recommended_books", "search_started"], names
+					assert names.index("search_started") < names.index("books_found") < names.index("recommended_books")
+					data = dict(received)
+					assert data["search_started"]["keywords"] == ["SF"]
+					assert data["books_found"]["books"][0]["number"] == 1
+					assert data["recommended_books"]["books"][0]["title"] == "SF入門"
+					assert data["done"]["response"] == FINAL_TEXT
+					# 生成中のテキストは配信しない
+					assert "token" not in names
+					assert len(server.events) == 0
+					print("[SUCCESS] ツールのイベントが応答より前に届き、closeで終了した")
+
+					print("\n[TEST] 他人のセッションは購読できない...")
+					response = client.get("/sessions/unknown/events", headers=headers)
+					assert response.status_code == 404
+					print("[SUCCESS] 404")
+				ds.close()
+		finally:
+			server_module.auth.verify_id_token = original_verify
+		return True
+	except Exception as e:
+		print(f"[ERROR] テストエラー: {e}")
+		import traceback
+		traceback.print_exc()
+		return False
+
+
+def main():
+	"""メインテスト"""
+	print("\n" + "🚀" * 30)
+	print("  ストリーミングテスト開始")
+	print("🚀" * 30)
+
+	results = []
+
+	# テスト実行
+	results.append(("llm_chat途中経過テスト", test_llm_chat_events()))
+	results.append(("ストリーミングエンドポイントテスト", test_stream_endpoints()))
+	results.append(("セッションイベントテスト", test_session_events()))
+
+	# 結果サマリー
+	print("\n" + "=" * 60)
+	print("  テスト結果サマリー")
+	print("=" * 60)
+
+	passed = sum(1 for _, result in results if result)
+	total = len(results)
+
+	for name, result in results:
+		status = "[PASS]" if result else "[FAIL]"
+		print(f"{status} {name}")
+
+	print("\n" + "=" * 60)
+	print(f"  合計: {passed}/{total} テスト成功")
+	print("=" * 60)
+
+	if passed == total:
+		print("\n" + "🎉" * 30)
+		print("  すべてのテストが成功しました！")
+		print("🎉" * 30)
+		return 0
+	else:
+		print("\n" + "❌" * 30)
+		print(f"  {total - passed}個のテストが失敗しました")
+		print("❌" * 30)
+		return 1
+
+if __name__ == "__main__":
+	sys.exit(main())
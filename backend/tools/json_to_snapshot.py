@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+"""
+既存のJSONデータ（users.json / conversations.json / nfc_users.json）を
+msgpackスナップショット（DATASTORE_BACKEND=snapshot 用）へ変換するスクリプト
+
+使い方:
+    python -m backend.tools.json_to_snapshot
+    python -m backend.tools.json_to_snapshot --data-dir path/to/data
+
+変換後は .env に DATASTORE_BACKEND=snapshot を設定して起動してください。
+JSONファイルは削除しないので、json バックエンドへ戻すこともできます（ただし変換後の変更は反映されません）。
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+# プロジェクトルートをPythonパスに追加
+project_root = Path(__file__).resolve().parent.parent.parent
+if str(project_root) not in sys.path:
+    sys.path.insert(0, str(project_root))
+
+from backend import DATA_DIR
+from backend.api.storage import convert_json_to_snapshot
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Convert JSON datastore files into a msgpack snapshot")
+    parser.add_argument("--data-dir", type=Path, default=DATA_DIR, help=f"data directory (default: {DATA_DIR})")
+    args = parser.parse_args()
+
+    if not Path(args.data_dir, "users.json").exists():
+        print(f"[ERROR] users.json not found in {args.data_dir}")
+        return 1
+
+    start = time.perf_counter()
+    users, conversations, nfc_users = convert_json_to_snapshot(args.data_dir)
+    elapsed = time.perf_counter() - start
+    print(
+        f"[SUCCESS] Converted {users} user(s), {conversations} conversation(s), "
+        f"{nfc_users} NFC card(s) in {elapsed:.2f}s"
+    )
+    print(f"  -> {Path(args.data_dir, 'datastore.snapshot')}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
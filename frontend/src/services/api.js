@@ -1,5 +1,30 @@
 const API_BASE_URL = import.meta.env.VITE_API_BASE_URL || 'http://localhost:8000'
 
+/*
+ * SSE（"event: ...\ndata: ...\n\n"）のレスポンスを読みながら onEvent(event, data) を呼ぶ
+ * （EventSourceはAuthorizationヘッダーを付けられないため fetch で読む）
+ */
+async function readServerSentEvents(response, onEvent) {
+    const reader = response.body.pipeThrough(new TextDecoderStream()).getReader()
+    let buffer = ''
+    while (true) {
+        const { value, done } = await reader.read()
+        if (done) return
+        buffer += value
+        let end
+        while ((end = buffer.indexOf('\n\n')) !== -1) {
+            const block = buffer.slice(0, end)
+            buffer = buffer.slice(end + 2)
+            // ": keepalive" 等のコメント行は読み飛ばす
+            const fields = Object.fromEntries(block.split('\n').filter(line => !line.startsWith(':')).map(line => {
+                const index = line.indexOf(': ')
+                return [line.slice(0, index), line.slice(index + 2)]
+            }))
+            if (fields.event) onEvent(fields.event, JSON.parse(fields.data))
+        }
+    }
+}
+
 export const api = {
     // ========================================
     // ユーザー関連API
@@ -96,6 +121,67 @@ export const api = {
         return response.json()
     },
 
+    /*
+     * メッセージ送信（ストリーミング）
+     * 途中経過のイベント（session / token / retry / expression / recommended_books）を onEvent(event, data) で受け取り、
+     * done のデータ（sendMessage と同じ内容）を返す
+     * token の data.streamed はそれまでに受け取ったテキストの全体。
+     * retry はサーバーが空の応答をやり直す時に届き、それまでの token は応答に含まれない（streamed も空に戻る）
+     */
+    async sendMessageStream(sessionId, message, idToken, onEvent, mode = 'default') {
+        const url = sessionId
+            ? `${API_BASE_URL}/sessions/${sessionId}/messages/stream?mode=${mode}`
+            : `${API_BASE_URL}/sessions/new/messages/stream?mode=${mode}`
+
+        const response = await fetch(url, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'Authorization': `Bearer ${idToken}`
+            },
+            body: JSON.stringify({ message, mode })
+        })
+
+        if (!response.ok) throw new Error('Failed to send message')
+
+        let result = null
+        let streamed = ''
+        await readServerSentEvents(response, (event, data) => {
+            if (event === 'done') result = data
+            else if (event === 'error') throw new Error(data.detail || 'Failed to send message')
+            else {
+                if (event === 'token') {
+                    streamed += data.text
+                    data = { ...data, streamed }
+                } else if (event === 'retry') {
+                    // 破棄された試行のテキストを取り消す
+                    streamed = ''
+                }
+                if (onEvent) onEvent(event, data)
+            }
+        })
+        if (!result) throw new Error('Stream ended unexpectedly')
+        return result
+    },
+
+    /*
+     * セッションのイベント購読（セカンドディスプレイ向け）
+     * ツールの実行時のイベント（turn_started / search_started / books_found / recommended_books / expression / done）を
+     * onEvent(event, data) で受け取る。セッションがcloseされる（closed）か signal で中断するまで続く
+     */
+    async subscribeSessionEvents(sessionId, idToken, onEvent, signal) {
+        const response = await fetch(`${API_BASE_URL}/sessions/${sessionId}/events`, {
+            method: 'GET',
+            headers: {
+                'Authorization': `Bearer ${idToken}`
+            },
+            signal
+        })
+
+        if (!response.ok) throw new Error('Failed to subscribe session events')
+        await readServerSentEvents(response, onEvent)
+    },
+
     /*
      * セッション情報取得
      */